@@ -0,0 +1,361 @@
+"""Discord Summary Bot のベンチマーク
+
+Discordにも Gemini にも接続せずに、合成メッセージを on_message に直接流し込み、
+ホットパスの性能を計測する。Gemini は遅延とエラー率を設定できるローカルの代替クライアントに置き換える。
+
+使用例:
+    python benchmark.py                                   # デフォルト規模で計測
+    python benchmark.py --guilds 50 --messages 500000     # 規模を変更
+    python benchmark.py --latency 2 --error-rate 0.1      # Geminiの遅延とエラー率を変更
+    python benchmark.py --json result.json                # 結果をJSONで保存
+    python benchmark.py --compare result.json             # 保存した結果と比較し、悪化していれば終了コード1
+
+同じ --seed なら同じメッセージ列とGeminiの応答（遅延・エラー）が生成される。
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import sys
+import time
+import types as pytypes
+from datetime import datetime, timedelta, timezone
+
+# bot.py の読み込み前に必須の設定を埋める（実際には接続しない）
+os.environ.setdefault('DISCORD_BOT_TOKEN', 'benchmark')
+os.environ.setdefault('GOOGLE_API_KEY', 'benchmark')
+os.environ['MESSAGE_STORE_PATH'] = ''
+os.environ['SCHEDULE_SPREAD_MINUTES'] = '0'
+# 利用枠の待機ではなくBot自体の処理時間を計測する
+for name in ('GEMINI_RPM', 'GEMINI_RPD', 'GEMINI_TPM', 'GEMINI_TPD'):
+    os.environ[name] = '0'
+
+import discord
+import psutil
+from google.genai import errors as genai_errors
+
+import bot
+
+JAPANESE_PHRASES = [
+    "おはようございます", "了解です", "ありがとうございます！", "確認します", "よろしくお願いします",
+    "本番環境へのデプロイが完了しました", "ステージングでエラーが出ています", "レビューお願いできますか",
+    "明日のミーティングは10時からです", "週末のイベント会場の予約が取れました", "参加者の名簿を共有します",
+    "データベースのレプリケーション遅延を調査中です", "障害対応の振り返りをしましょう",
+    "新機能の仕様書を更新しました", "キャッシュの設定を見直したら速くなりました",
+]
+ENGLISH_PHRASES = [
+    "good morning", "thanks!", "lgtm", "can someone review my pull request?",
+    "the deploy to production finished", "seeing timeouts on the api gateway again",
+    "let's sync tomorrow at 10", "I pushed a fix for the memory leak", "kubernetes cluster upgrade is scheduled",
+    "https://example.com/docs/runbook", "benchmark numbers look better after the refactor",
+]
+AUTHORS = [f"user{i}" for i in range(500)] + ["田中", "佐藤", "鈴木", "高橋", "伊藤", "渡辺", "山本", "中村"]
+
+
+class FakeResponse:
+    def __init__(self, text, prompt_tokens, output_tokens):
+        self.text = text
+        self.usage_metadata = pytypes.SimpleNamespace(
+            prompt_token_count=prompt_tokens, candidates_token_count=output_tokens)
+
+
+class FakeModels:
+    """client.aio.models の代替（遅延はプロンプトの長さに比例する分と一定の分の和）"""
+
+    def __init__(self, latency, latency_per_1k_tokens, error_rate, seed):
+        self.latency = latency
+        self.latency_per_1k_tokens = latency_per_1k_tokens
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.calls = 0
+        self.errors = 0
+
+    async def _respond(self, contents):
+        self.calls += 1
+        prompt_tokens = bot.estimate_tokens(contents)
+        # 同じシードなら同じ順序で同じ遅延・エラーになるよう、待機前に乱数を引く
+        delay = self.latency * self.rng.uniform(0.5, 1.5) + prompt_tokens / 1000 * self.latency_per_1k_tokens
+        failed = self.rng.random() < self.error_rate
+        await asyncio.sleep(delay)
+        if failed:
+            self.errors += 1
+            raise genai_errors.ServerError(503, {'error': {'message': 'benchmark', 'status': 'UNAVAILABLE'}})
+        text = f"ベンチマーク用の要約（入力 約{prompt_tokens} tokens）"
+        return FakeResponse(text, prompt_tokens, len(text))
+
+    async def generate_content(self, model, contents, config=None):
+        return await self._respond(contents)
+
+    async def generate_content_stream(self, model, contents, config=None):
+        response = await self._respond(contents)
+
+        async def chunks():
+            for i in range(0, len(response.text), 8):
+                yield pytypes.SimpleNamespace(text=response.text[i:i + 8], usage_metadata=None)
+            yield pytypes.SimpleNamespace(text=None, usage_metadata=response.usage_metadata)
+        return chunks()
+
+
+class FakeChannel:
+    def __init__(self, channel_id, name, guild):
+        self.id = channel_id
+        self.name = name
+        self.guild = guild
+        self.sent = 0
+
+    async def send(self, content=None, embed=None):
+        self.sent += 1
+
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.name = f"guild-{guild_id}"
+        self.channels = []
+
+
+def make_message(message_id, guild, channel, author, content, created_at):
+    return pytypes.SimpleNamespace(
+        id=message_id,
+        author=pytypes.SimpleNamespace(display_name=author, bot=False, id=hash(author) & 0xffffffff),
+        content=content,
+        created_at=created_at,
+        guild=guild,
+        channel=channel,
+        attachments=[],
+        embeds=[],
+    )
+
+
+def generate_messages(guilds, total, hours, burst_ratio, seed):
+    """合成メッセージを時刻順に生成
+
+    サーバーの規模はべき分布（少数の大規模サーバーと多数の小規模サーバー）、チャンネルの活動量も偏らせる。
+    burst_ratio の割合のメッセージは、サーバーごとに選んだ数個の「盛り上がった1時間」に集中させる。
+    """
+    rng = random.Random(seed)
+    now = datetime.now(timezone.utc)
+    start = now - timedelta(hours=hours)
+    guild_weights = [1 / (i + 1) for i in range(len(guilds))]
+    bursts = {guild.id: [rng.uniform(0, hours - 1) for _ in range(3)] for guild in guilds}
+
+    events = []
+    for _ in range(total):
+        guild = rng.choices(guilds, weights=guild_weights)[0]
+        channel = guild.channels[min(int(rng.expovariate(0.4)), len(guild.channels) - 1)]
+        if rng.random() < burst_ratio:
+            offset = rng.choice(bursts[guild.id]) + rng.uniform(0, 1)
+        else:
+            offset = rng.uniform(0, hours)
+        phrases = JAPANESE_PHRASES if rng.random() < 0.7 else ENGLISH_PHRASES
+        content = " ".join(rng.choice(phrases) for _ in range(rng.randint(1, 3)))
+        events.append((start + timedelta(hours=offset), guild, channel, rng.choice(AUTHORS), content))
+    events.sort(key=lambda e: e[0])
+
+    messages = []
+    for index, (created_at, guild, channel, author, content) in enumerate(events):
+        created_at = created_at.replace(microsecond=(created_at.microsecond // 1000) * 1000)
+        message_id = discord.utils.time_snowflake(created_at) + (index & 0x3fffff)
+        messages.append(make_message(message_id, guild, channel, author, content, created_at))
+    return messages
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)] if values else 0.0
+
+
+def timed(func, repeat):
+    """funcをrepeat回実行し、各回の所要時間（ミリ秒）のリストを返す（キャッシュを温めるため初回は計測しない）"""
+    func()
+    durations = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        durations.append((time.perf_counter() - started) * 1000)
+    return durations
+
+
+async def timed_async(func, repeat):
+    durations = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        await func()
+        durations.append((time.perf_counter() - started) * 1000)
+    return durations
+
+
+def peak_rss_mb():
+    """プロセスの最大RSS（MB）。resourceが使えない環境では現在のRSS"""
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+    except ImportError:
+        return psutil.Process().memory_info().rss / 1024 / 1024
+
+
+async def run_benchmark(args):
+    results = {}
+    rng = random.Random(args.seed)
+    fake_models = FakeModels(args.latency, args.latency_per_1k_tokens, args.error_rate, args.seed)
+    bot.client = pytypes.SimpleNamespace(aio=pytypes.SimpleNamespace(models=fake_models))
+    if args.no_breaker:
+        bot.BREAKER_THRESHOLD = 10 ** 9
+
+    # 合成サーバーを登録
+    guilds = {}
+    for g in range(args.guilds):
+        guild = FakeGuild(10 ** 17 + g)
+        guild.channels = [FakeChannel(10 ** 17 + g * 1000 + c, f"channel-{c}", guild) for c in range(args.channels)]
+        summary_channel = FakeChannel(10 ** 17 + g * 1000 + 999, bot.BOT_CHANNEL_NAME, guild)
+        guilds[guild.id] = guild
+        bot.server_configs[guild.id] = {
+            'summary_channel': summary_channel,
+            'enabled': True,
+            'timezone': bot.DEFAULT_TIMEZONE,
+            'schedule_hours': None,
+        }
+    bot.bot.get_guild = guilds.get
+
+    # コマンドの解析は本物のdiscord.Messageが必要なので省略する（合成メッセージにコマンドは含まれない）
+    async def process_commands(message):
+        pass
+    bot.bot.process_commands = process_commands
+
+    print(f"メッセージ生成中: {args.messages:,}件 / {args.guilds}サーバー × {args.channels}チャンネル / {args.hours}時間",
+          file=sys.stderr)
+    messages = generate_messages(list(guilds.values()), args.messages, args.hours, args.burst_ratio, args.seed)
+
+    # 受信（on_messageに直接流し込む）
+    rss_before = psutil.Process().memory_info().rss / 1024 / 1024
+    started = time.perf_counter()
+    for message in messages:
+        await bot.on_message(message)
+    elapsed = time.perf_counter() - started
+    results['ingest_msgs_per_sec'] = len(messages) / elapsed
+    results['ingest_rss_delta_mb'] = psutil.Process().memory_info().rss / 1024 / 1024 - rss_before
+    del messages
+
+    # 大きい順に並べ、最大のサーバーと中央値のサーバーで計測
+    ranked = sorted(guilds, key=bot.get_buffered_message_count, reverse=True)
+    targets = {'largest': ranked[0], 'median': ranked[len(ranked) // 2]}
+
+    for label, guild_id in targets.items():
+        for hours in (6, 24, 168):
+            durations = timed(lambda: bot.get_messages_in_timerange(guild_id, hours), args.repeat)
+            results[f'timerange_{hours}h_{label}_p50_ms'] = percentile(durations, 0.5)
+            results[f'timerange_{hours}h_{label}_p95_ms'] = percentile(durations, 0.95)
+
+        window = bot.get_summary_window(24)
+        durations = timed(lambda: bot.create_stats_embed(guild_id, window, "ベンチマーク"), args.repeat)
+        results[f'stats_embed_24h_{label}_p95_ms'] = percentile(durations, 0.95)
+
+        messages_by_channel = bot.get_messages_in_timerange(guild_id, 24)
+        durations = timed(lambda: bot.generate_simple_summary(messages_by_channel), args.repeat)
+        results[f'simple_summary_24h_{label}_p95_ms'] = percentile(durations, 0.95)
+
+        query = rng.choice(["デプロイ", "障害対応", "kubernetes", "イベント 予約"])
+        durations = timed(lambda: bot.search_messages(guild_id, query, 168), args.repeat)
+        results[f'search_168h_{label}_p95_ms'] = percentile(durations, 0.95)
+
+    # 要約Embedの作成（キャッシュを無効にしてGeminiの代替クライアントまで含めて計測）
+    guild = guilds[targets['largest']]
+
+    async def build_embed():
+        bot.summary_cache.clear()
+        window = bot.get_summary_window(24)
+        await bot.create_server_summary_embed(
+            guild, bot.get_messages_in_window(guild.id, *window), window, "ベンチマーク")
+    durations = await timed_async(build_embed, max(args.repeat // 10, 3))
+    results['summary_embed_24h_largest_p50_ms'] = percentile(durations, 0.5)
+    results['summary_embed_24h_largest_p95_ms'] = percentile(durations, 0.95)
+
+    # 定期要約（全サーバー）のエンドツーエンドの所要時間
+    bot.summary_cache.clear()
+    bot.summary_checkpoints.clear()
+    calls_before = fake_models.calls
+    slot = dict(bot.SUMMARY_SCHEDULE[0], key="benchmark")
+    started = time.perf_counter()
+    await bot.post_scheduled_summary(slot, list(guilds), datetime.now(timezone.utc))
+    results['scheduled_run_seconds'] = time.perf_counter() - started
+    results['scheduled_run_posted'] = bot.last_scheduled_run.get('posted', 0)
+    results['scheduled_run_failed'] = bot.last_scheduled_run.get('failed', 0)
+    results['scheduled_run_gemini_calls'] = fake_models.calls - calls_before
+    results['gemini_errors'] = fake_models.errors
+
+    results['peak_rss_mb'] = peak_rss_mb()
+    return results
+
+
+# 値が大きいほど良い指標（それ以外は小さいほど良い）
+HIGHER_IS_BETTER = {'ingest_msgs_per_sec', 'scheduled_run_posted'}
+# 比較の対象外（設定や乱数で決まる件数）
+NOT_COMPARED = {'scheduled_run_failed', 'scheduled_run_gemini_calls', 'gemini_errors'}
+
+
+def compare(results, baseline, tolerance):
+    """基準の結果と比較し、tolerance（割合）を超えて悪化した指標の一覧を返す"""
+    regressions = []
+    for key, value in results.items():
+        base = baseline.get(key)
+        if key in NOT_COMPARED or not base:
+            continue
+        change = (base - value) / base if key in HIGHER_IS_BETTER else (value - base) / base
+        # 1ミリ秒未満の計測は揺らぎが大きいので、絶対値でも差がある場合だけ悪化とみなす
+        if key.endswith('_ms') and value - base < 1.0:
+            continue
+        if change > tolerance:
+            regressions.append((key, base, value, change))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Discord Summary Bot のベンチマーク")
+    parser.add_argument('--guilds', type=int, default=20, help="サーバー数")
+    parser.add_argument('--channels', type=int, default=15, help="サーバーあたりのチャンネル数")
+    parser.add_argument('--messages', type=int, default=200000, help="合成メッセージの総数")
+    parser.add_argument('--hours', type=int, default=168, help="メッセージを分布させる期間（時間）")
+    parser.add_argument('--burst-ratio', type=float, default=0.2, help="盛り上がった時間帯に集中させるメッセージの割合")
+    parser.add_argument('--latency', type=float, default=0.2, help="Gemini代替クライアントの基本の遅延（秒）")
+    parser.add_argument('--latency-per-1k-tokens', type=float, default=0.02, help="入力1,000トークンあたりの追加の遅延（秒）")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Gemini代替クライアントのエラー率（0〜1）")
+    parser.add_argument('--no-breaker', action='store_true', help="サーキットブレーカーを無効にする（エラー率の影響を見る場合）")
+    parser.add_argument('--repeat', type=int, default=50, help="各計測の繰り返し回数")
+    parser.add_argument('--seed', type=int, default=42, help="乱数のシード")
+    parser.add_argument('--verbose', action='store_true', help="Botのログを表示する")
+    parser.add_argument('--json', help="結果を保存するJSONファイル")
+    parser.add_argument('--compare', help="比較する基準の結果（JSONファイル）")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="悪化とみなす変化の割合")
+    args = parser.parse_args()
+
+    # Botのログは計測中の出力を埋めてしまうので、指定がなければ捨てる
+    with contextlib.redirect_stdout(sys.stdout if args.verbose else open(os.devnull, 'w')):
+        results = asyncio.run(run_benchmark(args))
+
+    print()
+    width = max(len(key) for key in results)
+    for key, value in results.items():
+        print(f"{key:<{width}}  {value:,.2f}" if isinstance(value, float) else f"{key:<{width}}  {value:,}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'args': vars(args), 'results': results}, f, indent=2, ensure_ascii=False)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        print()
+        if regressions:
+            print(f"⚠️ {len(regressions)}個の指標が{args.tolerance:.0%}以上悪化しました:")
+            for key, base, value, change in regressions:
+                print(f"  {key}: {base:,.2f} → {value:,.2f} ({change:+.0%})")
+            sys.exit(1)
+        print("✅ 基準からの悪化はありません")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,33 @@
 import discord
 from discord.ext import commands, tasks
-from datetime import datetime, timedelta, time, timezone
+from datetime import datetime, timedelta, timezone
 import asyncio
-from collections import defaultdict, deque
+from collections import defaultdict, deque, OrderedDict
+from bisect import bisect_left, bisect_right, insort
+from array import array
 from google import genai  # 新しいGoogle Gen AI SDK
 from google.genai import types  # types のインポート
+from google.genai import errors as genai_errors
 import os
 from dotenv import load_dotenv
 import psutil
 import platform
 import gc
+import sys
+import sqlite3
+import threading
+import re
+import unicodedata
+import heapq
+import itertools
+import json
+import zlib
+import time
+import contextvars
+import random
+import math
+import traceback
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
 # .envファイルから環境変数を読み込み
 load_dotenv()
@@ -18,9 +36,7 @@ load_dotenv()
 DISCORD_BOT_TOKEN = os.getenv('DISCORD_BOT_TOKEN')
 GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY')
 
-# 環境変数が設定されているか確認
-if not DISCORD_BOT_TOKEN:
-    raise ValueError("DISCORD_BOT_TOKENが設定されていません。.envファイルを確認してください。")
+# 環境変数が設定されているか確認（DISCORD_BOT_TOKENはBOT_ROLEの確認時、要約ワーカー以外で必須）
 if not GOOGLE_API_KEY:
     raise ValueError("GOOGLE_API_KEYが設定されていません。.envファイルを確認してください。")
 
@@ -32,67 +48,1309 @@ intents = discord.Intents.default()
 intents.message_content = True  # メッセージ内容を読むために必要
 intents.guilds = True
 
-bot = commands.Bot(command_prefix='!', intents=intents)
+# シャーディングと複数プロセスでの実行
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', 0))  # シャード数（0でDiscordの推奨数、WORKER_COUNTが2以上なら必須）
+WORKER_COUNT = int(os.getenv('WORKER_COUNT', 1))  # シャードを分担するプロセス数
+WORKER_INDEX = int(os.getenv('WORKER_INDEX', 0))  # このプロセスの番号（0〜WORKER_COUNT-1）
+AUTO_SHARD = os.getenv('AUTO_SHARD', 'false').lower() == 'true'  # 1プロセスでもAutoShardedBotで接続する
+
+# ゲートウェイ（メッセージの受信と投稿）と要約ワーカーを別プロセスに分ける
+# all: 1プロセスですべて処理 / gateway: 受信と投稿のみ / summarizer: キューの要約ジョブを処理（Discordには接続しない）
+BOT_ROLE = os.getenv('BOT_ROLE', 'all')
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', 3))  # 要約ジョブの最大試行回数
+JOB_RETRY_BASE = float(os.getenv('JOB_RETRY_BASE', 30))  # 再試行までの待機時間の基準（秒、試行ごとに倍増）
+JOB_POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', 1))  # キューを確認する間隔（秒）
+
+if BOT_ROLE not in ('all', 'gateway', 'summarizer'):
+    raise ValueError("BOT_ROLEには all、gateway、summarizer のいずれかを設定してください。")
+if not DISCORD_BOT_TOKEN and BOT_ROLE != 'summarizer':
+    raise ValueError("DISCORD_BOT_TOKENが設定されていません。.envファイルを確認してください。")
+if WORKER_COUNT > 1 and SHARD_COUNT < WORKER_COUNT:
+    raise ValueError("WORKER_COUNTが2以上の場合は、SHARD_COUNTにWORKER_COUNT以上の値を設定してください。")
+if not 0 <= WORKER_INDEX < WORKER_COUNT:
+    raise ValueError("WORKER_INDEXは0〜WORKER_COUNT-1の範囲で設定してください。")
+
+def get_worker_shard_ids():
+    """このプロセスが担当するシャード（全シャードをWORKER_COUNT個の連続した範囲に分割）"""
+    per_worker = -(-SHARD_COUNT // WORKER_COUNT)
+    return list(range(WORKER_INDEX * per_worker, min((WORKER_INDEX + 1) * per_worker, SHARD_COUNT)))
+
+WORKER_SHARD_IDS = get_worker_shard_ids() if WORKER_COUNT > 1 else None
+
+def is_local_guild(guild_id):
+    """このプロセスのシャードが担当するサーバーか（DiscordはサーバーIDからシャードを決める）"""
+    return WORKER_SHARD_IDS is None or (guild_id >> 22) % SHARD_COUNT in WORKER_SHARD_IDS
+
+def local_guild_sql():
+    """is_local_guild()と同じ条件のSQLの (条件, パラメータ)。担当を分けていなければ空"""
+    if WORKER_SHARD_IDS is None:
+        return "", []
+    return (f" AND (guild_id >> 22) % ? IN ({', '.join('?' * len(WORKER_SHARD_IDS))})",
+            [SHARD_COUNT, *WORKER_SHARD_IDS])
+
+class SummaryBot(commands.AutoShardedBot if AUTO_SHARD or SHARD_COUNT > 0 or WORKER_COUNT > 1 else commands.Bot):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.backfill_tasks = set()  # 実行中の履歴の取り込み（完了前にガベージコレクションされないよう参照を保持）
+    
+    async def setup_hook(self):
+        # 永続化されたメッセージをバックグラウンドで読み込み、書き込みタスクを開始
+        if message_store:
+            await quota_governor.load()
+            self.hydration_task = asyncio.create_task(hydrate_message_buffers())
+            flush_store_task.start()
+        
+        # リソース監視・メトリクスの公開を開始
+        self.metrics_server = await start_monitoring()
+        
+        # 要約ワーカーが完了したジョブを投稿
+        if BOT_ROLE == 'gateway':
+            self.job_poller_task = asyncio.create_task(job_result_poller())
+    
+    def start_backfill(self, guilds):
+        """停止中に取りこぼした履歴の取り込みをバックグラウンドで開始"""
+        task = asyncio.create_task(backfill_guilds(guilds))
+        self.backfill_tasks.add(task)
+        task.add_done_callback(self.backfill_done)
+    
+    def backfill_done(self, task):
+        """完了した取り込みの参照を外し、例外で終わった場合はログに残す"""
+        self.backfill_tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            print(f"履歴の取り込みエラー: {task.exception()!r}")
+    
+    async def close(self):
+        # 終了前に未書き込みのメッセージをディスクへ反映
+        if message_store:
+            await message_store.flush()
+            await save_bucket_rollups()
+            await quota_governor.save()
+        if getattr(self, 'metrics_server', None):
+            self.metrics_server.close()
+        await super().close()
+
+shard_options = {}
+if SHARD_COUNT > 0:
+    shard_options['shard_count'] = SHARD_COUNT
+if WORKER_SHARD_IDS is not None:
+    shard_options['shard_ids'] = WORKER_SHARD_IDS
+bot = SummaryBot(command_prefix='!', intents=intents, **shard_options)
 
 # 設定項目
-MAX_MESSAGES_PER_SUMMARY = int(os.getenv('MAX_MESSAGES_PER_SUMMARY', 100))  # 1回の要約に含める最大メッセージ数
+PROMPT_TOKEN_BUDGET = int(os.getenv('PROMPT_TOKEN_BUDGET', 30000))  # 1回のプロンプトに含める会話の推定トークン数の上限
+MESSAGE_TOKEN_LIMIT = int(os.getenv('MESSAGE_TOKEN_LIMIT', 400))  # 1メッセージの推定トークン数の上限（超えた分は省略）
 BOT_CHANNEL_NAME = os.getenv('BOT_CHANNEL_NAME', 'bot-summaries')  # Bot用チャンネルの名前
 
+# メッセージの永続化先（SQLiteファイル、空文字で無効化）
+MESSAGE_STORE_PATH = os.getenv('MESSAGE_STORE_PATH', 'messages.db')
+STORE_FLUSH_INTERVAL = float(os.getenv('STORE_FLUSH_INTERVAL', 2))  # ディスクへまとめて書き込む間隔（秒）
+STORE_PENDING_LIMIT = int(os.getenv('STORE_PENDING_LIMIT', 100000))  # 書き込みに失敗し続けた時に保持する未書き込みメッセージの上限
+
+# 起動時・サーバー参加時の履歴の取り込み
+BACKFILL_CONCURRENCY = int(os.getenv('BACKFILL_CONCURRENCY', 4))  # 同時に履歴を取得するチャンネル数
+BACKFILL_HOURS = int(os.getenv('BACKFILL_HOURS', 168))  # 取り込む履歴の期間（時間）
+
+# 長期間・大量メッセージの階層要約（チャンネル/時間ブロックごとに要約してから統合）
+HIERARCHICAL_THRESHOLD = int(os.getenv('HIERARCHICAL_THRESHOLD', 1000))  # このメッセージ数かトークン予算を超えたら階層要約
+MAP_CHUNK_MESSAGES = int(os.getenv('MAP_CHUNK_MESSAGES', 400))  # 1回の部分要約に含める最大メッセージ数
+
+# 要約チェックポイント（時間ブロックごとの部分要約を保存して再利用）
+CHECKPOINT_BLOCK_HOURS = int(os.getenv('CHECKPOINT_BLOCK_HOURS', 6))  # 1ブロックの長さ（時間）
+CHECKPOINT_SNAP_SECONDS = 300  # この秒数以内のずれはブロック境界に揃える
+
+# 要約結果のキャッシュ
+SUMMARY_CACHE_TTL = int(os.getenv('SUMMARY_CACHE_TTL', 600))  # キャッシュの有効期間（秒）
+SUMMARY_CACHE_SIZE = int(os.getenv('SUMMARY_CACHE_SIZE', 256))  # キャッシュする要約の最大件数
+
+# !search の1回の表示件数
+SEARCH_RESULT_LIMIT = int(os.getenv('SEARCH_RESULT_LIMIT', 10))
+
+# 簡易要約のキーワードの基準（1週間の出現頻度）を再計算する間隔（秒）
+TERM_BASELINE_TTL = int(os.getenv('TERM_BASELINE_TTL', 600))
+
+# リソース使用状況のサンプリング間隔（秒）
+SAMPLER_INTERVAL = int(os.getenv('SAMPLER_INTERVAL', 10))
+
+# メトリクス（Prometheusのテキスト形式で公開するポート、0で無効）と構造化ログ（JSON）の出力間隔（秒、0で無効）
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')  # メトリクスを公開するアドレス（外部に公開しない場合はローカルのみ）
+METRICS_LOG_INTERVAL = int(os.getenv('METRICS_LOG_INTERVAL', 60))
+
+# イベントループの停止の監視（ブロッキング処理の検出）
+LOOP_WATCHDOG_INTERVAL = float(os.getenv('LOOP_WATCHDOG_INTERVAL', 0.1))  # ループの応答を確認する間隔（秒、0で無効）
+LOOP_STALL_THRESHOLD = float(os.getenv('LOOP_STALL_THRESHOLD', 0.5))  # この秒数以上止まったらスタックを記録（0で無効）
+LOOP_STALL_HISTORY = int(os.getenv('LOOP_STALL_HISTORY', 50))  # !loop で表示するために保持する停止の件数
+
+# 停止中に予定時刻を過ぎた定期要約を、起動後に実行する猶予（秒）
+SCHEDULE_CATCHUP_SECONDS = int(os.getenv('SCHEDULE_CATCHUP_SECONDS', 1800))
+# 定期要約の実行権の有効期限（秒）。投稿を終えずにプロセスが停止した場合、期限後に他のプロセスや再起動後の取りこぼし分の実行で取り直す
+SCHEDULE_CLAIM_LEASE = int(os.getenv('SCHEDULE_CLAIM_LEASE', 1800))
+
 # 使用するモデル（環境変数で設定可能）
 MODEL_NAME = os.getenv('GEMINI_MODEL', 'gemini-2.5-pro')
 
-# 要約スケジュール（時刻と要約期間）
-# JST（日本時間）の6時、12時、18時に投稿されるようにUTCで設定
+# 要約の規模に応じたモデルの振り分け（空にするとMODEL_NAMEを使用）
+ROUTE_SMALL_MODEL = os.getenv('ROUTE_SMALL_MODEL', 'gemini-2.5-flash')  # 少量の要約に使うモデル
+ROUTE_MAP_MODEL = os.getenv('ROUTE_MAP_MODEL', 'gemini-2.5-flash')  # 階層要約の部分要約に使うモデル
+ROUTE_SMALL_MAX_OUTPUT_TOKENS = int(os.getenv('ROUTE_SMALL_MAX_OUTPUT_TOKENS', 1000))  # 少量の要約の最大出力トークン数
+ROUTE_MAP_MAX_OUTPUT_TOKENS = int(os.getenv('ROUTE_MAP_MAX_OUTPUT_TOKENS', 1000))  # 部分要約の最大出力トークン数
+ROUTE_SMALL_TOKENS = int(os.getenv('ROUTE_SMALL_TOKENS', 4000))  # プロンプトの推定トークン数がこれ以下なら少量
+ROUTE_SMALL_MESSAGES = int(os.getenv('ROUTE_SMALL_MESSAGES', 150))  # メッセージ数がこれ以下なら少量
+
+# Gemini API呼び出しの並列数とタイムアウト
+GEMINI_CONCURRENCY = int(os.getenv('GEMINI_CONCURRENCY', 4))  # 同時に実行するAPI呼び出しの上限
+GEMINI_TIMEOUT = float(os.getenv('GEMINI_TIMEOUT', 120))  # 1回のAPI呼び出しのタイムアウト（秒）
+
+# Gemini APIの利用枠（0で無制限）。超えそうな呼び出しは空きができるまで待機させる
+GEMINI_RPM = int(os.getenv('GEMINI_RPM', 60))  # 1分あたりのリクエスト数
+GEMINI_RPD = int(os.getenv('GEMINI_RPD', 1500))  # 1日あたりのリクエスト数
+GEMINI_TPM = int(os.getenv('GEMINI_TPM', 1000000))  # 1分あたりの入力トークン数
+GEMINI_TPD = int(os.getenv('GEMINI_TPD', 0))  # 1日あたりの入力トークン数
+GEMINI_QUOTA_TIMEZONE = os.getenv('GEMINI_QUOTA_TIMEZONE', 'America/Los_Angeles')  # 1日の利用枠がリセットされる0時のタイムゾーン
+GEMINI_QUEUE_TIMEOUT = float(os.getenv('GEMINI_QUEUE_TIMEOUT', 600))  # 利用枠の空きを待つ最長時間（秒）
+
+# !summary の要約を生成しながら途中経過をEmbedに反映する（Discordの編集レート制限を考慮して間隔を空ける）
+SUMMARY_STREAMING = os.getenv('SUMMARY_STREAMING', 'true').lower() == 'true'
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', 1.5))  # Embedを編集する最短間隔（秒）
+
+# Gemini APIの障害対策
+GEMINI_RETRIES = int(os.getenv('GEMINI_RETRIES', 2))  # 一時的なエラー（タイムアウト、429、5xx）の再試行回数
+GEMINI_RETRY_BASE = float(os.getenv('GEMINI_RETRY_BASE', 2))  # 再試行の待機時間の基準（秒、試行ごとに倍増）
+SUMMARY_DEADLINE = float(os.getenv('SUMMARY_DEADLINE', 600))  # 1つの要約にかける最長時間（秒、部分要約と再試行を含む）
+BREAKER_THRESHOLD = int(os.getenv('BREAKER_THRESHOLD', 5))  # この回数連続で失敗したらそのモデルの呼び出しを停止
+BREAKER_COOLDOWN = float(os.getenv('BREAKER_COOLDOWN', 120))  # 停止してから試行を再開するまでの秒数
+FALLBACK_MODEL = os.getenv('FALLBACK_MODEL', 'gemini-2.5-flash')  # メインのモデルが使えない時のモデル（空で簡易要約のみ）
+
+# 定期要約のサーバー並列処理
+SUMMARY_WORKERS = int(os.getenv('SUMMARY_WORKERS', 8))  # 同時に要約を処理するサーバー数
+SUMMARY_TARGET_WINDOW = int(os.getenv('SUMMARY_TARGET_WINDOW', 900))  # 全サーバーの定期要約を完了させる目標時間（秒）
+# 優先して要約するサーバーのID（カンマ区切り）
+PRIORITY_GUILD_IDS = {int(g) for g in os.getenv('PRIORITY_GUILD_IDS', '').split(',') if g.strip()}
+
+# 要約スケジュール（各サーバーのタイムゾーンでの時刻と要約期間）
+# デフォルトは6時、12時、18時（!set_schedule でサーバーごとに変更可能）
 SUMMARY_SCHEDULE = [
-    # JST 6:00 (UTC 21:00 of previous day)
-    {"hour": 21, "minute": 0, "hours_back": 24, "description": "前日の要約", "color": discord.Color.purple()},
-    # JST 12:00 (UTC 3:00)
-    {"hour": 3, "minute": 0, "hours_back": 6, "description": "午前の要約", "color": discord.Color.blue()},
-    # JST 18:00 (UTC 9:00)
-    {"hour": 9, "minute": 0, "hours_back": 6, "description": "午後の要約", "color": discord.Color.orange()},
+    {"hour": 6, "minute": 0, "hours_back": 24, "description": "前日の要約", "color": discord.Color.purple()},
+    {"hour": 12, "minute": 0, "hours_back": 6, "description": "午前の要約", "color": discord.Color.blue()},
+    {"hour": 18, "minute": 0, "hours_back": 6, "description": "午後の要約", "color": discord.Color.orange()},
 ]
 
 # 週次サマリーのスケジュール（月曜日の朝6時）
 WEEKLY_SUMMARY_SCHEDULE = {
-    "weekday": 0,  # 月曜日（UTCでは日曜日の21時）
-    "hour": 21,    # UTC 21:00 = JST 6:00
+    "weekday": 0,  # 月曜日
+    "hour": 6,
     "minute": 0,
     "hours_back": 168,  # 1週間 = 168時間
     "description": "今週の要約",
     "color": discord.Color.green()
 }
 
+# サーバーごとのタイムゾーンのデフォルト（!set_timezone で変更可能）
+DEFAULT_TIMEZONE = os.getenv('SUMMARY_TIMEZONE', 'Asia/Tokyo')
+# 定期要約の開始をサーバーごとにずらす幅（分）。サーバーIDから決まる固定のオフセットで負荷を分散
+SCHEDULE_SPREAD_MINUTES = int(os.getenv('SCHEDULE_SPREAD_MINUTES', 10))
+
 # サーバーごとの設定を保存
 server_configs = {}
-# メッセージを保存する辞書（サーバーID -> チャンネルID -> メッセージリスト）
-# 1週間分のメッセージを保持するためにタイムスタンプ付きで管理
-message_buffers = defaultdict(lambda: defaultdict(lambda: deque()))
+# メッセージを保存する辞書（サーバーID -> チャンネルID -> ChannelBuffer）
+# 1週間分のメッセージを1時間単位のバケットに分けて時刻順に管理
+message_buffers = defaultdict(lambda: defaultdict(ChannelBuffer))
+
+# Gemini API呼び出しの同時実行数を制限するセマフォ
+gemini_semaphore = asyncio.Semaphore(GEMINI_CONCURRENCY)
+
+# 直近の定期要約の実行結果（!statusで表示）
+last_scheduled_run = {}
+# 定期要約を同時に処理するサーバー数の制限
+summary_worker_semaphore = asyncio.Semaphore(SUMMARY_WORKERS)
+
+# 簡易要約のキーワードの基準（サーバーID -> (有効期限, キーワード -> 出現バケット数, 総バケット数)）
+term_baselines = {}
+
+# 要約チェックポイント（サーバーID -> ブロック開始時刻 -> (フィンガープリント, 部分要約)）
+summary_checkpoints = defaultdict(dict)
+
+# 要約結果のキャッシュ（キー -> (有効期限, 要約)）と生成中の要約（キー -> [Task, 待っている呼び出し元の数]）
+summary_cache = OrderedDict()
+inflight_summaries = {}
+summary_cache_stats = {'hits': 0, 'joined': 0, 'misses': 0}
+
+# プロンプトサイズの統計（!api_usageで表示）
+prompt_size_stats = {'calls': 0, 'total_tokens': 0, 'max_tokens': 0}
+
+# モデルの振り分け先（名前 -> モデルと最大出力トークン数）
+MODEL_ROUTES = {
+    'small': {'model': ROUTE_SMALL_MODEL or MODEL_NAME, 'max_output_tokens': ROUTE_SMALL_MAX_OUTPUT_TOKENS, 'description': '少量の要約'},
+    'map': {'model': ROUTE_MAP_MODEL or MODEL_NAME, 'max_output_tokens': ROUTE_MAP_MAX_OUTPUT_TOKENS, 'description': '部分要約'},
+    'standard': {'model': MODEL_NAME, 'max_output_tokens': 1500, 'description': '通常の要約・統合'},
+    'weekly': {'model': MODEL_NAME, 'max_output_tokens': 2000, 'description': '週次の要約・統合'},
+}
+# 振り分け先と実際に生成したモデルごとの呼び出し統計（(振り分け先, モデル) -> 統計、!api_usageで表示）
+route_stats = defaultdict(lambda: {'calls': 0, 'errors': 0, 'input_tokens': 0, 'output_tokens': 0,
+                                   'latencies': deque(maxlen=200)})
+
+# リソース使用状況のサンプル（直近1時間分のリングバッファ、!systemで表示）
+resource_samples = deque(maxlen=max(3600 // SAMPLER_INTERVAL, 1))
+
+# 履歴の取り込み状況（!statusで表示）
+backfill_semaphore = asyncio.Semaphore(BACKFILL_CONCURRENCY)
+backfill_progress = {'running': 0, 'channels_total': 0, 'channels_done': 0, 'messages': 0}
+
+class MetricsRegistry:
+    """カウンター・ゲージ・ヒストグラムの集計（/metricsと構造化ログで出力）
+    
+    系列はメトリクス名とラベルの組で区別する。ヒストグラムは固定のバケット境界ごとの件数を持ち、
+    記録はbisectで1回の加算なので、メッセージの取り込みのような頻繁な処理でも計測できる。
+    ゲージにcallbackを指定すると出力時に値を計算する。
+    """
+    
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.metrics = {}  # 名前 -> {'type', 'help', 'buckets', 'callback', 'series': ラベル -> 値}
+    
+    def register(self, kind, name, help_text, buckets=None, callback=None):
+        self.metrics[name] = {'type': kind, 'help': help_text, 'buckets': buckets, 'callback': callback, 'series': {}}
+    
+    def inc(self, name, value=1, **labels):
+        series = self.metrics[name]['series']
+        key = tuple(sorted(labels.items()))
+        series[key] = series.get(key, 0) + value
+    
+    def set(self, name, value, **labels):
+        self.metrics[name]['series'][tuple(sorted(labels.items()))] = value
+    
+    def observe(self, name, value, **labels):
+        metric = self.metrics[name]
+        key = tuple(sorted(labels.items()))
+        state = metric['series'].get(key)
+        if state is None:
+            # バケットごとの件数（最後は+Inf）、合計、件数
+            state = metric['series'][key] = [[0] * (len(metric['buckets']) + 1), 0.0, 0]
+        state[0][bisect_left(metric['buckets'], value)] += 1
+        state[1] += value
+        state[2] += 1
+    
+    def collect(self, name):
+        """系列の (ラベル, 値) の一覧（callbackのゲージはここで計算）"""
+        metric = self.metrics[name]
+        if metric['callback']:
+            try:
+                return [((), metric['callback']())]
+            except Exception as e:
+                print(f"メトリクスの取得エラー ({name}): {e}")
+                return []
+        return list(metric['series'].items())
+    
+    @staticmethod
+    def format_labels(labels):
+        if not labels:
+            return ""
+        escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return "{" + ",".join(f'{key}="{escape(value)}"' for key, value in labels) + "}"
+    
+    def render(self):
+        """Prometheusのテキスト形式（version 0.0.4）"""
+        lines = []
+        for name, metric in self.metrics.items():
+            full_name = self.prefix + name
+            lines.append(f"# HELP {full_name} {metric['help']}")
+            lines.append(f"# TYPE {full_name} {metric['type']}")
+            for labels, value in self.collect(name):
+                if metric['type'] != 'histogram':
+                    lines.append(f"{full_name}{self.format_labels(labels)} {value}")
+                    continue
+                counts, total, count = value
+                cumulative = 0
+                for bound, bucket_count in zip(list(metric['buckets']) + ['+Inf'], counts):
+                    cumulative += bucket_count
+                    lines.append(f"{full_name}_bucket{self.format_labels(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{full_name}_sum{self.format_labels(labels)} {total}")
+                lines.append(f"{full_name}_count{self.format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+    
+    def quantile(self, name, value, q):
+        """ヒストグラムの分位数の推定値（該当するバケットの上限、+Infなら最大の境界）"""
+        buckets = self.metrics[name]['buckets']
+        counts, _, count = value
+        target = q * count
+        cumulative = 0
+        for index, bucket_count in enumerate(counts):
+            cumulative += bucket_count
+            if cumulative >= target:
+                return buckets[min(index, len(buckets) - 1)]
+        return buckets[-1]
+    
+    def snapshot(self):
+        """構造化ログ用の {系列名: 値}（ヒストグラムは件数・合計・p50・p95）"""
+        result = {}
+        for name, metric in self.metrics.items():
+            for labels, value in self.collect(name):
+                key = name + self.format_labels(labels)
+                if metric['type'] == 'histogram':
+                    if value[2]:
+                        result[key] = {'count': value[2], 'sum': round(value[1], 3),
+                                       'p50': self.quantile(name, value, 0.5), 'p95': self.quantile(name, value, 0.95)}
+                else:
+                    result[key] = round(value, 3) if isinstance(value, float) else value
+        return result
+
+# 秒単位の処理時間のバケット境界
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+metrics = MetricsRegistry('summarybot_')
+metrics.register('counter', 'messages_ingested_total', '取り込んだメッセージ数')
+metrics.register('counter', 'store_dropped_messages_total', '書き込みの失敗が続いて破棄したMessageStoreへの書き込み数')
+metrics.register('gauge', 'buffered_messages', 'バッファ内のメッセージ数',
+                 callback=lambda: sum(get_buffered_message_count(guild_id) for guild_id in list(message_buffers.keys())))
+metrics.register('gauge', 'event_loop_lag_seconds', '直近のサンプリングでのイベントループの遅延',
+                 callback=lambda: resource_samples[-1]['loop_lag'] if resource_samples else 0.0)
+metrics.register('histogram', 'prompt_build_seconds', '会話をプロンプトに整形する時間', buckets=LATENCY_BUCKETS)
+metrics.register('histogram', 'prompt_tokens', 'プロンプトの推定トークン数',
+                 buckets=(500, 1000, 2000, 4000, 8000, 16000, 32000, 64000, 128000))
+metrics.register('histogram', 'gemini_request_seconds', 'Gemini APIの1回の呼び出しの応答時間', buckets=LATENCY_BUCKETS)
+metrics.register('counter', 'gemini_tokens_total', 'Gemini APIの入出力トークン数')
+metrics.register('counter', 'fallback_total', 'フォールバックの回数（model: 代替モデル、simple: 簡易要約）')
+metrics.register('histogram', 'discord_send_seconds', 'Discordへの送信・編集の応答時間', buckets=LATENCY_BUCKETS)
+metrics.register('histogram', 'scheduler_lag_seconds', '定期要約の予定時刻からの遅れ（dispatch: 実行開始、start: サーバーの要約開始）',
+                 buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800))
+metrics.register('histogram', 'scheduled_run_seconds', '予定時刻から定期要約の全サーバーの完了までの時間',
+                 buckets=(10, 30, 60, 120, 300, 600, 900, 1800, 3600))
+metrics.register('counter', 'scheduled_summaries_total', '定期要約の結果（posted/skipped/failed）ごとのサーバー数')
+metrics.register('gauge', 'job_queue_depth', '要約ジョブのキューの状態ごとの件数（BOT_ROLE=gateway）')
+metrics.register('histogram', 'job_seconds', '要約ジョブの登録から投稿までの時間（キューの待ち時間を含む）',
+                 buckets=(1, 5, 10, 30, 60, 120, 300, 600, 900, 1800, 3600))
+metrics.register('histogram', 'loop_stall_seconds', 'イベントループが停止した時間（LOOP_STALL_THRESHOLD以上）',
+                 buckets=(0.5, 1, 2, 5, 10, 30, 60))
 
-# API使用量追跡用
-daily_api_calls = 0
-last_reset_date = datetime.now().date()
+def log_event(event, **fields):
+    """構造化ログ（1行のJSON）を出力"""
+    print(json.dumps({'time': datetime.now(timezone.utc).isoformat(), 'event': event, **fields},
+                     ensure_ascii=False, default=str))
 
 class MessageData:
+    """バッファ内のメッセージ
+    
+    __slots__でインスタンス辞書をなくし、表示名とチャンネル名はインターンして共有する。
+    タイムスタンプとジャンプURLはメッセージIDなどの整数から必要な時に復元する。
+    """
+    __slots__ = ('author', 'content', 'guild_id', 'channel_id', 'message_id', 'channel_name', 'attachments', 'embeds')
+    
     def __init__(self, message):
-        self.author = message.author.display_name  # Display Nameを使用
+        self.author = sys.intern(message.author.display_name)  # Display Nameを使用
         self.content = message.content
-        self.timestamp = message.created_at
-        self.jump_url = message.jump_url
-        self.channel_name = message.channel.name
+        self.guild_id = message.guild.id
         self.channel_id = message.channel.id
+        self.message_id = message.id
+        self.channel_name = sys.intern(message.channel.name)
         self.attachments = len(message.attachments)
         self.embeds = len(message.embeds)
+    
+    @classmethod
+    def from_row(cls, row):
+        """MessageStoreの行から復元"""
+        msg = cls.__new__(cls)
+        (msg.message_id, msg.guild_id, msg.channel_id, channel_name, author,
+         msg.content, msg.attachments, msg.embeds) = row
+        msg.channel_name = sys.intern(channel_name)
+        msg.author = sys.intern(author)
+        return msg
+    
+    def to_row(self):
+        return (self.message_id, self.guild_id, self.channel_id, self.channel_name, self.author,
+                self.content, self.attachments, self.embeds)
+    
+    @property
+    def ts(self):
+        """投稿時刻（エポック秒）。DiscordのID（snowflake）から算出"""
+        return ((self.message_id >> 22) + discord.utils.DISCORD_EPOCH) / 1000
+    
+    @property
+    def timestamp(self):
+        return discord.utils.snowflake_time(self.message_id)
+    
+    @property
+    def jump_url(self):
+        return f"https://discord.com/channels/{self.guild_id}/{self.channel_id}/{self.message_id}"
+
+# 簡易要約のキーワード抽出（Unicode正規化・小文字化した後に適用）
+TERM_NOISE_PATTERN = re.compile(r"https?://\S+|<a?:\w+:\d+>|<[@#][!&]?\d+>|:\w+:")
+TERM_PATTERN = re.compile(
+    r"[a-z][a-z0-9_+#.\-]*[a-z0-9+#]"  # 英単語・識別子
+    r"|[\u30a1-\u30fa\u30fc]{2,}"  # カタカナ語
+    r"|[\u4e00-\u9fff\u3005\u30f6]{2,}"  # 漢字の連続
+    r"|[\uac00-\ud7af]{2,}"  # ハングル
+)
+TERM_STOPWORDS = frozenset(
+    "the and for you that this with have are was but not just what can will from your they there "
+    "about all out get like one our has had its would been were when which them then than also "
+    "www com https http".split()
+)
+
+def normalize_text(text):
+    """キーワード抽出・検索用に本文を正規化（全角英数・半角カナの統一と小文字化）"""
+    return unicodedata.normalize('NFKC', text).lower()
+
+def extract_terms(text):
+    """メッセージからキーワードの集合を抽出（分かち書きのない日本語にも対応）
+    
+    英単語・カタカナ語・ハングルはまとまりのまま、漢字は2〜4文字ならそのまま、
+    それより長い連続は2文字ずつ（bi-gram）に分ける。ひらがなは助詞や語尾が多いので使わない。
+    """
+    text = TERM_NOISE_PATTERN.sub(" ", normalize_text(text))
+    terms = set()
+    for match in TERM_PATTERN.finditer(text):
+        term = match.group()
+        first = term[0]
+        if '\u4e00' <= first <= '\u9fff' or first in '\u3005\u30f6':
+            if len(term) <= 4:
+                terms.add(term)
+            else:
+                terms.update(term[i:i + 2] for i in range(len(term) - 1))
+        elif first.isascii():
+            if len(term) >= 3 and term not in TERM_STOPWORDS:
+                terms.add(term)
+        else:
+            terms.add(term)
+    return terms
+
+def extract_query_terms(text):
+    """検索語からキーワードを抽出（漢字の連続は長さによらず2文字ずつに分け、語の途中からでも一致させる）"""
+    terms = set()
+    for term in extract_terms(text):
+        first = term[0]
+        if len(term) > 2 and ('\u4e00' <= first <= '\u9fff' or first in '\u3005\u30f6'):
+            terms.update(term[i:i + 2] for i in range(len(term) - 1))
+        else:
+            terms.add(term)
+    return terms
+
+class HourBucket:
+    """1時間分のメッセージ（タイムスタンプ昇順）と、投稿者ごとの件数・キーワードの転置インデックス"""
+    __slots__ = ('hour', 'timestamps', 'messages', 'authors', 'postings')
+    
+    def __init__(self, hour):
+        self.hour = hour  # エポックからの経過時間（時間単位）
+        self.timestamps = array('d')  # エポック秒
+        self.messages = []
+        # 集計はバケットごと削除されるので、古いメッセージの分も一緒に消える
+        self.authors = defaultdict(int)  # 表示名 -> 件数
+        self.postings = {}  # キーワード -> 含むメッセージのリスト（件数は簡易要約、リストは検索に使う）
+
+def dump_bucket_rollup(bucket):
+    """バケットの集計（投稿者ごとの件数とキーワードの転置インデックス）をMessageStore用に直列化
+    
+    転置インデックスはメッセージID順での位置で保存する。戻り値は (メッセージ数, 最後のメッセージID, 投稿者, 転置インデックス)。
+    """
+    ordered = sorted(bucket.messages, key=lambda msg: msg.message_id)
+    position = {id(msg): i for i, msg in enumerate(ordered)}
+    postings = {term: [position[id(msg)] for msg in msgs] for term, msgs in bucket.postings.items()}
+    return len(ordered), ordered[-1].message_id, json.dumps(bucket.authors, ensure_ascii=False), json.dumps(postings, ensure_ascii=False)
+
+def load_bucket_rollup(hour, messages, authors, postings):
+    """MessageStoreの行（メッセージID順）と保存済みの集計からバケットを組み立てる（キーワードの抽出はしない）"""
+    bucket = HourBucket(hour)
+    bucket.messages = messages
+    bucket.timestamps = array('d', (msg.ts for msg in messages))
+    bucket.authors = defaultdict(int, json.loads(authors))
+    bucket.postings = {term: [messages[i] for i in positions] for term, positions in json.loads(postings).items()}
+    return bucket
+
+class ChannelBuffer:
+    """チャンネルごとの時刻インデックス付きメッセージストア
+    
+    メッセージを1時間単位のバケットに分けて保持し、期間指定の取得はバケットと
+    タイムスタンプ配列の二分探索で行う。古いメッセージはバケット単位で削除する。
+    """
+    
+    def __init__(self):
+        self.buckets = []
+        self.count = 0
+        self.documents = defaultdict(int)  # キーワード -> 含むバケット数（簡易要約のIDF用）
+        self.vocabulary = []  # documentsのキーワードの昇順のリスト（検索語の展開用、Noneなら次の検索で作り直す）
+    
+    def __len__(self):
+        return self.count
+    
+    def __iter__(self):
+        for bucket in self.buckets:
+            yield from bucket.messages
+    
+    def append(self, msg):
+        """メッセージを時刻順の位置に追加"""
+        ts = msg.ts
+        hour = int(ts // 3600)
+        
+        # 通常は最新のバケットの末尾に追加するだけで済む
+        if self.buckets and self.buckets[-1].hour == hour and ts >= self.buckets[-1].timestamps[-1]:
+            bucket = self.buckets[-1]
+            bucket.timestamps.append(ts)
+            bucket.messages.append(msg)
+        else:
+            # 到着順が前後した場合は該当するバケットに挿入
+            i = bisect_left(self.buckets, hour, key=lambda b: b.hour)
+            if i == len(self.buckets) or self.buckets[i].hour != hour:
+                self.buckets.insert(i, HourBucket(hour))
+            bucket = self.buckets[i]
+            j = bisect_right(bucket.timestamps, ts)
+            bucket.timestamps.insert(j, ts)
+            bucket.messages.insert(j, msg)
+        
+        bucket.authors[msg.author] += 1
+        for term in extract_terms(msg.content):
+            postings = bucket.postings.get(term)
+            if postings is None:
+                bucket.postings[term] = [msg]
+                self.add_term(term)
+            else:
+                postings.append(msg)
+        self.count += 1
+    
+    def add_term(self, term):
+        """バケットに新しく出現したキーワードを数え、このチャンネルで初出なら語彙に加える"""
+        if not self.documents[term] and self.vocabulary is not None:
+            insort(self.vocabulary, term)
+        self.documents[term] += 1
+    
+    def expand_term(self, query_term):
+        """検索語のキーワードを含むこのチャンネルのキーワード（英単語は前方一致、それ以外は部分一致）
+        
+        語彙は昇順なので、英単語は二分探索で前方一致の範囲だけを、それ以外はASCII以外の
+        キーワード（昇順で英単語より後ろ）だけを調べる。
+        """
+        if self.vocabulary is None:
+            self.vocabulary = sorted(self.documents)
+        vocabulary = self.vocabulary
+        if query_term[0].isascii():
+            matches = []
+            for term in vocabulary[bisect_left(vocabulary, query_term):]:
+                if not term.startswith(query_term):
+                    break
+                matches.append(term)
+            return matches
+        return [term for term in vocabulary[bisect_left(vocabulary, '\x80'):] if query_term in term]
+    
+    def contains(self, msg):
+        """同じメッセージIDのメッセージが既にあるか"""
+        ts = msg.ts
+        i = bisect_left(self.buckets, int(ts // 3600), key=lambda b: b.hour)
+        if i == len(self.buckets) or self.buckets[i].hour != int(ts // 3600):
+            return False
+        bucket = self.buckets[i]
+        j = bisect_left(bucket.timestamps, ts)
+        while j < len(bucket.timestamps) and bucket.timestamps[j] == ts:
+            if bucket.messages[j].message_id == msg.message_id:
+                return True
+            j += 1
+        return False
+    
+    def last_message_id_before(self, ts):
+        """ts より前の最新メッセージのID（なければNone）"""
+        i = bisect_right(self.buckets, int(ts // 3600), key=lambda b: b.hour)
+        for bucket in reversed(self.buckets[:i]):
+            j = bisect_left(bucket.timestamps, ts)
+            if j > 0:
+                return bucket.messages[j - 1].message_id
+        return None
+    
+    def range(self, start_ts, end_ts=None):
+        """start_ts より後（end_ts 指定時はそれ以前）のメッセージを時刻順に返す"""
+        result = []
+        i = bisect_left(self.buckets, int(start_ts // 3600), key=lambda b: b.hour)
+        for bucket in self.buckets[i:]:
+            if end_ts is not None and bucket.hour * 3600 > end_ts:
+                break
+            lo = bisect_right(bucket.timestamps, start_ts) if bucket.hour * 3600 <= start_ts else 0
+            hi = bisect_right(bucket.timestamps, end_ts) if end_ts is not None else len(bucket.messages)
+            result.extend(bucket.messages[lo:hi])
+        return result
+    
+    def stats(self, start_ts, end_ts=None):
+        """range() と同じ期間の (メッセージ数, 投稿者の集合)
+        
+        期間に完全に含まれるバケットは集計済みの件数と投稿者を使い、期間の両端にかかる
+        バケットだけメッセージを数えるので、メッセージ数ではなく時間数に比例する。
+        """
+        count = 0
+        authors = set()
+        i = bisect_left(self.buckets, int(start_ts // 3600), key=lambda b: b.hour)
+        for bucket in self.buckets[i:]:
+            bucket_start = bucket.hour * 3600
+            if end_ts is not None and bucket_start > end_ts:
+                break
+            if bucket_start > start_ts and (end_ts is None or bucket_start + 3600 <= end_ts):
+                count += len(bucket.messages)
+                authors.update(bucket.authors)
+                continue
+            lo = bisect_right(bucket.timestamps, start_ts) if bucket_start <= start_ts else 0
+            hi = bisect_right(bucket.timestamps, end_ts) if end_ts is not None else len(bucket.messages)
+            count += max(hi - lo, 0)
+            authors.update(msg.author for msg in bucket.messages[lo:hi])
+        return count, authors
+    
+    def term_counts(self, start_ts, end_ts=None):
+        """range() と同じ期間のキーワードごとのメッセージ数（stats()と同様に両端のバケットだけ走査）"""
+        counts = defaultdict(int)
+        i = bisect_left(self.buckets, int(start_ts // 3600), key=lambda b: b.hour)
+        for bucket in self.buckets[i:]:
+            bucket_start = bucket.hour * 3600
+            if end_ts is not None and bucket_start > end_ts:
+                break
+            if bucket_start > start_ts and (end_ts is None or bucket_start + 3600 <= end_ts):
+                for term, postings in bucket.postings.items():
+                    counts[term] += len(postings)
+                continue
+            lo = bisect_right(bucket.timestamps, start_ts) if bucket_start <= start_ts else 0
+            hi = bisect_right(bucket.timestamps, end_ts) if end_ts is not None else len(bucket.messages)
+            for msg in bucket.messages[lo:hi]:
+                for term in extract_terms(msg.content):
+                    counts[term] += 1
+        return counts
+    
+    def search(self, terms, phrases, start_ts, limit):
+        """start_ts より後のメッセージから検索し、新しい順に最大limit件返す
+        
+        termsの各キーワードについて、それを含む（英単語は前方一致する）このチャンネルのキーワードを
+        集め（「会議」→「定例会議」、「deploy」→「deployment」）、それぞれの転置インデックスの和集合の
+        積集合で絞り込んでから、本文（正規化・小文字化）がphrasesをすべて含むものだけを返す。
+        termsが空の場合（ひらがなだけの検索語など）は、全件の走査でイベントループを止めないよう何も返さない。
+        """
+        if not terms:
+            return []
+        groups = []
+        for query_term in terms:
+            group = self.expand_term(query_term)
+            if not group:
+                return []
+            groups.append(group)
+        
+        results = []
+        i = bisect_left(self.buckets, int(start_ts // 3600), key=lambda b: b.hour)
+        for bucket in reversed(self.buckets[i:]):
+            postings = []
+            for group in groups:
+                lists = [bucket.postings[term] for term in group if term in bucket.postings]
+                if not lists:
+                    break
+                postings.append(lists)
+            else:
+                postings.sort(key=lambda lists: sum(map(len, lists)))
+                candidates = list({id(msg): msg for msgs in postings[0] for msg in msgs}.values())
+                for other in postings[1:]:
+                    ids = {id(msg) for msgs in other for msg in msgs}
+                    candidates = [msg for msg in candidates if id(msg) in ids]
+            if len(postings) < len(groups):
+                continue
+            
+            matched = [
+                msg for msg in candidates
+                if msg.ts > start_ts and all(phrase in normalize_text(msg.content) for phrase in phrases)
+            ]
+            matched.sort(key=lambda msg: msg.ts, reverse=True)
+            results.extend(matched[:limit - len(results)])
+            if len(results) >= limit:
+                break
+        return results
+    
+    def bucket_at(self, hour):
+        """指定した時間のバケット（なければNone）"""
+        i = bisect_left(self.buckets, hour, key=lambda b: b.hour)
+        return self.buckets[i] if i < len(self.buckets) and self.buckets[i].hour == hour else None
+    
+    def add_bucket(self, bucket):
+        """集計済みのバケットを末尾に追加（MessageStoreからの復元用、既存のバケットより新しいこと）"""
+        self.buckets.append(bucket)
+        self.count += len(bucket.messages)
+        # 復元ではキーワードの追加が多いので、並べ直しは最初の検索までまとめて遅らせる
+        self.vocabulary = None
+        for term in bucket.postings:
+            self.documents[term] += 1
+    
+    def channel_name(self):
+        """最新のメッセージのチャンネル名"""
+        return self.buckets[-1].messages[-1].channel_name if self.buckets else None
+    
+    def evict_before(self, cutoff_ts):
+        """cutoff_ts より前に終わるバケットを丸ごと削除し、削除したメッセージ数を返す"""
+        n = 0
+        while n < len(self.buckets) and (self.buckets[n].hour + 1) * 3600 <= cutoff_ts:
+            n += 1
+        evicted = sum(len(bucket.messages) for bucket in self.buckets[:n])
+        for bucket in self.buckets[:n]:
+            for term in bucket.postings:
+                self.documents[term] -= 1
+                if not self.documents[term]:
+                    del self.documents[term]
+                    if self.vocabulary is not None:
+                        del self.vocabulary[bisect_left(self.vocabulary, term)]
+        del self.buckets[:n]
+        self.count -= evicted
+        return evicted
+
+def ts_to_snowflake(ts):
+    """エポック秒をその時刻のDiscord ID（snowflake）の下限に変換"""
+    return max(int(ts * 1000) - discord.utils.DISCORD_EPOCH, 0) << 22
+
+class MessageStore:
+    """SQLite（WALモード）によるメッセージの永続化
+    
+    on_messageでは書き込み待ちリストに積むだけで、ディスクへの書き込みは
+    flush()でまとめてワーカースレッド上で行う。メッセージIDは時刻順のsnowflakeなので、
+    期間指定の読み込みと保持期間のクリーンアップはIDの範囲で行う。
+    WORKER_COUNTが2以上の場合は全プロセスで同じファイルを共有し、サーバーの設定、
+    利用枠、定期要約の実行記録もここで共有する（ロック待ちはtimeout秒まで）。
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self.pending = []
+        self.touched = set()  # 集計の保存が必要なバケット（サーバーID, チャンネルID, 時間）
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS messages (
+                message_id INTEGER PRIMARY KEY,
+                guild_id INTEGER NOT NULL,
+                channel_id INTEGER NOT NULL,
+                channel_name TEXT NOT NULL,
+                author TEXT NOT NULL,
+                content TEXT NOT NULL,
+                attachments INTEGER NOT NULL,
+                embeds INTEGER NOT NULL
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_guild ON messages (guild_id, message_id)")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS checkpoints (
+                guild_id INTEGER NOT NULL,
+                block_start INTEGER NOT NULL,
+                message_count INTEGER NOT NULL,
+                last_message_id INTEGER NOT NULL,
+                summary TEXT NOT NULL,
+                PRIMARY KEY (guild_id, block_start)
+            )
+        """)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS guild_settings (
+                guild_id INTEGER PRIMARY KEY,
+                timezone TEXT,
+                schedule_hours TEXT
+            )
+        """)
+        # 以前のバージョンで作成したファイルに要約のON/OFFと投稿先の列を追加
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(guild_settings)")}
+        for column in ('enabled', 'summary_channel_id'):
+            if column not in columns:
+                self.conn.execute(f"ALTER TABLE guild_settings ADD COLUMN {column} INTEGER")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS quota_state (
+                name TEXT PRIMARY KEY,
+                level REAL NOT NULL,
+                updated REAL NOT NULL
+            )
+        """)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS api_usage (
+                date TEXT PRIMARY KEY,
+                requests INTEGER NOT NULL,
+                input_tokens INTEGER NOT NULL,
+                output_tokens INTEGER NOT NULL
+            )
+        """)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS schedule_runs (
+                job TEXT NOT NULL,
+                fire_at INTEGER NOT NULL,
+                PRIMARY KEY (job, fire_at)
+            )
+        """)
+        # 実行権（status: claimed → done）。以前の形式の行は実行済みとして扱う
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(schedule_runs)")}
+        if 'status' not in columns:
+            self.conn.execute("ALTER TABLE schedule_runs ADD COLUMN status TEXT NOT NULL DEFAULT 'done'")
+            self.conn.execute("ALTER TABLE schedule_runs ADD COLUMN owner TEXT")
+            self.conn.execute("ALTER TABLE schedule_runs ADD COLUMN lease_until REAL")
+        # 要約ジョブのキュー（status: queued → running → done/failed → posting → posted）
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS summary_jobs (
+                job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                guild_id INTEGER NOT NULL,
+                priority INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                available_at REAL NOT NULL,
+                worker TEXT,
+                lease_until REAL,
+                result TEXT,
+                error TEXT,
+                created_at REAL NOT NULL,
+                finished_at REAL
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_summary_jobs_status ON summary_jobs (status, priority, size, job_id)")
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(summary_jobs)")}
+        if 'post_attempts' not in columns:
+            self.conn.execute("ALTER TABLE summary_jobs ADD COLUMN post_attempts INTEGER NOT NULL DEFAULT 0")
+        # 1時間ごとのバケットの集計（起動時にメッセージを1件ずつ追加し直さずにバケットを復元する）
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS bucket_rollups (
+                guild_id INTEGER NOT NULL,
+                channel_id INTEGER NOT NULL,
+                hour INTEGER NOT NULL,
+                message_count INTEGER NOT NULL,
+                last_message_id INTEGER NOT NULL,
+                authors TEXT NOT NULL,
+                postings TEXT NOT NULL,
+                PRIMARY KEY (guild_id, channel_id, hour)
+            )
+        """)
+        self.conn.commit()
+    
+    def enqueue(self, msg):
+        """メッセージを書き込み待ちリストに追加（ディスクI/Oは行わない）"""
+        self.pending.append(msg.to_row())
+        self.touched.add((msg.guild_id, msg.channel_id, int(msg.ts // 3600)))
+    
+    def _execute(self, sql, params=(), many=False):
+        with self.lock:
+            if many:
+                self.conn.executemany(sql, params)
+            else:
+                self.conn.execute(sql, params)
+            self.conn.commit()
+    
+    def _query(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+    
+    async def flush(self):
+        """書き込み待ちのメッセージをまとめてディスクへ書き込む"""
+        if not self.pending:
+            return 0
+        rows, self.pending = self.pending, []
+        try:
+            await asyncio.to_thread(
+                self._execute,
+                "INSERT OR IGNORE INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+                True,
+            )
+        except Exception:
+            # 書き込みに失敗した行は次回のflushで再試行する。失敗が続く場合は古いものから捨てて
+            # メモリの増加を抑える（バッファには残り、再起動時のバックフィルで取り戻せる）
+            self.pending[:0] = rows
+            overflow = len(self.pending) - STORE_PENDING_LIMIT
+            if overflow > 0:
+                del self.pending[:overflow]
+                self.dropped += overflow
+                metrics.inc('store_dropped_messages_total', overflow)
+                print(f"⚠️ MessageStoreへの書き込みが失敗し続けているため{overflow}件の書き込みを破棄しました")
+            raise
+        return len(rows)
+    
+    async def save_rollups(self, rows):
+        await asyncio.to_thread(self._execute, "INSERT OR REPLACE INTO bucket_rollups VALUES (?, ?, ?, ?, ?, ?, ?)", rows, True)
+    
+    def read_rollups(self, start_hour):
+        """start_hour 以降のバケットの集計を読み込む（ワーカースレッドから呼び出す）"""
+        return {
+            (guild_id, channel_id, hour): (count, last_id, authors, postings)
+            for guild_id, channel_id, hour, count, last_id, authors, postings in self._query(
+                "SELECT * FROM bucket_rollups WHERE hour >= ?" + local_guild_sql()[0], (start_hour, *local_guild_sql()[1]))
+        }
+    
+    def read_range(self, start_ts, end_ts, guild_id=None, local_only=False):
+        """期間内のメッセージ行をID順に読み込む（ワーカースレッドから呼び出す）
+        
+        local_onlyを指定すると、このプロセスのシャードが担当するサーバーの行だけを読む。
+        """
+        sql = "SELECT * FROM messages WHERE message_id > ? AND message_id < ?"
+        params = [ts_to_snowflake(start_ts), ts_to_snowflake(end_ts)]
+        if guild_id is not None:
+            sql += " AND guild_id = ?"
+            params.append(guild_id)
+        if local_only:
+            condition, condition_params = local_guild_sql()
+            sql += condition
+            params += condition_params
+        return self._query(sql + " ORDER BY message_id", params)
+    
+    def read_checkpoints(self, start_ts):
+        """start_ts 以降のブロックの要約チェックポイントを読み込む（ワーカースレッドから呼び出す）"""
+        return self._query("SELECT * FROM checkpoints WHERE block_start >= ?", (int(start_ts),))
+    
+    async def save_checkpoint(self, guild_id, block_start, fingerprint, summary):
+        await asyncio.to_thread(
+            self._execute,
+            "INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?, ?)",
+            (guild_id, int(block_start), fingerprint[0], fingerprint[1], summary),
+        )
+    
+    def read_guild_settings(self, guild_id):
+        """サーバーの設定を読み込む（ワーカースレッドから呼び出す）"""
+        rows = self._query(
+            "SELECT timezone, schedule_hours, enabled, summary_channel_id FROM guild_settings WHERE guild_id = ?",
+            (guild_id,),
+        )
+        if not rows:
+            return {}
+        timezone_name, schedule_hours, enabled, summary_channel_id = rows[0]
+        return {
+            'timezone': timezone_name,
+            'schedule_hours': json.loads(schedule_hours) if schedule_hours else None,
+            'enabled': None if enabled is None else bool(enabled),
+            'summary_channel_id': summary_channel_id,
+        }
+    
+    async def save_guild_settings(self, guild_id, config):
+        summary_channel = config['summary_channel']
+        await asyncio.to_thread(
+            self._execute,
+            "INSERT OR REPLACE INTO guild_settings (guild_id, timezone, schedule_hours, enabled, summary_channel_id) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (guild_id, config['timezone'], json.dumps(config['schedule_hours']) if config['schedule_hours'] else None,
+             int(config['enabled']), summary_channel.id if summary_channel else None),
+        )
+    
+    def read_quota_state(self, date):
+        """利用枠のバケットの残量と指定日の使用量を読み込む（ワーカースレッドから呼び出す）"""
+        buckets = {name: (level, updated) for name, level, updated in self._query("SELECT * FROM quota_state")}
+        rows = self._query("SELECT requests, input_tokens, output_tokens FROM api_usage WHERE date = ?", (date,))
+        return buckets, rows[0] if rows else None
+    
+    def update_quota_state(self, update):
+        """他のプロセスと排他してバケットの残量を読み、update(残量)が返す残量を書き込む
+        
+        updateは {名前: (残量, 更新時刻)} を受け取り (戻り値, 書き込む行) を返す。
+        BEGIN IMMEDIATEで書き込みロックを取ってから読むので、複数のプロセスが同時に取り出しても
+        利用枠を超えない（ワーカースレッドから呼び出す）。
+        """
+        with self.lock:
+            try:
+                self.conn.execute("BEGIN IMMEDIATE")
+                buckets = {name: (level, updated) for name, level, updated in self.conn.execute("SELECT * FROM quota_state")}
+                result, rows = update(buckets)
+                self.conn.executemany("INSERT OR REPLACE INTO quota_state VALUES (?, ?, ?)", rows)
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+        return result
+    
+    def add_api_usage(self, date, requests, input_tokens, output_tokens):
+        """指定日の使用量に加算して合計を返す（ワーカースレッドから呼び出す）"""
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO api_usage VALUES (?, ?, ?, ?) ON CONFLICT(date) DO UPDATE SET "
+                "requests = requests + excluded.requests, input_tokens = input_tokens + excluded.input_tokens, "
+                "output_tokens = output_tokens + excluded.output_tokens",
+                (date, requests, input_tokens, output_tokens),
+            )
+            self.conn.commit()
+            return self.conn.execute(
+                "SELECT requests, input_tokens, output_tokens FROM api_usage WHERE date = ?", (date,)).fetchone()
+    
+    async def save_quota_state(self, buckets, usage):
+        await asyncio.to_thread(self._execute, "INSERT OR REPLACE INTO quota_state VALUES (?, ?, ?)", buckets, True)
+        await asyncio.to_thread(
+            self._execute,
+            "INSERT OR REPLACE INTO api_usage VALUES (?, ?, ?, ?)",
+            (usage['date'], usage['requests'], usage['input_tokens'], usage['output_tokens']),
+        )
+    
+    def has_run(self, job, fire_at, owner):
+        """定期要約が実行済みか、他のプロセスが実行中か（ワーカースレッドから呼び出す）"""
+        rows = self._query("SELECT status, owner, lease_until FROM schedule_runs WHERE job = ? AND fire_at = ?",
+                           (job, int(fire_at)))
+        if not rows:
+            return False
+        status, claimed_by, lease_until = rows[0]
+        return status == 'done' or (claimed_by != owner and lease_until > time.time())
+    
+    def claim_runs(self, jobs, fire_at, owner, lease_seconds):
+        """定期要約の実行権を取得し、取得できたジョブを返す（ワーカースレッドから呼び出す）
+        
+        INSERT OR IGNOREで最初に記録したプロセスだけが行を追加できるので、複数のプロセスが
+        同じ定期要約を予定していても実行されるのは1回だけになる。投稿を終えたらfinish_runs()で
+        doneにする。doneにならないまま期限が切れた実行権と、同じownerの実行権（再起動前の自分）は取り直せる。
+        """
+        claimed = []
+        now = time.time()
+        with self.lock:
+            try:
+                self.conn.execute("BEGIN IMMEDIATE")
+                for job in jobs:
+                    cursor = self.conn.execute("INSERT OR IGNORE INTO schedule_runs VALUES (?, ?, 'claimed', ?, ?)",
+                                               (job, int(fire_at), owner, now + lease_seconds))
+                    if cursor.rowcount == 0:
+                        cursor = self.conn.execute(
+                            "UPDATE schedule_runs SET owner = ?, lease_until = ? "
+                            "WHERE job = ? AND fire_at = ? AND status = 'claimed' AND (lease_until < ? OR owner = ?)",
+                            (owner, now + lease_seconds, job, int(fire_at), now, owner),
+                        )
+                    if cursor.rowcount == 1:
+                        claimed.append(job)
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+        return claimed
+    
+    def finish_runs(self, jobs, fire_at, owner):
+        """取得した実行権を実行済みにする（ワーカースレッドから呼び出す）"""
+        self._execute(
+            "UPDATE schedule_runs SET status = 'done' WHERE job = ? AND fire_at = ? AND owner = ? AND status = 'claimed'",
+            [(job, int(fire_at), owner) for job in jobs], True,
+        )
+    
+    async def enqueue_job(self, guild_id, priority, size, payload):
+        """要約ジョブをキューに追加してIDを返す"""
+        def insert():
+            now = time.time()
+            with self.lock:
+                cursor = self.conn.execute(
+                    "INSERT INTO summary_jobs (guild_id, priority, size, payload, status, available_at, created_at) "
+                    "VALUES (?, ?, ?, ?, 'queued', ?, ?)",
+                    (guild_id, priority, size, payload, now, now),
+                )
+                self.conn.commit()
+                return cursor.lastrowid
+        return await asyncio.to_thread(insert)
+    
+    def claim_job(self, worker, lease_seconds, max_attempts):
+        """実行できる最も優先度の高いジョブを取得して実行中にする（ワーカースレッドから呼び出す）
+        
+        優先度（定期要約 → 手動要約）、メッセージ数の少ない順、登録順に選ぶ。期限（lease_until）を
+        過ぎても完了しない実行中のジョブは、ワーカーが停止したとみなして再び取得できる
+        （試行回数が上限に達していれば失敗にする）。戻り値は (ID, サーバーID, 優先度, メッセージ数,
+        payload, 試行回数) かNone。
+        """
+        now = time.time()
+        with self.lock:
+            try:
+                self.conn.execute("BEGIN IMMEDIATE")
+                self.conn.execute(
+                    "UPDATE summary_jobs SET status = 'failed', error = 'ワーカーが応答しません', finished_at = ? "
+                    "WHERE status = 'running' AND lease_until < ? AND attempts >= ?",
+                    (now, now, max_attempts),
+                )
+                row = self.conn.execute(
+                    "SELECT job_id, guild_id, priority, size, payload, attempts FROM summary_jobs "
+                    "WHERE (status = 'queued' AND available_at <= ?) OR (status = 'running' AND lease_until < ?) "
+                    "ORDER BY priority, size, job_id LIMIT 1",
+                    (now, now),
+                ).fetchone()
+                if row:
+                    self.conn.execute(
+                        "UPDATE summary_jobs SET status = 'running', worker = ?, lease_until = ?, attempts = attempts + 1 "
+                        "WHERE job_id = ?",
+                        (worker, now + lease_seconds, row[0]),
+                    )
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+        return row[:5] + (row[5] + 1,) if row else None
+    
+    def finish_job(self, job_id, worker, result=None, error=None, retry_at=None):
+        """ジョブの結果を記録（retry_atを指定するとその時刻に再試行、ワーカースレッドから呼び出す）
+        
+        期限切れで他のワーカーが取得し直したジョブの結果は記録しない。
+        """
+        now = time.time()
+        if error is None:
+            sql, params = "status = 'done', result = ?, finished_at = ?", (result, now)
+        elif retry_at is not None:
+            sql, params = "status = 'queued', error = ?, available_at = ?", (error, retry_at)
+        else:
+            sql, params = "status = 'failed', error = ?, finished_at = ?", (error, now)
+        self._execute(f"UPDATE summary_jobs SET {sql} WHERE job_id = ? AND worker = ? AND status = 'running'",
+                      params + (job_id, worker))
+    
+    def read_finished_jobs(self, limit=20):
+        """このプロセスのシャードが担当するサーバーの、投稿待ちの完了・失敗したジョブを読み込む
+        
+        投稿中のまま期限（lease_until）を過ぎたジョブ（投稿に失敗して再試行を待っていたものや、
+        投稿中にプロセスが停止したもの）も含む。ワーカースレッドから呼び出す。
+        """
+        condition, params = local_guild_sql()
+        return self._query(
+            "SELECT job_id, guild_id, payload, result IS NOT NULL, result, error, created_at, post_attempts FROM summary_jobs "
+            "WHERE (status IN ('done', 'failed') OR (status = 'posting' AND lease_until < ?))"
+            + condition + " ORDER BY job_id LIMIT ?",
+            (time.time(), *params, limit),
+        )
+    
+    def claim_posting(self, job_id, lease_seconds):
+        """完了したジョブの投稿権を取得する（取得できたらTrue、ワーカースレッドから呼び出す）
+        
+        1つの行の状態を条件付きで更新するだけなので、複数のゲートウェイが同じジョブを読んでも投稿するのは1つだけになる。
+        """
+        now = time.time()
+        with self.lock:
+            cursor = self.conn.execute(
+                "UPDATE summary_jobs SET status = 'posting', lease_until = ?, post_attempts = post_attempts + 1 "
+                "WHERE job_id = ? AND (status IN ('done', 'failed') OR (status = 'posting' AND lease_until < ?))",
+                (now + lease_seconds, job_id, now),
+            )
+            self.conn.commit()
+        return cursor.rowcount == 1
+    
+    async def retry_posting(self, job_id, retry_at):
+        """投稿に失敗したジョブをretry_at以降に再び投稿できるようにする"""
+        await asyncio.to_thread(self._execute, "UPDATE summary_jobs SET lease_until = ? WHERE job_id = ? AND status = 'posting'",
+                                (retry_at, job_id))
+    
+    async def mark_posted(self, job_id):
+        await asyncio.to_thread(self._execute, "UPDATE summary_jobs SET status = 'posted' WHERE job_id = ?", (job_id,))
+    
+    def queue_stats(self):
+        """キューの状況（状態ごとの件数と最も古いジョブの登録時刻、実行中のワーカー、直近24時間の実績）"""
+        stats = {status: {'count': 0, 'oldest': None} for status in ('queued', 'running', 'done', 'failed', 'posting')}
+        for status, count, oldest in self._query(
+                "SELECT status, COUNT(*), MIN(created_at) FROM summary_jobs WHERE status != 'posted' GROUP BY status"):
+            stats[status] = {'count': count, 'oldest': oldest}
+        stats['workers'] = self._query(
+            "SELECT worker, COUNT(*) FROM summary_jobs WHERE status = 'running' GROUP BY worker ORDER BY worker")
+        finished, failed, retried, average = self._query(
+            "SELECT COUNT(*), SUM(result IS NULL), SUM(attempts > 1), AVG(finished_at - created_at) FROM summary_jobs "
+            "WHERE finished_at >= ?",
+            (time.time() - 86400,),
+        )[0]
+        stats['recent'] = {'finished': finished, 'failed': failed or 0, 'retried': retried or 0, 'average': average}
+        return stats
+    
+    async def delete_before(self, cutoff_ts):
+        await asyncio.to_thread(self._execute, "DELETE FROM messages WHERE message_id < ?", (ts_to_snowflake(cutoff_ts),))
+        await asyncio.to_thread(self._execute, "DELETE FROM checkpoints WHERE block_start < ?", (int(cutoff_ts),))
+        await asyncio.to_thread(self._execute, "DELETE FROM schedule_runs WHERE fire_at < ?", (int(cutoff_ts),))
+        await asyncio.to_thread(self._execute, "DELETE FROM summary_jobs WHERE status = 'posted' AND created_at < ?", (cutoff_ts,))
+        await asyncio.to_thread(self._execute, "DELETE FROM bucket_rollups WHERE hour < ?", (int(cutoff_ts // 3600),))
+    
+    async def delete_guild(self, guild_id):
+        await asyncio.to_thread(self._execute, "DELETE FROM messages WHERE guild_id = ?", (guild_id,))
+        await asyncio.to_thread(self._execute, "DELETE FROM checkpoints WHERE guild_id = ?", (guild_id,))
+        await asyncio.to_thread(self._execute, "DELETE FROM guild_settings WHERE guild_id = ?", (guild_id,))
+        await asyncio.to_thread(self._execute, "DELETE FROM bucket_rollups WHERE guild_id = ?", (guild_id,))
+
+message_store = MessageStore(MESSAGE_STORE_PATH) if MESSAGE_STORE_PATH else None
+if (WORKER_COUNT > 1 or BOT_ROLE != 'all') and not message_store:
+    raise ValueError("WORKER_COUNTが2以上かBOT_ROLEがall以外の場合は、全プロセスで共有するMESSAGE_STORE_PATHを設定してください。")
+
+def load_buffers_from_store(start_ts, end_ts):
+    """MessageStoreからチャンネルごとのChannelBufferを構築（ワーカースレッドで実行）
+    
+    集計が保存済みで件数と最後のメッセージIDが一致するバケットは、キーワードを抽出し直さずにそのまま復元する。
+    集計がない（または古い）バケットだけメッセージを1件ずつ追加し、次回のflushで集計を保存し直す。
+    """
+    rollups = message_store.read_rollups(int(start_ts // 3600))
+    grouped = defaultdict(list)  # (サーバーID, チャンネルID, 時間) -> メッセージID順のメッセージ
+    for row in message_store.read_range(start_ts, end_ts, local_only=True):
+        msg = MessageData.from_row(row)
+        grouped[(msg.guild_id, msg.channel_id, int(msg.ts // 3600))].append(msg)
+    
+    buffers = defaultdict(lambda: defaultdict(ChannelBuffer))
+    stale = []
+    for key in sorted(grouped, key=lambda key: key[2]):
+        guild_id, channel_id, hour = key
+        messages = grouped[key]
+        buffer = buffers[guild_id][channel_id]
+        rollup = rollups.get(key)
+        if rollup and rollup[0] == len(messages) and rollup[1] == messages[-1].message_id:
+            buffer.add_bucket(load_bucket_rollup(hour, messages, rollup[2], rollup[3]))
+        else:
+            for msg in messages:
+                buffer.append(msg)
+            stale.append(key)
+    return buffers, stale
+
+async def hydrate_message_buffers():
+    """起動時に保持期間内のメッセージをMessageStoreから復元
+    
+    読み込みはワーカースレッドで行うため、その間もメッセージの受信は止まらない。
+    起動後に受信したメッセージは読み込み範囲外なので、復元したバッファに合流させる。
+    """
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    now_ts = datetime.now(timezone.utc).timestamp()
+    loaded, stale = await asyncio.to_thread(load_buffers_from_store, now_ts - 168 * 3600, now_ts)
+    message_store.touched.update(stale)
+    
+    for guild_id, block_start, message_count, last_message_id, summary in await asyncio.to_thread(
+            message_store.read_checkpoints, now_ts - 168 * 3600):
+        if not is_local_guild(guild_id):
+            continue
+        summary_checkpoints[guild_id].setdefault(block_start, ((message_count, last_message_id), summary))
+    
+    total = 0
+    for guild_id, channels in loaded.items():
+        for channel_id, buffer in channels.items():
+            live = message_buffers[guild_id].get(channel_id)
+            if live:
+                for msg in live:
+                    buffer.append(msg)
+            message_buffers[guild_id][channel_id] = buffer
+            total += len(buffer)
+    
+    print(f"[{datetime.now()}] MessageStoreから{total}件のメッセージを復元しました（{loop.time() - started:.1f}秒）")
+
+def ingest_message(message, dedup=False):
+    """メッセージをバッファと永続化キューに追加（dedup指定時は重複を無視してNoneを返す）"""
+    message_data = MessageData(message)
+    buffer = message_buffers[message.guild.id][message.channel.id]
+    if dedup and buffer.contains(message_data):
+        return None
+    
+    buffer.append(message_data)
+    metrics.inc('messages_ingested_total')
+    if message_store:
+        message_store.enqueue(message_data)
+    return message_data
+
+def get_block_offset(guild_id, ts):
+    """ブロック境界の位置（エポック秒でのオフセット）
+    
+    サーバーの最初の定期要約の時刻（サーバーのタイムゾーン）に揃え、定期要約の期間がブロックの境界で
+    区切られるようにする。サーバーの設定がなければデフォルトのスケジュールとタイムゾーンを使う。
+    """
+    config = server_configs.get(guild_id) or {}
+    slot = get_guild_slots(config)[0]
+    utc_offset = datetime.fromtimestamp(ts, get_guild_timezone(config)).utcoffset().total_seconds()
+    return int(slot['hour'] * 3600 + slot['minute'] * 60 - utc_offset)
+
+def get_block_start(ts, guild_id=None):
+    """ts を含む要約チェックポイントのブロックの開始時刻（エポック秒）"""
+    size = CHECKPOINT_BLOCK_HOURS * 3600
+    offset = get_block_offset(guild_id, ts)
+    return ((int(ts) - offset) // size) * size + offset
+
+def get_summary_window(hours_back, guild_id=None):
+    """過去hours_back時間の要約対象期間 (開始, 終了) をエポック秒で返す
+    
+    開始時刻がブロック境界の前後CHECKPOINT_SNAP_SECONDS秒以内なら境界に揃え、
+    定期要約の期間がチェックポイントのブロックと一致するようにする。
+    """
+    end_ts = datetime.now(timezone.utc).timestamp()
+    start_ts = end_ts - hours_back * 3600
+    block_start = get_block_start(start_ts, guild_id)
+    for boundary in (block_start, block_start + CHECKPOINT_BLOCK_HOURS * 3600):
+        if abs(start_ts - boundary) <= CHECKPOINT_SNAP_SECONDS:
+            start_ts = boundary
+    return start_ts, end_ts
 
 def get_messages_in_timerange(guild_id, hours_back):
     """指定時間内のメッセージを取得"""
-    cutoff_time = datetime.now(timezone.utc) - timedelta(hours=hours_back)
+    return get_messages_in_window(guild_id, *get_summary_window(hours_back, guild_id))
+
+def get_messages_in_window(guild_id, start_ts, end_ts=None):
+    """期間 (start_ts, end_ts] のメッセージをチャンネル名ごとに取得"""
     messages_by_channel = {}
     
-    for channel_id, messages in message_buffers[guild_id].items():
-        filtered_messages = [
-            msg for msg in messages 
-            if msg.timestamp.replace(tzinfo=None) > cutoff_time.replace(tzinfo=None)
-        ]
+    for channel_id, buffer in message_buffers[guild_id].items():
+        filtered_messages = buffer.range(start_ts, end_ts)
         if filtered_messages:
             # チャンネル名でグループ化
             channel_name = filtered_messages[0].channel_name
@@ -100,87 +1358,130 @@ def get_messages_in_timerange(guild_id, hours_back):
     
     return messages_by_channel
 
+def get_window_stats(guild_id, start_ts, end_ts=None):
+    """期間 (start_ts, end_ts] の統計（get_messages_in_window と同じ対象）
+    
+    各バッファの1時間ごとの集計をまとめるだけで、メッセージは走査しない。
+    戻り値: {'total': 件数, 'channels': チャンネル名 -> 件数, 'authors': 投稿者の集合}
+    """
+    channels = defaultdict(int)
+    authors = set()
+    for buffer in message_buffers[guild_id].values():
+        count, channel_authors = buffer.stats(start_ts, end_ts)
+        if count:
+            channels[buffer.channel_name()] += count
+            authors |= channel_authors
+    return {'total': sum(channels.values()), 'channels': channels, 'authors': authors}
+
+def estimate_message_memory(sample_per_channel=50):
+    """バッファ内メッセージ1件あたりの推定メモリ使用量（バイト）をサンプリングで算出"""
+    sample_bytes = 0
+    sample_count = 0
+    names = set()
+    
+    for channels in list(message_buffers.values()):
+        for buffer in list(channels.values()):
+            if not buffer.buckets:
+                continue
+            for msg in buffer.buckets[-1].messages[:sample_per_channel]:
+                # オブジェクト本体 + 本文 + メッセージID + バケット内の参照とタイムスタンプ（各8バイト）
+                sample_bytes += sys.getsizeof(msg) + sys.getsizeof(msg.content) + sys.getsizeof(msg.message_id) + 16
+                sample_count += 1
+                names.add(msg.author)
+                names.add(msg.channel_name)
+    
+    if not sample_count:
+        return 0
+    
+    # インターンされた名前は共有されるため、サンプル全体で1回だけ数える
+    sample_bytes += sum(sys.getsizeof(name) for name in names)
+    return sample_bytes / sample_count
+
 def cleanup_old_messages():
-    """1週間以上前のメッセージを削除"""
-    cutoff_time = datetime.now(timezone.utc) - timedelta(hours=168)  # 1週間 = 168時間
+    """1週間以上前のメッセージをバケット単位で削除"""
+    cutoff_ts = datetime.now(timezone.utc).timestamp() - 168 * 3600  # 1週間 = 168時間
     
     for guild_id in message_buffers:
         for channel_id in message_buffers[guild_id]:
-            # dequeから古いメッセージを削除
-            while (message_buffers[guild_id][channel_id] and 
-                   message_buffers[guild_id][channel_id][0].timestamp.replace(tzinfo=None) < cutoff_time.replace(tzinfo=None)):
-                message_buffers[guild_id][channel_id].popleft()
+            message_buffers[guild_id][channel_id].evict_before(cutoff_ts)
+
+def get_term_baseline(guild_id):
+    """サーバーの保持期間全体（1週間）でのキーワードの出現バケット数と総バケット数（TERM_BASELINE_TTL秒キャッシュ）"""
+    now = time.monotonic()
+    cached = term_baselines.get(guild_id)
+    if cached and cached[0] > now:
+        return cached[1], cached[2]
+    
+    documents = defaultdict(int)
+    total = 0
+    for buffer in message_buffers[guild_id].values():
+        total += len(buffer.buckets)
+        for term, count in buffer.documents.items():
+            documents[term] += count
+    term_baselines[guild_id] = (now + TERM_BASELINE_TTL, documents, total)
+    return documents, total
+
+def count_terms(messages):
+    """メッセージのリストのキーワードごとのメッセージ数（期間の集計を使えない場合）"""
+    counts = defaultdict(int)
+    for msg in messages:
+        for term in extract_terms(msg.content):
+            counts[term] += 1
+    return counts
+
+def rank_terms(counts, documents, total, limit):
+    """キーワードを1週間の出現頻度に対するTF-IDFで順位付けし、上位limit件を返す
+    
+    2件以上のメッセージに出たキーワードを優先し、それだけでlimit件に満たない場合（メッセージの少ない期間）は
+    1件だけのキーワードで補う。
+    """
+    scored = [
+        (count >= 2, (1 + math.log(count)) * math.log((total + 1) / (documents.get(term, 0) + 1)) + 1e-9 * count, term)
+        for term, count in counts.items()
+    ]
+    return [term for _, _, term in heapq.nlargest(limit, scored)]
 
 def generate_simple_summary(messages_by_channel):
-    """Gemini APIが使えない場合の簡易要約"""
+    """Gemini APIが使えない場合の簡易要約
+    
+    チャンネルごとの特徴的なキーワードを、バッファの1時間ごとのキーワード集計をまとめて
+    1週間の出現頻度に対するTF-IDFで選ぶ。メッセージの本文は走査しないので、
+    APIの障害時に多数のサーバーで使われてもすぐに返せる。
+    """
     summaries = []
+    total_counts = defaultdict(int)
+    documents, total = {}, 0
     
-    for channel_name, messages in messages_by_channel.items():
-        content_words = defaultdict(int)
+    ranked_channels = sorted(messages_by_channel.items(), key=lambda x: len(x[1]), reverse=True)
+    for channel_name, messages in ranked_channels:
+        if not messages:
+            continue
+        first = messages[0]
+        buffer = message_buffers.get(first.guild_id, {}).get(first.channel_id)
+        if buffer is not None and buffer.contains(first):
+            # 最初のメッセージの直前から最後のメッセージまでの集計（同じ時刻の直前のメッセージは誤差として許容）
+            counts = buffer.term_counts(first.ts - 0.0005, messages[-1].ts)
+            documents, total = get_term_baseline(first.guild_id)
+        else:
+            counts = count_terms(messages)
         
-        for msg in messages:
-            words = msg.content.lower().split()
-            for word in words:
-                if len(word) > 4:  # 4文字以上の単語をカウント
-                    content_words[word] += 1
+        for term, count in counts.items():
+            total_counts[term] += count
         
-        # 頻出単語TOP3
-        top_words = sorted(content_words.items(), key=lambda x: x[1], reverse=True)[:3]
-        if top_words:
-            keywords = ", ".join([word for word, _ in top_words])
-            summaries.append(f"**#{channel_name}**: {keywords}")
+        keywords = rank_terms(counts, documents, max(total, 1), 5)
+        if keywords:
+            summaries.append(f"**#{channel_name}**（{len(messages)}件）: {', '.join(keywords)}")
     
     if summaries:
-        return "\n".join(summaries)
+        overall = rank_terms(total_counts, documents, max(total, 1), 8)
+        header = [f"**全体の話題**: {', '.join(overall)}", ""] if overall and len(summaries) > 1 else []
+        return "\n".join(header + summaries)
     return "特定のトピックは見つかりませんでした。"
 
-def summarize_all_channels(messages_by_channel, is_weekly=False):
-    """全チャンネルのメッセージを統合して要約する関数"""
-    global daily_api_calls, last_reset_date
-    
-    # 日付が変わったらAPI使用量をリセット
-    if datetime.now().date() != last_reset_date:
-        daily_api_calls = 0
-        last_reset_date = datetime.now().date()
-    
-    if not any(messages_by_channel.values()):
-        return "要約するメッセージがありません。"
-    
-    try:
-        # 全チャンネルのメッセージを整形
-        all_conversations = []
-        
-        for channel_name, messages in messages_by_channel.items():
-            if not messages:
-                continue
-            
-            channel_text = f"\n=== #{channel_name} ===\n"
-            message_texts = []
-            
-            # 最新のMAX_MESSAGES_PER_SUMMARY件のみ処理（週次サマリーの場合は2倍）
-            max_messages = MAX_MESSAGES_PER_SUMMARY * 2 if is_weekly else MAX_MESSAGES_PER_SUMMARY
-            
-            for msg in messages[-max_messages:]:
-                text = f"{msg.author}: {msg.content}"
-                if msg.attachments > 0:
-                    text += f" [添付ファイル: {msg.attachments}件]"
-                if msg.embeds > 0:
-                    text += f" [Embed: {msg.embeds}件]"
-                message_texts.append(text)
-            
-            channel_text += "\n".join(message_texts)
-            all_conversations.append(channel_text)
-        
-        # 全会話を結合
-        full_conversation = "\n\n".join(all_conversations)
-        
-        # プロンプトを構築（週次サマリー用の特別な指示を追加）
-        if is_weekly:
-            prompt = f"""以下は1週間分のDiscordチャンネルの会話です。1週間の活動を俯瞰的に要約してください。
-
-{full_conversation}
+# 日本時間（要約内の時刻表示用）
+JST = timezone(timedelta(hours=9))
 
-重要な指示：
+WEEKLY_SUMMARY_INSTRUCTIONS = """重要な指示：
 - 1週間の活動を総括的に要約
 - 主要なトピック、決定事項、進捗状況を整理
 - チャンネルごとの活動傾向を分析
@@ -189,12 +1490,8 @@ def summarize_all_channels(messages_by_channel, is_weekly=False):
 - 簡潔で読みやすい要約（1800文字以内）
 - 箇条書きや見出しを活用して構造化
 - 登場する人物のDisplay Nameには敬称として「さん」を付けてください"""
-        else:
-            prompt = f"""以下のDiscordチャンネルの会話を要約してください。
-
-{full_conversation}
 
-重要な指示：
+SUMMARY_INSTRUCTIONS = """重要な指示：
 - 全チャンネルを俯瞰して統合的に要約する
 - 「#チャンネル名で誰が何を話したか」を明確に記載
 - 重要な情報、決定事項、注目すべきトピックを優先
@@ -203,32 +1500,975 @@ def summarize_all_channels(messages_by_channel, is_weekly=False):
 - 箇条書きや見出しを活用して構造化
 - 登場する人物のDisplay Nameには敬称として「さん」を付けてください"""
 
-        
-        # APIを呼び出し
-        response = client.models.generate_content(
-            model=MODEL_NAME,
-            contents=prompt,
-            config=types.GenerateContentConfig(
-                temperature=0.3,
-                max_output_tokens=2000 if is_weekly else 1500,  # 週次サマリーは少し長め
-            ),
-        )
-        
-        daily_api_calls += 1
-        
-        # レスポンスのテキストを取得
-        if response.text:
-            return response.text
-        else:
-            return "要約の生成に失敗しました。"
-            
-    except Exception as e:
-        print(f"Gemini API エラー: {e}")
-        return generate_simple_summary(messages_by_channel)
+URL_PATTERN = re.compile(r'https?://\S+')
+CUSTOM_EMOJI_PATTERN = re.compile(r'<a?:\w+:\d+>')
 
-async def get_or_create_bot_channel(guild):
-    """Bot用チャンネルを取得または作成"""
-    # 既存のbot-summariesチャンネルを探す
+def estimate_tokens(text):
+    """推定トークン数（日本語などの非ASCII文字は1文字1トークン、ASCIIは4文字で1トークン）"""
+    ascii_chars = len(text.encode('ascii', 'ignore'))
+    return (len(text) - ascii_chars) + ascii_chars // 4 + 1
+
+def is_bare_emoji(content):
+    """絵文字・記号だけのメッセージか"""
+    stripped = CUSTOM_EMOJI_PATTERN.sub('', content)
+    return all(unicodedata.category(c) in ('So', 'Sk', 'Mn', 'Cf', 'Zs', 'Cc') for c in stripped)
+
+def format_message(msg):
+    """メッセージをプロンプト用の1行に整形（要約に不要なメッセージはNone）
+    
+    URLは[URL]に置き換え、同じ行の繰り返しはまとめ、長いメッセージはMESSAGE_TOKEN_LIMITで切り詰める。
+    """
+    content = URL_PATTERN.sub('[URL]', msg.content).strip()
+    if is_bare_emoji(content) and not (msg.attachments or msg.embeds):
+        return None
+    
+    if '\n' in content:
+        lines = []
+        for line in content.split('\n'):
+            if lines and lines[-1][0] == line:
+                lines[-1][1] += 1
+            else:
+                lines.append([line, 1])
+        content = '\n'.join(line if repeat == 1 else f"{line} (×{repeat})" for line, repeat in lines)
+    
+    tokens = estimate_tokens(content)
+    if tokens > MESSAGE_TOKEN_LIMIT:
+        content = content[:len(content) * MESSAGE_TOKEN_LIMIT // tokens] + " …(以下省略)"
+    
+    text = f"{msg.author}: {content}"
+    if msg.attachments > 0:
+        text += f" [添付ファイル: {msg.attachments}件]"
+    if msg.embeds > 0:
+        text += f" [Embed: {msg.embeds}件]"
+    return text
+
+def message_tokens(msg):
+    """整形後のメッセージの推定トークン数の上限"""
+    return min(estimate_tokens(msg.content), MESSAGE_TOKEN_LIMIT) + estimate_tokens(msg.author) + 2
+
+def allocate_token_budget(needs, weights, budget):
+    """チャンネルごとの必要トークン数を、活動量（weights）に比例してbudget内で配分
+    
+    配分が必要量を上回るチャンネルには必要量だけを割り当て、余りを他のチャンネルで分け合う。
+    """
+    allowance = {}
+    active = set(needs)
+    remaining = budget
+    
+    while active:
+        total_weight = sum(weights[name] for name in active) or 1
+        satisfied = [name for name in active if needs[name] <= remaining * weights[name] / total_weight]
+        if not satisfied:
+            for name in active:
+                allowance[name] = remaining * weights[name] / total_weight
+            break
+        for name in satisfied:
+            allowance[name] = needs[name]
+            remaining -= needs[name]
+            active.discard(name)
+    
+    return allowance
+
+def pack_conversation(messages_by_channel, budget=PROMPT_TOKEN_BUDGET):
+    """チャンネルごとのメッセージをトークン予算内のプロンプト用テキストに整形
+    
+    絵文字だけのメッセージは除き、同じ発言の連続は1行にまとめる。予算は活動量に応じて
+    チャンネルに配分し、各チャンネルでは新しいメッセージから順に予算内に収める。
+    戻り値は (テキスト, 統計) で、統計は推定トークン数と採用/全体のメッセージ数。
+    """
+    started = time.perf_counter()
+    channel_lines = {}
+    total_messages = 0
+    
+    for channel_name, messages in messages_by_channel.items():
+        lines = []
+        for msg in messages:
+            total_messages += 1
+            line = format_message(msg)
+            if line is None:
+                continue
+            if lines and lines[-1][0] == line:
+                lines[-1][1] += 1
+                continue
+            lines.append([line, 1])
+        if lines:
+            channel_lines[channel_name] = [
+                (line if repeat == 1 else f"{line} (×{repeat})", estimate_tokens(line) + 1, repeat)
+                for line, repeat in lines
+            ]
+    
+    needs = {name: sum(tokens for _, tokens, _ in lines) + estimate_tokens(name) + 4 for name, lines in channel_lines.items()}
+    weights = {name: len(lines) for name, lines in channel_lines.items()}
+    allowance = allocate_token_budget(needs, weights, budget)
+    
+    all_conversations = []
+    packed_tokens = 0
+    packed_messages = 0
+    
+    for channel_name, lines in channel_lines.items():
+        remaining = allowance[channel_name] - (estimate_tokens(channel_name) + 4)
+        kept = []
+        for line, tokens, repeat in reversed(lines):
+            if tokens > remaining:
+                break
+            kept.append(line)
+            remaining -= tokens
+            packed_tokens += tokens
+            packed_messages += repeat
+        if kept:
+            kept.reverse()
+            all_conversations.append(f"\n=== #{channel_name} ===\n" + "\n".join(kept))
+            packed_tokens += estimate_tokens(channel_name) + 4
+    
+    stats = {'tokens': packed_tokens, 'messages': packed_messages, 'total': total_messages}
+    metrics.observe('prompt_build_seconds', time.perf_counter() - started)
+    return "\n\n".join(all_conversations), stats
+
+def build_summary_prompt(messages_by_channel, is_weekly=False):
+    """全チャンネルのメッセージを整形して要約用プロンプトを構築"""
+    full_conversation, stats = pack_conversation(messages_by_channel)
+    print(f"プロンプト: 約{stats['tokens']} tokens（{stats['messages']}/{stats['total']}件）")
+    
+    # プロンプトを構築（週次サマリー用の特別な指示を追加）
+    if is_weekly:
+        return f"""以下は1週間分のDiscordチャンネルの会話です。1週間の活動を俯瞰的に要約してください。
+
+{full_conversation}
+
+{WEEKLY_SUMMARY_INSTRUCTIONS}"""
+    
+    return f"""以下のDiscordチャンネルの会話を要約してください。
+
+{full_conversation}
+
+{SUMMARY_INSTRUCTIONS}"""
+
+def split_into_map_units(messages_by_channel):
+    """階層要約の部分要約単位に分割
+    
+    大きいチャンネルはMAP_CHUNK_MESSAGES件・PROMPT_TOKEN_BUDGETごとの時間ブロックに分け、
+    小さいチャンネルは1つの単位にまとめてAPI呼び出し回数を抑える。
+    """
+    units = []
+    current = {}
+    current_size = 0
+    current_tokens = 0
+    
+    for channel_name, messages in sorted(messages_by_channel.items(), key=lambda x: len(x[1]), reverse=True):
+        tokens = [message_tokens(msg) for msg in messages]
+        channel_tokens = sum(tokens)
+        
+        if len(messages) >= MAP_CHUNK_MESSAGES or channel_tokens >= PROMPT_TOKEN_BUDGET:
+            start = 0
+            chunk_tokens = 0
+            for i, msg_tokens in enumerate(tokens):
+                if i > start and (i - start >= MAP_CHUNK_MESSAGES or chunk_tokens + msg_tokens > PROMPT_TOKEN_BUDGET):
+                    units.append({channel_name: messages[start:i]})
+                    start = i
+                    chunk_tokens = 0
+                chunk_tokens += msg_tokens
+            units.append({channel_name: messages[start:]})
+            continue
+        
+        if current and (current_size + len(messages) > MAP_CHUNK_MESSAGES or
+                        current_tokens + channel_tokens > PROMPT_TOKEN_BUDGET):
+            units.append(current)
+            current = {}
+            current_size = 0
+            current_tokens = 0
+        current[channel_name] = messages
+        current_size += len(messages)
+        current_tokens += channel_tokens
+    
+    if current:
+        units.append(current)
+    return units
+
+def describe_period(messages_by_channel):
+    """部分要約の対象期間を「10/12 03:00〜10/14 05:00」の形式で返す"""
+    first = min(msgs[0].ts for msgs in messages_by_channel.values() if msgs)
+    last = max(msgs[-1].ts for msgs in messages_by_channel.values() if msgs)
+    fmt = '%m/%d %H:%M'
+    return f"{datetime.fromtimestamp(first, JST).strftime(fmt)}〜{datetime.fromtimestamp(last, JST).strftime(fmt)}"
+
+async def summarize_map_unit(unit):
+    """部分要約を1つ生成し (要約, Geminiで生成できたか) を返す（失敗時は簡易要約で代替）"""
+    period = describe_period(unit)
+    channel_names = [f"#{name}" for name in unit]
+    label = " ".join(channel_names[:5]) + (f" 他{len(channel_names) - 5}ch" if len(channel_names) > 5 else "")
+    prompt = f"""以下はDiscordの会話の一部（{period}）です。後で他の部分と統合するための要点メモを作成してください。
+
+{pack_conversation(unit)[0]}
+
+重要な指示：
+- チャンネルごとに、誰が何を話したか、決定事項、重要な情報を箇条書きで記載
+- 挨拶や雑談など重要でない内容は省略
+- 800文字以内
+- 前置きは不要"""
+    
+    try:
+        text = await generate_with_gemini(prompt, route='map')
+        if text:
+            return f"【{label} {period}】\n{text}", True
+    except asyncio.TimeoutError:
+        print(f"Gemini API タイムアウト（部分要約, {GEMINI_TIMEOUT:.0f}秒）")
+        metrics.inc('fallback_total', kind='simple', stage='map', reason='timeout')
+    except QuotaExceededError as e:
+        print(f"Gemini API 利用枠超過（部分要約）: {e}")
+        metrics.inc('fallback_total', kind='simple', stage='map', reason='quota')
+    except CircuitOpenError as e:
+        print(f"Gemini API 停止中（部分要約）: {e}")
+        metrics.inc('fallback_total', kind='simple', stage='map', reason='circuit_open')
+    except Exception as e:
+        print(f"Gemini API エラー（部分要約）: {e}")
+        metrics.inc('fallback_total', kind='simple', stage='map', reason='error')
+    return f"【{label} {period}】\n{generate_simple_summary(unit)}", False
+
+async def reduce_partial_summaries(partials, is_weekly=False, on_text=None):
+    """部分要約を統合して最終的な要約を作成"""
+    combined = "\n\n".join(partials)
+    
+    if is_weekly:
+        prompt = f"""以下は1週間分のDiscordチャンネルの会話を部分ごとに要約したメモです。これらを統合し、1週間の活動を俯瞰的に要約してください。
+
+{combined}
+
+{WEEKLY_SUMMARY_INSTRUCTIONS}"""
+    else:
+        prompt = f"""以下はDiscordチャンネルの会話を部分ごとに要約したメモです。これらを統合して要約してください。
+
+{combined}
+
+{SUMMARY_INSTRUCTIONS}"""
+    
+    return await generate_with_gemini(prompt, route='weekly' if is_weekly else 'standard', on_text=on_text)
+
+async def summarize_hierarchical(units, is_weekly=False, on_text=None):
+    """部分要約を並列に生成し、それらを統合して最終的な要約を作成"""
+    results = await asyncio.gather(*(summarize_map_unit(unit) for unit in units))
+    return await reduce_partial_summaries([text for text, _ in results], is_weekly=is_weekly, on_text=on_text)
+
+def slice_messages(messages_by_channel, start_ts, end_ts):
+    """[start_ts, end_ts) のメッセージをチャンネルごとに切り出す"""
+    sliced = {}
+    for channel_name, messages in messages_by_channel.items():
+        lo = bisect_left(messages, start_ts, key=lambda m: m.ts)
+        hi = bisect_left(messages, end_ts, key=lambda m: m.ts)
+        if hi > lo:
+            sliced[channel_name] = messages[lo:hi]
+    return sliced
+
+def get_fingerprint(messages_by_channel):
+    """メッセージ集合のフィンガープリント（件数, 最大メッセージID）"""
+    count = sum(len(messages) for messages in messages_by_channel.values())
+    last_id = max((messages[-1].message_id for messages in messages_by_channel.values() if messages), default=0)
+    return count, last_id
+
+def get_complete_blocks(start_ts, end_ts, guild_id=None):
+    """期間内に完全に含まれるチェックポイントのブロック開始時刻の一覧"""
+    size = CHECKPOINT_BLOCK_HOURS * 3600
+    block_start = get_block_start(start_ts, guild_id)
+    if block_start < start_ts:
+        block_start += size
+    blocks = []
+    while block_start + size <= end_ts:
+        blocks.append(block_start)
+        block_start += size
+    return blocks
+
+async def save_checkpoint(guild_id, block_start, fingerprint, summary):
+    """ブロックの要約チェックポイントを保存"""
+    summary_checkpoints[guild_id][block_start] = (fingerprint, summary)
+    if message_store:
+        try:
+            await message_store.save_checkpoint(guild_id, block_start, fingerprint, summary)
+        except Exception as e:
+            print(f"チェックポイント保存エラー: {e}")
+
+async def summarize_block(guild_id, block_start, block_messages):
+    """ブロックの部分要約を返す（メッセージが変わっていなければ保存済みのチェックポイントを再利用）"""
+    fingerprint = get_fingerprint(block_messages)
+    checkpoint = summary_checkpoints[guild_id].get(block_start)
+    if checkpoint and checkpoint[0] == fingerprint:
+        return checkpoint[1], True
+    
+    results = await asyncio.gather(*(summarize_map_unit(unit) for unit in split_into_map_units(block_messages)))
+    summary = "\n\n".join(text for text, _ in results)
+    
+    # 簡易要約で代替した部分を含む場合は保存しない
+    if all(ok for _, ok in results):
+        await save_checkpoint(guild_id, block_start, fingerprint, summary)
+    return summary, False
+
+async def summarize_with_checkpoints(guild_id, messages_by_channel, blocks, window, is_weekly=False, on_text=None):
+    """完了済みブロックはチェックポイント、それ以外は新しいメッセージだけを部分要約して統合"""
+    start_ts, end_ts = window
+    size = CHECKPOINT_BLOCK_HOURS * 3600
+    
+    head_units = split_into_map_units(slice_messages(messages_by_channel, start_ts, blocks[0]))
+    tail_units = split_into_map_units(slice_messages(messages_by_channel, blocks[-1] + size, end_ts + 1))
+    block_items = []
+    for block_start in blocks:
+        block_messages = slice_messages(messages_by_channel, block_start, block_start + size)
+        if block_messages:
+            block_items.append((block_start, block_messages))
+    
+    head_results, block_results, tail_results = await asyncio.gather(
+        asyncio.gather(*(summarize_map_unit(unit) for unit in head_units)),
+        asyncio.gather(*(summarize_block(guild_id, block_start, block_messages) for block_start, block_messages in block_items)),
+        asyncio.gather(*(summarize_map_unit(unit) for unit in tail_units)),
+    )
+    reused = sum(1 for _, was_reused in block_results if was_reused)
+    print(f"チェックポイント: {len(block_items)}ブロック中{reused}ブロックを保存済みの要約から構築")
+    
+    results = [*head_results, *block_results, *tail_results]
+    return await reduce_partial_summaries([text for text, _ in results], is_weekly=is_weekly, on_text=on_text)
+
+class QuotaExceededError(Exception):
+    """待機できる時間内に利用枠の空きができない"""
+
+# API呼び出しの優先度（小さいほど先に実行）。要約を開始する側で (種類, サーバーのメッセージ数) を設定する
+PRIORITY_SCHEDULED = 0
+PRIORITY_MANUAL = 1
+gemini_priority = contextvars.ContextVar('gemini_priority', default=(PRIORITY_MANUAL, 0))
+
+class TokenBucket:
+    """容量capacityで、空の状態からperiod秒で満タンまで回復するトークンバケット（1分あたりの利用枠）"""
+    __slots__ = ('capacity', 'rate', 'level', 'updated')
+    
+    def __init__(self, capacity, period):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.level = float(capacity)
+        self.updated = time.time()
+    
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def wait_time(self, amount, now):
+        """amountを取り出せるまでの秒数（容量を超える量は容量として扱う）"""
+        self.refill(now)
+        return max(0.0, (min(amount, self.capacity) - self.level) / self.rate)
+    
+    def take(self, amount):
+        # 推定より実際の使用量が多かった場合はマイナスになり、その分だけ後の呼び出しが待つ
+        self.level -= amount
+    
+    def remaining(self, now):
+        self.refill(now)
+        return self.level
+    
+    def restore(self, level, updated):
+        self.level = min(level, self.capacity)
+        self.updated = updated
+    
+    def state(self):
+        return self.level, self.updated
+
+def get_quota_timezone():
+    try:
+        return ZoneInfo(GEMINI_QUOTA_TIMEZONE)
+    except ZoneInfoNotFoundError:
+        return timezone.utc
+
+def get_quota_date(now):
+    """now（エポック秒）の利用枠の日付（GEMINI_QUOTA_TIMEZONEでの日付）"""
+    return str(datetime.fromtimestamp(now, get_quota_timezone()).date())
+
+def get_quota_day(now):
+    """now（エポック秒）を含む利用枠の1日の (開始, 終了) をエポック秒で返す（GEMINI_QUOTA_TIMEZONEの0時区切り）"""
+    tz = get_quota_timezone()
+    day = datetime.fromtimestamp(now, tz).date()
+    start = datetime(day.year, day.month, day.day, tzinfo=tz)
+    return start.timestamp(), (start + timedelta(days=1)).timestamp()
+
+class DailyCounter:
+    """1日あたりの利用枠。使用量を数え、日付が変わった時点で0に戻す（少しずつ回復はしない）"""
+    __slots__ = ('capacity', 'used', 'day')
+    
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.used = 0.0
+        self.day = get_quota_day(time.time())[0]
+    
+    def reset(self, now):
+        day = get_quota_day(now)[0]
+        if day != self.day:
+            self.day = day
+            self.used = 0.0
+    
+    def wait_time(self, amount, now):
+        """amountを使えるまでの秒数（その日の枠が足りなければ翌日の0時まで）"""
+        self.reset(now)
+        if self.used + min(amount, self.capacity) <= self.capacity:
+            return 0.0
+        return get_quota_day(now)[1] - now
+    
+    def take(self, amount):
+        self.used = max(self.used + amount, 0.0)
+    
+    def remaining(self, now):
+        self.reset(now)
+        return self.capacity - self.used
+    
+    def restore(self, used, day):
+        self.used = used
+        self.day = day
+    
+    def state(self):
+        return self.used, self.day
+
+class QuotaGovernor:
+    """Gemini APIの利用枠を管理する
+    
+    リクエスト数と入力トークン数のそれぞれに1分のトークンバケットと1日の使用量のカウンター
+    （GEMINI_QUOTA_TIMEZONEの0時にリセット）を持ち、すべてに空きができるまで呼び出しを待機させる。
+    待機中の呼び出しは優先度（定期要約 → 手動要約、メッセージ数の少ないサーバーから）の順に1つずつ実行を許可する。
+    使用量は失敗・タイムアウト・再試行も含めて送信する時点で数え、完了後に実際の入力トークン数で補正する。
+    バケットの残量と日ごとの使用量はMessageStoreに保存し、再起動後も引き継ぐ。
+    WORKER_COUNTが2以上かBOT_ROLEがall以外の場合（shared）はバケットをMessageStore上で全プロセスが共有し、
+    取り出しのたびにトランザクション内で残量を読み書きする。self.bucketsは表示用の最新の値になる。
+    """
+    
+    def __init__(self):
+        self.buckets = {}
+        for name, capacity in (('rpm', GEMINI_RPM), ('rpd', GEMINI_RPD), ('tpm', GEMINI_TPM), ('tpd', GEMINI_TPD)):
+            if capacity > 0:
+                self.buckets[name] = TokenBucket(capacity, 60) if name.endswith('m') else DailyCounter(capacity)
+        self.waiters = []  # (優先度, 連番)
+        self.counter = itertools.count()
+        self.changed = asyncio.Event()
+        self.usage = {'date': get_quota_date(time.time()), 'requests': 0, 'input_tokens': 0, 'output_tokens': 0}
+        self.stats = {'waited': 0, 'wait_seconds': 0.0, 'rejected': 0}
+        self.dirty = False
+        self.shared = (WORKER_COUNT > 1 or BOT_ROLE != 'all') and message_store is not None
+        # sharedの場合にまだMessageStoreへ反映していない使用量と、入力トークン数の推定との差
+        self.unsynced = {'requests': 0, 'input_tokens': 0, 'output_tokens': 0, 'adjust': 0}
+    
+    def costs(self, tokens):
+        return {'rpm': 1, 'rpd': 1, 'tpm': tokens, 'tpd': tokens}
+    
+    def wait_time(self, tokens):
+        """すべてのバケットに空きができるまでの秒数"""
+        now = time.time()
+        costs = self.costs(tokens)
+        return max((bucket.wait_time(costs[name], now) for name, bucket in self.buckets.items()), default=0.0)
+    
+    def sync_buckets(self, rows, update):
+        """共有のバケットの残量をself.bucketsに読み込み、update()の後の残量を書き込む行と返す"""
+        for name, (level, updated) in rows.items():
+            bucket = self.buckets.get(name)
+            if bucket:
+                bucket.restore(level, updated)
+        result = update()
+        return result, [(name, *bucket.state()) for name, bucket in self.buckets.items()]
+    
+    def take_now(self, tokens):
+        """すべてのバケットに空きがあれば取り出して0を、なければ空くまでの秒数を返す"""
+        delay = self.wait_time(tokens)
+        if delay <= 0:
+            costs = self.costs(tokens)
+            for name, bucket in self.buckets.items():
+                bucket.take(costs[name])
+        return delay
+    
+    async def reserve(self, tokens):
+        if not self.shared or not self.buckets:
+            delay = self.take_now(tokens)
+        else:
+            delay = await asyncio.to_thread(
+                message_store.update_quota_state, lambda rows: self.sync_buckets(rows, lambda: self.take_now(tokens)))
+        if delay <= 0:
+            self.count_request(tokens)
+        return delay
+    
+    async def acquire(self, tokens, timeout=None):
+        """入力トークン数tokensの呼び出しの実行許可を待つ
+        
+        待ち行列の先頭になり、かつ利用枠に空きができた時点で戻る。
+        timeout秒（省略時はGEMINI_QUEUE_TIMEOUT秒）以内に空きができない場合はQuotaExceededErrorを送出する。
+        """
+        timeout = GEMINI_QUEUE_TIMEOUT if timeout is None else timeout
+        entry = (gemini_priority.get(), next(self.counter))
+        heapq.heappush(self.waiters, entry)
+        started = time.monotonic()
+        try:
+            while True:
+                # 状態を確認する前の通知を受け取れるよう、先にイベントを取り出しておく
+                changed = self.changed
+                remaining = timeout - (time.monotonic() - started)
+                delay = await self.reserve(tokens) if self.waiters[0] == entry else remaining
+                if delay <= 0 and self.waiters[0] == entry:
+                    break
+                if delay > remaining or remaining <= 0:
+                    if self.waiters[0] == entry or remaining <= 0:
+                        self.stats['rejected'] += 1
+                        raise QuotaExceededError(f"Gemini APIの利用枠に{timeout:.0f}秒以内に空きができません")
+                    delay = remaining
+                
+                # 先頭の呼び出しが抜けるか、空きができるまで待つ
+                try:
+                    await asyncio.wait_for(changed.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.waiters.remove(entry)
+            heapq.heapify(self.waiters)
+            # 待機中の全員に通知し、次の待機には新しいイベントを使う（clear()で他の呼び出しへの通知を消さない）
+            self.changed.set()
+            self.changed = asyncio.Event()
+        
+        waited = time.monotonic() - started
+        if waited > 1:
+            self.stats['waited'] += 1
+            self.stats['wait_seconds'] += waited
+    
+    def roll_usage(self):
+        today = get_quota_date(time.time())
+        if self.usage['date'] != today:
+            self.usage = {'date': today, 'requests': 0, 'input_tokens': 0, 'output_tokens': 0}
+    
+    def count_request(self, tokens):
+        """送信する呼び出しを推定の入力トークン数で使用量に数える"""
+        self.roll_usage()
+        self.usage['requests'] += 1
+        self.usage['input_tokens'] += tokens
+        if self.shared:
+            self.unsynced['requests'] += 1
+            self.unsynced['input_tokens'] += tokens
+        self.dirty = True
+    
+    def record(self, estimated_tokens, input_tokens, output_tokens):
+        """完了した呼び出しの実際の使用量を記録（入力トークンの推定との差を使用量とバケットに反映）"""
+        self.roll_usage()
+        self.usage['input_tokens'] += input_tokens - estimated_tokens
+        self.usage['output_tokens'] += output_tokens
+        
+        if self.shared:
+            self.unsynced['input_tokens'] += input_tokens - estimated_tokens
+            self.unsynced['output_tokens'] += output_tokens
+            self.unsynced['adjust'] += input_tokens - estimated_tokens
+        else:
+            self.adjust_tokens(input_tokens - estimated_tokens)
+        self.dirty = True
+    
+    def adjust_tokens(self, amount):
+        for name in ('tpm', 'tpd'):
+            if name in self.buckets:
+                self.buckets[name].take(amount)
+    
+    def today(self):
+        """本日の使用量（日付が変わっていれば0）"""
+        today = get_quota_date(time.time())
+        if self.usage['date'] != today:
+            return {'date': today, 'requests': 0, 'input_tokens': 0, 'output_tokens': 0}
+        return self.usage
+    
+    async def load(self):
+        """保存済みのバケットの残量と本日の使用量を復元"""
+        buckets, usage = await asyncio.to_thread(message_store.read_quota_state, self.usage['date'])
+        for name, (level, updated) in buckets.items():
+            bucket = self.buckets.get(name)
+            if bucket:
+                bucket.restore(level, updated)
+        if usage:
+            self.usage['requests'], self.usage['input_tokens'], self.usage['output_tokens'] = usage
+    
+    async def save(self):
+        if not self.dirty:
+            return
+        self.dirty = False
+        if self.shared:
+            await self.save_shared()
+            return
+        rows = [(name, *bucket.state()) for name, bucket in self.buckets.items()]
+        try:
+            await message_store.save_quota_state(rows, dict(self.usage))
+        except Exception:
+            self.dirty = True
+            raise
+    
+    async def save_shared(self):
+        """未反映の使用量を共有の使用量に加算し、入力トークン数の推定との差を共有のバケットに反映"""
+        unsynced, self.unsynced = self.unsynced, {'requests': 0, 'input_tokens': 0, 'output_tokens': 0, 'adjust': 0}
+        date = self.usage['date']
+        try:
+            totals = await asyncio.to_thread(message_store.add_api_usage, date, unsynced['requests'],
+                                             unsynced['input_tokens'], unsynced['output_tokens'])
+        except Exception:
+            for key, value in unsynced.items():
+                self.unsynced[key] += value
+            self.dirty = True
+            raise
+        
+        # 他のプロセスの使用量を含む合計で表示を更新
+        if self.usage['date'] == date:
+            self.usage['requests'], self.usage['input_tokens'], self.usage['output_tokens'] = (
+                total + self.unsynced[key] for total, key in zip(totals, ('requests', 'input_tokens', 'output_tokens')))
+        
+        if unsynced['adjust'] and self.buckets:
+            try:
+                await asyncio.to_thread(message_store.update_quota_state,
+                                        lambda rows: self.sync_buckets(rows, lambda: self.adjust_tokens(unsynced['adjust'])))
+            except Exception:
+                self.unsynced['adjust'] += unsynced['adjust']
+                self.dirty = True
+                raise
+
+quota_governor = QuotaGovernor()
+
+class CircuitOpenError(Exception):
+    """サーキットブレーカーが開いていてモデルを呼び出せない"""
+
+class CircuitBreaker:
+    """モデルごとのサーキットブレーカー
+    
+    closed: 通常どおり呼び出す
+    open: BREAKER_THRESHOLD回連続で一時的なエラーが発生した後、BREAKER_COOLDOWN秒は呼び出さない
+    half_open: 待機後に1件だけ試行し、成功すればclosed、失敗すれば再びopen
+    """
+    
+    def __init__(self, model):
+        self.model = model
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_started = None
+        self.last_error = None
+        self.stats = {'opened': 0, 'short_circuited': 0, 'failures': 0}
+    
+    def allow(self):
+        now = time.monotonic()
+        if self.state == 'open' and now - self.opened_at >= BREAKER_COOLDOWN:
+            self.state = 'half_open'
+            self.trial_started = None
+        if self.state == 'half_open':
+            # 試行中の呼び出しがキャンセルなどで結果を返さなかった場合も、GEMINI_TIMEOUT後に次の試行を許可
+            if self.trial_started is None or now - self.trial_started > GEMINI_TIMEOUT:
+                self.trial_started = now
+                return True
+        elif self.state == 'closed':
+            return True
+        self.stats['short_circuited'] += 1
+        return False
+    
+    def success(self):
+        if self.state != 'closed':
+            print(f"[{datetime.now()}] {self.model} の呼び出しを再開しました")
+        self.state = 'closed'
+        self.failures = 0
+    
+    def release(self):
+        """結果が判定に使えない呼び出し（リクエスト自体の問題など）の試行枠を状態を変えずに返す"""
+        if self.state == 'half_open':
+            self.trial_started = None
+    
+    def failure(self, error):
+        self.failures += 1
+        self.stats['failures'] += 1
+        self.last_error = f"{type(error).__name__}: {error}"[:200]
+        if self.state == 'half_open' or (self.state == 'closed' and self.failures >= BREAKER_THRESHOLD):
+            self.state = 'open'
+            self.opened_at = time.monotonic()
+            self.stats['opened'] += 1
+            print(f"[{datetime.now()}] ⚠️ {self.model} で{self.failures}回連続でエラーが発生したため{BREAKER_COOLDOWN:.0f}秒間呼び出しを停止します")
+    
+    def describe(self):
+        if self.state == 'open':
+            remaining = max(BREAKER_COOLDOWN - (time.monotonic() - self.opened_at), 0)
+            return f"🔴 停止中（あと{remaining:.0f}秒）"
+        if self.state == 'half_open':
+            return "🟡 試行中"
+        return "🟢 正常"
+
+circuit_breakers = {}
+
+def get_circuit_breaker(model):
+    if model not in circuit_breakers:
+        circuit_breakers[model] = CircuitBreaker(model)
+    return circuit_breakers[model]
+
+# 要約全体の期限（イベントループの時刻）。要約を開始する側で設定し、部分要約や再試行もこの期限内に収める
+gemini_deadline = contextvars.ContextVar('gemini_deadline', default=None)
+
+def is_transient_error(error):
+    """再試行やブレーカーの対象となる一時的なエラーか（タイムアウト、レート制限、サーバーエラー、通信エラー）"""
+    if isinstance(error, (asyncio.TimeoutError, ConnectionError)):
+        return True
+    if isinstance(error, genai_errors.APIError):
+        return error.code in (408, 429, 500, 502, 503, 504)
+    return False
+
+async def call_gemini_model(model, prompt, max_output_tokens, prompt_tokens, deadline, on_text=None):
+    """1つのモデルを一時的なエラーの再試行付きで呼び出し、(テキスト, 入力トークン数, 出力トークン数) を返す
+    
+    再試行の待機時間は指数的に増やしてジッターを加え、期限を超える再試行はしない。
+    on_textを指定するとストリーミングで生成し、チャンクを受け取るたびに途中までのテキストで呼び出す
+    （再試行した場合は最初からのテキストになる）。
+    """
+    loop = asyncio.get_running_loop()
+    breaker = get_circuit_breaker(model)
+    config = types.GenerateContentConfig(
+        temperature=0.3,
+        max_output_tokens=max_output_tokens,
+    )
+    
+    async def request():
+        if on_text is None:
+            response = await client.aio.models.generate_content(model=model, contents=prompt, config=config)
+            return response.text, response.usage_metadata
+        
+        parts = []
+        usage = None
+        async for chunk in await client.aio.models.generate_content_stream(model=model, contents=prompt, config=config):
+            if chunk.text:
+                parts.append(chunk.text)
+                on_text("".join(parts))
+            usage = chunk.usage_metadata or usage
+        return "".join(parts), usage
+    
+    for attempt in range(GEMINI_RETRIES + 1):
+        if not breaker.allow():
+            raise CircuitOpenError(f"{model} は停止中です（{breaker.last_error}）")
+        
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            raise asyncio.TimeoutError()
+        await quota_governor.acquire(prompt_tokens, timeout=min(GEMINI_QUEUE_TIMEOUT, remaining))
+        
+        try:
+            timeout = min(GEMINI_TIMEOUT, deadline - loop.time())
+            if timeout <= 0:
+                raise asyncio.TimeoutError()
+            async with gemini_semaphore:
+                started = time.perf_counter()
+                try:
+                    text, usage = await asyncio.wait_for(request(), timeout=timeout)
+                except Exception:
+                    metrics.observe('gemini_request_seconds', time.perf_counter() - started, model=model, outcome='error')
+                    raise
+                metrics.observe('gemini_request_seconds', time.perf_counter() - started, model=model, outcome='ok')
+        except Exception as e:
+            if not is_transient_error(e):
+                # リクエスト自体の問題なのでAPIの障害としても回復としても数えない
+                breaker.release()
+                raise
+            breaker.failure(e)
+            
+            delay = min(GEMINI_RETRY_BASE * 2 ** attempt, 60) * random.uniform(0.5, 1.0)
+            if attempt == GEMINI_RETRIES or loop.time() + delay >= deadline:
+                raise
+            print(f"Gemini API 一時的なエラー（{model}, {attempt + 1}回目）: {type(e).__name__} {e} - {delay:.1f}秒後に再試行")
+            await asyncio.sleep(delay)
+            continue
+        
+        breaker.success()
+        input_tokens = getattr(usage, 'prompt_token_count', None) or prompt_tokens
+        output_tokens = getattr(usage, 'candidates_token_count', None) or 0
+        quota_governor.record(prompt_tokens, input_tokens, output_tokens)
+        metrics.inc('gemini_tokens_total', input_tokens, model=model, direction='input')
+        metrics.inc('gemini_tokens_total', output_tokens, model=model, direction='output')
+        return text, input_tokens, output_tokens
+
+def select_route(prompt, message_count, is_weekly=False):
+    """要約のプロンプトの規模と期間の種類からモデルの振り分け先を選ぶ"""
+    if is_weekly:
+        return 'weekly'
+    if estimate_tokens(prompt) <= ROUTE_SMALL_TOKENS and message_count <= ROUTE_SMALL_MESSAGES:
+        return 'small'
+    return 'standard'
+
+async def generate_with_gemini(prompt, route='standard', on_text=None):
+    """Gemini APIを非同期クライアントで呼び出す
+    
+    モデルと最大出力トークン数はMODEL_ROUTES[route]で決まり、振り分け先ごとに応答時間とトークン数を記録する。
+    呼び出しはquota_governorで利用枠に空きができるまで待機する（空かなければQuotaExceededError）。
+    同時実行数はGEMINI_CONCURRENCYで制限され、1回の呼び出しはGEMINI_TIMEOUT秒か要約全体の期限で
+    キャンセルされる。一時的なエラーは再試行し、モデルが停止中（サーキットブレーカーが開いている）
+    か再試行しても失敗した場合はFALLBACK_MODELで生成する。どちらも使えなければ例外を送出し、
+    呼び出し元は簡易要約にフォールバックする。
+    on_textを指定するとストリーミングで生成する（call_gemini_model参照）。
+    呼び出し元のタスクがキャンセルされた場合もAPI呼び出しごとキャンセルされる（get_or_create_summaryで
+    同じ要約を複数の呼び出し元が待っている場合は、全員がキャンセルされるまで呼び出しを続ける）。
+    """
+    prompt_tokens = estimate_tokens(prompt)
+    prompt_size_stats['calls'] += 1
+    prompt_size_stats['total_tokens'] += prompt_tokens
+    prompt_size_stats['max_tokens'] = max(prompt_size_stats['max_tokens'], prompt_tokens)
+    metrics.observe('prompt_tokens', prompt_tokens, route=route)
+    
+    settings = MODEL_ROUTES[route]
+    deadline = gemini_deadline.get() or asyncio.get_running_loop().time() + SUMMARY_DEADLINE
+    models = [settings['model']]
+    if FALLBACK_MODEL and FALLBACK_MODEL != settings['model']:
+        models.append(FALLBACK_MODEL)
+    
+    for index, model in enumerate(models):
+        # 応答時間とトークン数は実際に生成したモデルの分として記録する
+        stats = route_stats[(route, model)]
+        started = time.monotonic()
+        try:
+            text, input_tokens, output_tokens = await call_gemini_model(
+                model, prompt, settings['max_output_tokens'], prompt_tokens, deadline, on_text=on_text)
+        except Exception as e:
+            if index == len(models) - 1 or not (isinstance(e, CircuitOpenError) or is_transient_error(e)):
+                stats['errors'] += 1
+                raise
+            stats['errors'] += 1
+            print(f"{model} が利用できないため {models[index + 1]} で生成します: {type(e).__name__} {e}")
+            metrics.inc('fallback_total', kind='model', stage=route,
+                        reason='circuit_open' if isinstance(e, CircuitOpenError) else 'transient')
+            continue
+        
+        stats['calls'] += 1
+        stats['input_tokens'] += input_tokens
+        stats['output_tokens'] += output_tokens
+        stats['latencies'].append(time.monotonic() - started)
+        return text
+
+async def generate_summary(messages_by_channel, is_weekly=False, guild_id=None, window=None, on_text=None):
+    """要約を生成（API呼び出しの失敗は例外として呼び出し元に伝える）
+    
+    on_textを指定すると、最終的な要約（統合）の生成中に途中までのテキストで呼び出される。
+    """
+    blocks = get_complete_blocks(*window, guild_id) if guild_id is not None and window else []
+    
+    # 週次や大量のメッセージは部分要約を並列に作ってから統合し、全メッセージを対象にする
+    total_messages = sum(len(messages) for messages in messages_by_channel.values())
+    needs_hierarchical = (
+        is_weekly or total_messages > HIERARCHICAL_THRESHOLD or
+        sum(message_tokens(msg) for messages in messages_by_channel.values() for msg in messages) > PROMPT_TOKEN_BUDGET
+    )
+    units = split_into_map_units(messages_by_channel) if needs_hierarchical else []
+    
+    if len(blocks) > 1:
+        return await summarize_with_checkpoints(guild_id, messages_by_channel, blocks, window, is_weekly=is_weekly, on_text=on_text)
+    if len(units) > 1:
+        return await summarize_hierarchical(units, is_weekly=is_weekly, on_text=on_text)
+    
+    prompt = build_summary_prompt(messages_by_channel, is_weekly=is_weekly)
+    
+    # APIを呼び出し（規模に応じてモデルと出力の長さを選ぶ）
+    text = await generate_with_gemini(prompt, route=select_route(prompt, total_messages, is_weekly=is_weekly), on_text=on_text)
+    
+    # 期間がちょうど1ブロックなら、後の長期間の要約で再利用できるよう保存
+    if text and len(blocks) == 1 and window[0] == blocks[0]:
+        block_messages = slice_messages(messages_by_channel, blocks[0], blocks[0] + CHECKPOINT_BLOCK_HOURS * 3600)
+        if get_fingerprint(block_messages) == get_fingerprint(messages_by_channel):
+            await save_checkpoint(guild_id, blocks[0], get_fingerprint(block_messages), text)
+    return text
+
+async def get_or_create_summary(key, factory):
+    """キャッシュ済みの要約を返すか、生成中の同じ要約に合流するか、新しく生成する
+    
+    生成に成功した要約だけをSUMMARY_CACHE_TTL秒キャッシュし、件数がSUMMARY_CACHE_SIZEを
+    超えたら最も長く使われていないものから削除する。呼び出し元がキャンセルされても生成は
+    合流している他の呼び出し元のために続け、待っている呼び出し元がすべてキャンセルされた時点で止める。
+    """
+    loop = asyncio.get_running_loop()
+    cached = summary_cache.get(key)
+    if cached and cached[0] > loop.time():
+        summary_cache.move_to_end(key)
+        summary_cache_stats['hits'] += 1
+        return cached[1]
+    
+    entry = inflight_summaries.get(key)
+    if entry:
+        summary_cache_stats['joined'] += 1
+    else:
+        summary_cache_stats['misses'] += 1
+        
+        async def run():
+            try:
+                text = await factory()
+                if text:
+                    summary_cache[key] = (loop.time() + SUMMARY_CACHE_TTL, text)
+                    summary_cache.move_to_end(key)
+                    while len(summary_cache) > SUMMARY_CACHE_SIZE:
+                        summary_cache.popitem(last=False)
+                return text
+            finally:
+                if inflight_summaries.get(key) is entry:
+                    del inflight_summaries[key]
+        
+        entry = inflight_summaries[key] = [None, 0]
+        entry[0] = asyncio.create_task(run())
+    
+    # 呼び出し元がキャンセルされても、合流している他の呼び出し元のために生成は続ける
+    task = entry[0]
+    entry[1] += 1
+    try:
+        return await asyncio.shield(task)
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0 and not task.done():
+            # 待っている呼び出し元がいなくなれば生成もキャンセルし、以降の呼び出しは新しく生成する
+            if inflight_summaries.get(key) is entry:
+                del inflight_summaries[key]
+            task.cancel()
+
+async def summarize_all_channels(messages_by_channel, is_weekly=False, guild_id=None, window=None, on_text=None,
+                                 fallback=True):
+    """全チャンネルのメッセージを統合して要約する関数
+    
+    guild_id と window（開始, 終了のエポック秒）を指定すると、期間に含まれる完了済みの
+    時間ブロックは保存済みのチェックポイントから構築し、新しいメッセージだけを要約する。
+    同じサーバー・期間・メッセージの要約はキャッシュから返し、生成中なら合流する。
+    on_textは新しく生成する場合だけ途中経過で呼び出される（generate_summary参照）。
+    fallback=Falseの場合はAPIのエラーで簡易要約にせず例外を送出する（要約ジョブの再試行用）。
+    """
+    if not any(messages_by_channel.values()):
+        return "要約するメッセージがありません。"
+    
+    # 部分要約や再試行を含めて要約全体をSUMMARY_DEADLINE秒以内に収める
+    deadline_token = gemini_deadline.set(asyncio.get_running_loop().time() + SUMMARY_DEADLINE)
+    try:
+        if guild_id is not None and window:
+            key = (guild_id, round((window[1] - window[0]) / 3600), is_weekly, get_fingerprint(messages_by_channel))
+            text = await get_or_create_summary(
+                key, lambda: generate_summary(messages_by_channel, is_weekly=is_weekly, guild_id=guild_id, window=window,
+                                              on_text=on_text)
+            )
+        else:
+            text = await generate_summary(messages_by_channel, is_weekly=is_weekly, on_text=on_text)
+        
+        # レスポンスのテキストを取得
+        if text:
+            return text
+        else:
+            return "要約の生成に失敗しました。"
+    
+    except asyncio.TimeoutError:
+        if not fallback:
+            raise
+        print(f"Gemini API タイムアウト（1回{GEMINI_TIMEOUT:.0f}秒 / 要約全体{SUMMARY_DEADLINE:.0f}秒）")
+        metrics.inc('fallback_total', kind='simple', stage='summary', reason='timeout')
+        return generate_simple_summary(messages_by_channel)
+    except QuotaExceededError as e:
+        if not fallback:
+            raise
+        print(f"Gemini API 利用枠超過: {e}")
+        metrics.inc('fallback_total', kind='simple', stage='summary', reason='quota')
+        return generate_simple_summary(messages_by_channel)
+    except CircuitOpenError as e:
+        if not fallback:
+            raise
+        print(f"Gemini API 停止中のため簡易要約を使用: {e}")
+        metrics.inc('fallback_total', kind='simple', stage='summary', reason='circuit_open')
+        return generate_simple_summary(messages_by_channel)
+    except Exception as e:
+        if not fallback:
+            raise
+        print(f"Gemini API エラー: {e}")
+        metrics.inc('fallback_total', kind='simple', stage='summary', reason='error')
+        return generate_simple_summary(messages_by_channel)
+    finally:
+        gemini_deadline.reset(deadline_token)
+
+async def get_or_create_bot_channel(guild):
+    """Bot用チャンネルを取得または作成"""
+    # 既存のbot-summariesチャンネルを探す
     for channel in guild.text_channels:
         if channel.name == BOT_CHANNEL_NAME:
             return channel
@@ -244,8 +2484,11 @@ async def get_or_create_bot_channel(guild):
         print(f"チャンネル作成権限がありません: {guild.name}")
         return None
 
-def create_server_summary_embed(guild, messages_by_channel, time_description, color=discord.Color.blue(), is_weekly=False):
-    """サーバー全体の要約用Embedを作成"""
+def create_stats_embed(guild_id, window, time_description, color=discord.Color.blue(), is_weekly=False):
+    """統計情報だけの要約用Embedを作成（要約本文はdescriptionに後から設定する）
+    
+    統計はバッファの1時間ごとの集計から求める（get_window_stats参照）。
+    """
     embed = discord.Embed(
         title=f"📋 {time_description}",
         color=color,
@@ -253,118 +2496,971 @@ def create_server_summary_embed(guild, messages_by_channel, time_description, co
     )
     
     # 全体の統計
-    total_messages = sum(len(messages) for messages in messages_by_channel.values())
-    active_channels = len([ch for ch, msgs in messages_by_channel.items() if msgs])
-    all_authors = set()
-    for messages in messages_by_channel.values():
-        for msg in messages:
-            all_authors.add(msg.author)
+    stats = get_window_stats(guild_id, *window)
+    active_channels = len(stats['channels'])
+    
+    # 統計情報を簡潔に
+    stats_text = f"💬 {stats['total']}件 | 📍 {active_channels}ch | 👥 {len(stats['authors'])}人"
+    embed.add_field(
+        name="📊 統計",
+        value=stats_text,
+        inline=False
+    )
+    
+    # チャンネル別の活動状況（週次サマリーの場合はTOP5）
+    if active_channels > 0:
+        channel_stats = []
+        top_count = 5 if is_weekly else 3
+        for channel_name, count in sorted(stats['channels'].items(), 
+                                          key=lambda x: x[1], 
+                                          reverse=True)[:top_count]:
+            channel_stats.append(f"**#{channel_name}**: {count}件")
+        
+        if channel_stats:
+            embed.add_field(
+                name="🔥 活発なチャンネル",
+                value=" / ".join(channel_stats),
+                inline=False
+            )
+    
+    return embed
+
+async def create_server_summary_embed(guild, messages_by_channel, window, time_description, color=discord.Color.blue(), is_weekly=False):
+    """サーバー全体の要約用Embedを作成（windowはmessages_by_channelを取得した期間 (開始, 終了)）"""
+    embed = create_stats_embed(guild.id, window, time_description, color, is_weekly=is_weekly)
+    
+    # 要約内容
+    summary = await summarize_all_channels(messages_by_channel, is_weekly=is_weekly, guild_id=guild.id, window=window)
+    
+    # 要約をそのまま追加
+    embed.description = summary
+    
+    return embed
+
+class EmbedStreamer:
+    """生成途中の要約を一定間隔でEmbedのdescriptionに反映する
+    
+    update()は最新のテキストを記録するだけで、編集はSTREAM_EDIT_INTERVAL秒ごとに最大1回、
+    最新のテキストでまとめて行う。finish()で最終的な要約に置き換える。
+    """
+    
+    def __init__(self, message, embed):
+        self.message = message
+        self.embed = embed
+        self.text = None
+        self.task = None
+    
+    def update(self, text):
+        self.text = text
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+    
+    async def run(self):
+        shown = None
+        while self.text != shown:
+            shown = self.text
+            self.embed.description = truncate_description(shown + " ▌")
+            try:
+                started = time.perf_counter()
+                await self.message.edit(embed=self.embed)
+                metrics.observe('discord_send_seconds', time.perf_counter() - started, kind='stream_edit')
+            except discord.HTTPException as e:
+                print(f"要約の途中経過の表示エラー: {e}")
+            await asyncio.sleep(STREAM_EDIT_INTERVAL)
+    
+    async def finish(self, summary):
+        if self.task:
+            # 送信中の途中経過が最終的な要約の後に反映されないよう、終了を待ってから編集する
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        self.embed.description = truncate_description(summary)
+        started = time.perf_counter()
+        await self.message.edit(embed=self.embed)
+        metrics.observe('discord_send_seconds', time.perf_counter() - started, kind='manual')
+
+def truncate_description(text, limit=4096):
+    """Embedのdescriptionの上限に収まるよう切り詰める"""
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+async def setup_guild(guild):
+    """サーバーの初期設定"""
+    guild_id = guild.id
+    
+    # Bot用チャンネルを取得または作成
+    bot_channel = await get_or_create_bot_channel(guild)
+    
+    server_configs[guild_id] = {
+        'summary_channel': bot_channel,
+        'enabled': True,
+        'timezone': DEFAULT_TIMEZONE,
+        'schedule_hours': None,  # Noneはデフォルトのスケジュール
+    }
+    
+    # 保存済みの設定を反映（複数プロセスで実行している場合は他のプロセスで変更した設定も引き継ぐ）
+    if message_store:
+        settings = await asyncio.to_thread(message_store.read_guild_settings, guild_id)
+        config = server_configs[guild_id]
+        for key in ('timezone', 'schedule_hours'):
+            if settings.get(key):
+                config[key] = settings[key]
+        if settings.get('enabled') is not None:
+            config['enabled'] = settings['enabled']
+        saved_channel = guild.get_channel(settings['summary_channel_id']) if settings.get('summary_channel_id') else None
+        if saved_channel:
+            config['summary_channel'] = saved_channel
+            bot_channel = saved_channel
+    await summary_scheduler.schedule_guild(guild_id)
+    
+    if bot_channel:
+        print(f"サーバー '{guild.name}' の設定完了。要約チャンネル: #{bot_channel.name}")
+    else:
+        print(f"サーバー '{guild.name}' でチャンネル作成に失敗しました。")
+
+def get_buffered_message_count(guild_id):
+    """サーバーのバッファ内のメッセージ総数"""
+    return sum(len(messages) for messages in message_buffers[guild_id].values())
+
+def get_schedule_offset(guild_id):
+    """サーバーの定期要約の開始を遅らせる秒数（サーバーIDから決まる固定値、優先サーバーは0）"""
+    if guild_id in PRIORITY_GUILD_IDS or SCHEDULE_SPREAD_MINUTES <= 0:
+        return 0
+    return zlib.crc32(str(guild_id).encode()) % (SCHEDULE_SPREAD_MINUTES * 60)
+
+async def post_guild_summary(guild, config, schedule_info, window, is_weekly=False):
+    """1サーバー分の定期要約を生成して投稿し、結果（posted/skipped/failed）を返す"""
+    # 指定期間のメッセージを取得
+    messages_by_channel = get_messages_in_window(guild.id, *window)
+    gemini_priority.set((PRIORITY_SCHEDULED, get_buffered_message_count(guild.id)))
+    
+    if not messages_by_channel:
+        print(f"[{datetime.now()}] {guild.name}: {schedule_info['description']}に新しいメッセージがないため要約をスキップ")
+        return 'skipped'
+    
+    if BOT_ROLE == 'gateway':
+        # 要約は要約ワーカーに任せ、完了したらjob_result_poller()が投稿する
+        try:
+            await enqueue_summary_job(guild.id, PRIORITY_SCHEDULED, config['summary_channel'], schedule_info['description'],
+                                      schedule_info['color'], window, is_weekly=is_weekly)
+            return 'queued'
+        except Exception as e:
+            print(f"要約ジョブの登録エラー ({guild.name}): {e}")
+            return 'failed'
+    
+    try:
+        embed = await create_server_summary_embed(
+            guild, 
+            messages_by_channel, 
+            window,
+            schedule_info['description'],
+            schedule_info['color'],
+            is_weekly=is_weekly
+        )
+        summary_channel = config['summary_channel']
+        
+        if summary_channel:
+            started = time.perf_counter()
+            await summary_channel.send(embed=embed)
+            metrics.observe('discord_send_seconds', time.perf_counter() - started, kind='scheduled')
+            total_messages = sum(len(msgs) for msgs in messages_by_channel.values())
+            print(f"[{datetime.now()}] {guild.name} の{schedule_info['description']}を投稿しました（{total_messages}件のメッセージ）")
+        return 'posted'
+    
+    except Exception as e:
+        print(f"要約エラー ({guild.name}): {e}")
+        return 'failed'
+
+async def post_scheduled_summary(schedule_info, guild_ids, fire_at, is_weekly=False):
+    """同じ時刻に予定されたサーバーの定期要約を並列に投稿
+    
+    各サーバーはget_schedule_offset()の秒数だけ開始をずらし、同時に処理するのは
+    SUMMARY_WORKERS個まで。優先サーバー、メッセージ数の多いサーバーの順に着手し、
+    時間のかかる大規模サーバーを先に始めることで全体の完了時刻を早める。
+    要約の期間は予定時刻までで固定なので、開始をずらしても内容は変わらない。
+    所要時間は予定時刻から最後のサーバーの完了までを計測する。
+    サーバーIDごとの結果（post_guild_summary()の戻り値）を返す。
+    """
+    window = (fire_at.timestamp() - schedule_info['hours_back'] * 3600, fire_at.timestamp())
+    
+    targets = []
+    for guild_id in guild_ids:
+        config = server_configs.get(guild_id)
+        if not config or not config['enabled'] or not config['summary_channel']:
+            continue
+        
+        guild = bot.get_guild(guild_id)
+        if not guild:
+            continue
+        
+        targets.append((guild, config))
+    
+    if not targets:
+        return {}
+    
+    targets.sort(key=lambda t: (t[0].id not in PRIORITY_GUILD_IDS, -get_buffered_message_count(t[0].id)))
+    
+    results = defaultdict(int)
+    guild_results = {}
+    slowest = (None, 0.0)
+    
+    async def run(guild, config):
+        nonlocal slowest
+        delay = fire_at.timestamp() + get_schedule_offset(guild.id) - datetime.now(timezone.utc).timestamp()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        
+        async with summary_worker_semaphore:
+            guild_started = datetime.now(timezone.utc)
+            # ずらした開始時刻からの遅れ（ワーカーの空き待ちを含む）
+            lag = (guild_started - fire_at).total_seconds() - get_schedule_offset(guild.id)
+            metrics.observe('scheduler_lag_seconds', max(lag, 0.0), stage='start')
+            result = await post_guild_summary(guild, config, schedule_info, window, is_weekly=is_weekly)
+        results[result] += 1
+        guild_results[guild.id] = result
+        if result != 'queued':
+            # キューに登録した要約はpost_job_result()で投稿した時点で数える
+            metrics.inc('scheduled_summaries_total', result=result)
+        guild_elapsed = (datetime.now(timezone.utc) - guild_started).total_seconds()
+        if guild_elapsed > slowest[1]:
+            slowest = (guild.name, guild_elapsed)
+    
+    await asyncio.gather(*(run(guild, config) for guild, config in targets))
+    
+    elapsed = (datetime.now(timezone.utc) - fire_at).total_seconds()
+    metrics.observe('scheduled_run_seconds', elapsed)
+    log_event('scheduled_run', description=schedule_info['description'], fire_at=fire_at.isoformat(),
+              elapsed=round(elapsed, 1), guilds=len(targets), slowest=slowest[0],
+              slowest_elapsed=round(slowest[1], 1), **results)
+    last_scheduled_run.update({
+        'description': schedule_info['description'],
+        'started_at': fire_at,
+        'elapsed': elapsed,
+        'guilds': len(targets),
+        'posted': results['posted'],
+        'skipped': results['skipped'],
+        'failed': results['failed'],
+        'queued': results['queued'],
+        'slowest': slowest,
+    })
+    
+    print(f"[{datetime.now()}] {schedule_info['description']}の定期要約完了: {len(targets)}サーバー / {elapsed:.1f}秒 "
+          f"(投稿 {results['posted']}, スキップ {results['skipped']}, 失敗 {results['failed']}"
+          + (f", キュー登録 {results['queued']})" if results['queued'] else ")"))
+    if elapsed > SUMMARY_TARGET_WINDOW:
+        print(f"⚠️ 定期要約が目標時間（{SUMMARY_TARGET_WINDOW}秒）を超過しました。最も遅いサーバー: {slowest[0]} ({slowest[1]:.1f}秒)")
+    return guild_results
+
+def group_rows_by_channel(rows):
+    """MessageStoreの行をget_messages_in_windowと同じ形式（チャンネル名 -> メッセージのリスト）にまとめる"""
+    by_channel = {}
+    for row in rows:
+        msg = MessageData.from_row(row)
+        by_channel.setdefault(msg.channel_id, []).append(msg)
+    return {messages[0].channel_name: messages for messages in by_channel.values()}
+
+async def enqueue_summary_job(guild_id, priority, channel, description, color, window, is_weekly=False, message_id=None):
+    """要約ジョブをキューに登録（BOT_ROLE=gateway）
+    
+    要約ワーカーはMessageStoreからメッセージを読むので、受信済みのメッセージを書き込んでから登録する。
+    message_idを指定すると、完了時にそのメッセージを編集して要約を表示する。
+    channelがNoneの場合は、投稿時点のサーバーの要約チャンネルに投稿する。
+    """
+    await message_store.flush()
+    payload = {
+        'window': list(window),
+        'is_weekly': is_weekly,
+        'description': description,
+        'color': color.value,
+        'channel_id': channel.id if channel else None,
+        'message_id': message_id,
+        'kind': 'scheduled' if priority == PRIORITY_SCHEDULED else 'manual',
+    }
+    return await message_store.enqueue_job(guild_id, priority, get_buffered_message_count(guild_id), json.dumps(payload))
+
+async def post_job_result(job_id, guild_id, payload, done, result, error, created_at, post_attempts):
+    """要約ワーカーが完了したジョブの要約を投稿（失敗したジョブは簡易要約を投稿）
+    
+    投稿権を取得できたジョブだけを投稿し、投稿できてから投稿済みにする。送信に失敗した場合は
+    JOB_RETRY_BASE秒から倍増する間隔（最長1時間）で再試行し、投稿先がない・権限がない場合だけ諦める。
+    """
+    if not await asyncio.to_thread(message_store.claim_posting, job_id, 120):
+        return
+    
+    payload = json.loads(payload)
+    window = tuple(payload['window'])
+    guild = bot.get_guild(guild_id)
+    channel = None
+    if guild and payload['channel_id']:
+        channel = guild.get_channel(payload['channel_id'])
+    elif guild and server_configs.get(guild_id):
+        channel = server_configs[guild_id]['summary_channel']
+    
+    async def discard(reason):
+        # 投稿先が削除されたか権限がないので、再試行しても投稿できない
+        print(f"要約ジョブ {job_id} を投稿できないため破棄します（サーバー {guild_id}）: {reason}")
+        if payload['kind'] == 'scheduled':
+            metrics.inc('scheduled_summaries_total', result='failed')
+        await message_store.mark_posted(job_id)
+    
+    if channel is None:
+        await discard("投稿先のチャンネルが見つかりません")
+        return
+    
+    try:
+        if done:
+            summary = result
+        else:
+            print(f"要約ジョブ {job_id} が失敗したため簡易要約を投稿します: {error}")
+            metrics.inc('fallback_total', kind='simple', stage='job', reason='error')
+            summary = generate_simple_summary(get_messages_in_window(guild_id, *window))
+        
+        embed = create_stats_embed(guild_id, window, payload['description'], discord.Color(payload['color']),
+                                   is_weekly=payload['is_weekly'])
+        embed.description = truncate_description(summary)
+        
+        started = time.perf_counter()
+        if payload['message_id']:
+            await channel.get_partial_message(payload['message_id']).edit(embed=embed)
+        else:
+            await channel.send(embed=embed)
+        metrics.observe('discord_send_seconds', time.perf_counter() - started, kind=payload['kind'])
+    except (discord.NotFound, discord.Forbidden) as e:
+        await discard(e)
+        return
+    except Exception as e:
+        delay = min(JOB_RETRY_BASE * 2 ** post_attempts, 3600)
+        print(f"要約ジョブ {job_id} の投稿エラー（{post_attempts + 1}回目）: {type(e).__name__} {e} - {delay:.0f}秒後に再試行")
+        await message_store.retry_posting(job_id, time.time() + delay)
+        return
+    
+    await message_store.mark_posted(job_id)
+    elapsed = time.time() - created_at
+    status = 'done' if done else 'failed'
+    metrics.observe('job_seconds', elapsed, kind=payload['kind'], result=status)
+    if payload['kind'] == 'scheduled':
+        metrics.inc('scheduled_summaries_total', result='posted' if done else 'failed')
+    print(f"[{datetime.now()}] {guild.name} の{payload['description']}を投稿しました（ジョブ {job_id}, 登録から{elapsed:.1f}秒）")
+
+async def job_result_poller():
+    """完了したジョブの投稿とキューの件数の記録をJOB_POLL_INTERVAL秒ごとに行う（BOT_ROLE=gateway）"""
+    await bot.wait_until_ready()
+    while True:
+        try:
+            for job in await asyncio.to_thread(message_store.read_finished_jobs):
+                await post_job_result(*job)
+            stats = await asyncio.to_thread(message_store.queue_stats)
+            for status in ('queued', 'running'):
+                metrics.set('job_queue_depth', stats[status]['count'], status=status)
+        except Exception as e:
+            print(f"要約ジョブの確認エラー: {e}")
+        await asyncio.sleep(JOB_POLL_INTERVAL)
+
+async def run_summary_job(guild_id, priority, size, payload, fallback=False):
+    """要約ジョブの期間のメッセージをMessageStoreから読み込んで要約する（BOT_ROLE=summarizer）
+    
+    APIのエラーは例外として送出し、fallbackを指定した場合（最後の試行）だけ簡易要約にする。
+    """
+    window = tuple(payload['window'])
+    # チェックポイントのブロックをサーバーのスケジュールに揃えるため、最新の設定を読み込む
+    server_configs[guild_id] = await asyncio.to_thread(message_store.read_guild_settings, guild_id)
+    rows = await asyncio.to_thread(message_store.read_range, *window, guild_id)
+    messages_by_channel = group_rows_by_channel(rows)
+    gemini_priority.set((priority, size))
+    return await summarize_all_channels(messages_by_channel, is_weekly=payload['is_weekly'], guild_id=guild_id, window=window,
+                                        fallback=fallback)
+
+async def summarizer_loop(worker):
+    """キューから要約ジョブを1つずつ取得して処理する
+    
+    例外で終わったジョブはJOB_MAX_ATTEMPTS回まで、JOB_RETRY_BASE秒から倍増する間隔を空けて再試行する。
+    最後の試行でもAPIが使えなければ簡易要約を結果にする。
+    要約自体はSUMMARY_DEADLINE秒以内に終わるので、それに余裕を持たせた時間を過ぎても完了しない
+    ジョブは、このワーカーが停止したとみなして他のワーカーが取得し直す。
+    """
+    while True:
+        try:
+            job = await asyncio.to_thread(message_store.claim_job, worker, SUMMARY_DEADLINE + 120, JOB_MAX_ATTEMPTS)
+        except Exception as e:
+            print(f"要約ジョブの取得エラー: {e}")
+            job = None
+        if job is None:
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+            continue
+        
+        job_id, guild_id, priority, size, payload, attempts = job
+        started = time.monotonic()
+        try:
+            summary = await run_summary_job(guild_id, priority, size, json.loads(payload),
+                                            fallback=attempts >= JOB_MAX_ATTEMPTS)
+        except Exception as e:
+            retry_at = time.time() + JOB_RETRY_BASE * 2 ** (attempts - 1) if attempts < JOB_MAX_ATTEMPTS else None
+            print(f"要約ジョブ {job_id} のエラー（{attempts}回目）: {type(e).__name__} {e}"
+                  + (f" - {retry_at - time.time():.0f}秒後に再試行" if retry_at else ""))
+            await asyncio.to_thread(message_store.finish_job, job_id, worker, error=f"{type(e).__name__}: {e}", retry_at=retry_at)
+            continue
+        
+        await asyncio.to_thread(message_store.finish_job, job_id, worker, result=summary)
+        print(f"[{datetime.now()}] 要約ジョブ {job_id} を処理しました（サーバー {guild_id}, {time.monotonic() - started:.1f}秒）")
+
+async def run_summarizer():
+    """要約ワーカーのプロセス（BOT_ROLE=summarizer）
+    
+    Discordには接続せず、SUMMARY_WORKERS個のループでキューの要約ジョブを並列に処理する。
+    Gemini APIの利用枠はゲートウェイや他の要約ワーカーとMessageStoreで共有する。
+    """
+    worker = f"{platform.node()}:{os.getpid()}"
+    await quota_governor.load()
+    now_ts = datetime.now(timezone.utc).timestamp()
+    for guild_id, block_start, message_count, last_message_id, summary in await asyncio.to_thread(
+            message_store.read_checkpoints, now_ts - 168 * 3600):
+        summary_checkpoints[guild_id].setdefault(block_start, ((message_count, last_message_id), summary))
+    
+    metrics_server = await start_monitoring()
+    flush_store_task.start()
+    print(f"要約ワーカー {worker} を開始しました（並列数 {SUMMARY_WORKERS}）")
+    try:
+        await asyncio.gather(*(summarizer_loop(worker) for _ in range(SUMMARY_WORKERS)))
+    finally:
+        await quota_governor.save()
+        if metrics_server:
+            metrics_server.close()
+
+async def backfill_channel(channel, until_ts):
+    """チャンネルの取りこぼした履歴を channel.history で取り込み、追加した件数を返す
+    
+    バッファ内で until_ts より前の最新メッセージ（ハイウォーターマーク）から再開し、
+    保持期間より古い履歴は取得しない。
+    """
+    buffer = message_buffers[channel.guild.id][channel.id]
+    high_water_mark = buffer.last_message_id_before(until_ts) or 0
+    after_id = max(high_water_mark, ts_to_snowflake(until_ts - BACKFILL_HOURS * 3600))
+    
+    added = 0
+    async with backfill_semaphore:
+        async for message in channel.history(
+            limit=None,
+            after=discord.Object(id=after_id),
+            before=discord.Object(id=ts_to_snowflake(until_ts)),
+            oldest_first=True,
+        ):
+            if message.author.bot:
+                continue
+            if ingest_message(message, dedup=True):
+                added += 1
+                backfill_progress['messages'] += 1
+    return added
+
+async def backfill_guilds(guilds):
+    """サーバーの全テキストチャンネルの履歴を並列に取り込む
+    
+    取り込みはライブのメッセージ受信と並行して進み、起動以降のメッセージは
+    on_messageで受信済みのため、取り込み開始時刻より前だけを対象にする。
+    """
+    # 永続化されたメッセージの復元が終わってからハイウォーターマークを決める
+    hydration_task = getattr(bot, 'hydration_task', None)
+    if hydration_task:
+        await hydration_task
+    
+    until_ts = datetime.now(timezone.utc).timestamp()
+    channels = []
+    for guild in guilds:
+        for channel in guild.text_channels:
+            if channel.name == BOT_CHANNEL_NAME:
+                continue
+            permissions = channel.permissions_for(guild.me)
+            if permissions.read_messages and permissions.read_message_history:
+                channels.append(channel)
+    
+    if not channels:
+        return
+    
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    last_report = started
+    backfill_progress['running'] += 1
+    backfill_progress['channels_total'] += len(channels)
+    
+    async def run(channel):
+        nonlocal last_report
+        try:
+            await backfill_channel(channel, until_ts)
+        except discord.HTTPException as e:
+            print(f"履歴の取り込みエラー ({channel.guild.name} #{channel.name}): {e}")
+        backfill_progress['channels_done'] += 1
+        
+        # 30秒ごとに進捗を表示
+        if loop.time() - last_report >= 30:
+            last_report = loop.time()
+            print(f"[{datetime.now()}] 履歴の取り込み中: {backfill_progress['channels_done']}/{backfill_progress['channels_total']}"
+                  f"チャンネル, {backfill_progress['messages']}件")
+    
+    try:
+        await asyncio.gather(*(run(channel) for channel in channels))
+    finally:
+        backfill_progress['running'] -= 1
+    
+    print(f"[{datetime.now()}] 履歴の取り込み完了: {len(guilds)}サーバー / {len(channels)}チャンネル "
+          f"({loop.time() - started:.1f}秒, 累計{backfill_progress['messages']}件)")
+
+async def resource_sampler():
+    """CPU・メモリ・イベントループの遅延・バッファ件数・GCの状況を定期的に記録
+    
+    psutil.cpu_percent(interval=None) は前回呼び出しからの使用率を即座に返すため、
+    イベントループを止めずに計測できる。ループの遅延は、監視が有効ならloop_watchdogのheartbeatで
+    測った前回のサンプル以降の最大値を使い、無効ならsleepの予定時刻からのずれで測る。
+    """
+    loop = asyncio.get_running_loop()
+    process = psutil.Process()
+    
+    # 初回呼び出しは基準値の記録のみ
+    psutil.cpu_percent(interval=None)
+    process.cpu_percent(interval=None)
+    
+    while True:
+        expected = loop.time() + SAMPLER_INTERVAL
+        await asyncio.sleep(SAMPLER_INTERVAL)
+        lag = max(loop.time() - expected, 0.0)
+        if loop_watchdog and loop_watchdog.started_at is not None:
+            lag = loop_watchdog.take_max_lag()
+        
+        try:
+            resource_samples.append({
+                'time': datetime.now(timezone.utc),
+                'cpu': psutil.cpu_percent(interval=None),
+                'process_cpu': process.cpu_percent(interval=None),
+                'rss': process.memory_info().rss,
+                'loop_lag': lag,
+                'buffered': sum(get_buffered_message_count(guild_id) for guild_id in list(message_buffers.keys())),
+                'gc_counts': gc.get_count(),
+                'gc_collections': tuple(stat['collections'] for stat in gc.get_stats()),
+            })
+        except Exception as e:
+            print(f"リソースのサンプリングエラー: {e}")
+
+async def handle_metrics_request(reader, writer):
+    """GET /metrics にPrometheusのテキスト形式でメトリクスを返す最小限のHTTPサーバー"""
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+        # ヘッダーは読み捨てる
+        while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b'\r\n', b'\n', b''):
+            pass
+        
+        parts = request_line.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+            status, content_type, body = '200 OK', 'text/plain; version=0.0.4; charset=utf-8', metrics.render().encode()
+        else:
+            status, content_type, body = '404 Not Found', 'text/plain; charset=utf-8', b'Not Found\n'
+        
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+                     f"Connection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    except Exception as e:
+        print(f"メトリクスの送信エラー: {e}")
+    finally:
+        writer.close()
+
+async def start_monitoring():
+    """リソースのサンプリング、イベントループの監視、メトリクスの公開と構造化ログの出力を開始
+    
+    メトリクスを公開した場合はそのサーバーを返す。タスクはmonitoring_tasksで保持する。
+    """
+    monitoring_tasks.append(asyncio.create_task(resource_sampler()))
+    if loop_watchdog:
+        monitoring_tasks.append(loop_watchdog.start())
+    if METRICS_LOG_INTERVAL > 0:
+        monitoring_tasks.append(asyncio.create_task(metrics_logger()))
+    
+    if not METRICS_PORT:
+        return None
+    # 複数プロセスで実行している場合はプロセスごとにポートをずらす。要約ワーカーはゲートウェイの後ろの
+    # ポートを使い、同じホストで複数起動した場合は空いているポートを順に探す
+    if BOT_ROLE == 'summarizer':
+        ports = range(METRICS_PORT + WORKER_COUNT, METRICS_PORT + WORKER_COUNT + 16)
+    else:
+        ports = [METRICS_PORT + WORKER_INDEX]
+    for port in ports:
+        try:
+            server = await asyncio.start_server(handle_metrics_request, METRICS_HOST, port)
+        except OSError as e:
+            error = e
+            continue
+        print(f"メトリクスを http://{METRICS_HOST}:{port}/metrics で公開しています")
+        return server
+    # ポートが使えなくてもBot自体は動かす
+    print(f"⚠️ メトリクスを公開できません（ポート {ports[0]}〜{ports[-1]}）: {error}")
+    return None
+
+monitoring_tasks = []
+
+async def metrics_logger():
+    """METRICS_LOG_INTERVAL秒ごとにメトリクスを構造化ログとして出力"""
+    while True:
+        await asyncio.sleep(METRICS_LOG_INTERVAL)
+        try:
+            log_event('metrics', metrics=metrics.snapshot())
+        except Exception as e:
+            print(f"メトリクスの出力エラー: {e}")
+
+class LoopWatchdog:
+    """イベントループの停止（ブロッキング処理）を検出する監視スレッド
+    
+    ループ側のheartbeat()がLOOP_WATCHDOG_INTERVAL秒ごとに時刻を更新し、別スレッドのwatch()が
+    その更新がLOOP_STALL_THRESHOLD秒以上止まっていないか確認する。止まっていれば
+    sys._current_frames()でループのスレッドのスタックと実行中のタスクを記録する。
+    停止の長さはループが再開した時点でheartbeat()が確定させ、ログに出力する。
+    """
+    
+    def __init__(self):
+        self.thread_id = None
+        self.loop = None
+        self.beat = time.monotonic()
+        self.lock = threading.Lock()
+        self.current = None  # 検出済みで継続中の停止
+        self.events = deque(maxlen=LOOP_STALL_HISTORY)
+        self.lags = deque(maxlen=max(int(300 / LOOP_WATCHDOG_INTERVAL), 1))  # 直近5分の遅延
+        self.max_lag = 0.0  # resource_sampler()が前回読み出してからの最大の遅延
+        self.stalls = 0
+        self.started_at = None
+    
+    def start(self):
+        """イベントループ上で呼び出し、監視スレッドとheartbeatのタスクを開始"""
+        self.loop = asyncio.get_running_loop()
+        self.thread_id = threading.get_ident()
+        self.beat = time.monotonic()
+        self.started_at = datetime.now(timezone.utc)
+        threading.Thread(target=self.watch, name='loop-watchdog', daemon=True).start()
+        return asyncio.create_task(self.heartbeat())
+    
+    async def heartbeat(self):
+        while True:
+            expected = time.monotonic() + LOOP_WATCHDOG_INTERVAL
+            await asyncio.sleep(LOOP_WATCHDOG_INTERVAL)
+            now = time.monotonic()
+            lag = max(now - expected, 0.0)
+            self.lags.append(lag)
+            self.max_lag = max(self.max_lag, lag)
+            with self.lock:
+                self.beat = now
+                event, self.current = self.current, None
+            
+            if event is None:
+                if lag < LOOP_STALL_THRESHOLD:
+                    continue
+                # 監視スレッドが確認する前に再開した停止（スタックは取れていない）
+                event = {'time': datetime.now(timezone.utc) - timedelta(seconds=lag), 'task': None,
+                         'location': '不明', 'stack': []}
+                with self.lock:
+                    self.events.append(event)
+            event['duration'] = lag
+            self.stalls += 1
+            metrics.observe('loop_stall_seconds', lag)
+            log_event('loop_stall', duration=round(lag, 3), task=event['task'], location=event['location'])
+    
+    def take_max_lag(self):
+        """前回の呼び出し以降の最大の遅延を返してリセット（!systemの推移も!loopと同じ計測から求める）"""
+        lag, self.max_lag = self.max_lag, 0.0
+        return lag
+    
+    def watch(self):
+        while True:
+            time.sleep(LOOP_WATCHDOG_INTERVAL)
+            with self.lock:
+                stalled = time.monotonic() - self.beat - LOOP_WATCHDOG_INTERVAL
+                if stalled < LOOP_STALL_THRESHOLD or self.current is not None:
+                    continue
+                frame = sys._current_frames().get(self.thread_id)
+                if frame is None:
+                    continue
+                try:
+                    event = self.current = self.capture(frame, stalled)
+                except Exception as e:
+                    print(f"イベントループの監視エラー: {e}")
+                    continue
+                self.events.append(event)
+            
+            print(f"⚠️ イベントループが{stalled:.1f}秒以上停止しています（{event['task'] or 'コールバック'}, {event['location']}）\n"
+                  + "".join(event['stack']), end="")
+    
+    def capture(self, frame, stalled):
+        """ループのスレッドのスタックから停止の記録を作る"""
+        stack = traceback.extract_stack(frame)[-20:]
+        # 原因の箇所はこのファイル内の最も内側のフレーム（なければスタックの最も内側）
+        own = [entry for entry in stack if entry.filename == __file__]
+        where = own[-1] if own else stack[-1]
+        
+        task_name = None
+        try:
+            task = asyncio.current_task(self.loop)
+            if task:
+                task_name = f"{task.get_name()} ({getattr(task.get_coro(), '__qualname__', '?')})"
+        except Exception:
+            pass
+        
+        return {
+            'time': datetime.now(timezone.utc) - timedelta(seconds=stalled),
+            'task': task_name,
+            'location': f"{where.name} ({os.path.basename(where.filename)}:{where.lineno})",
+            'stack': traceback.format_list(stack),
+            'duration': None,
+        }
+
+# 監視が無効な場合はNone（間隔が0以下だと監視スレッドが空回りするので作らない）
+loop_watchdog = LoopWatchdog() if LOOP_STALL_THRESHOLD > 0 and LOOP_WATCHDOG_INTERVAL > 0 else None
+
+def summarize_samples(key):
+    """直近1時間のサンプルの (最小, 最大, p95)"""
+    values = sorted(sample[key] for sample in resource_samples)
+    if not values:
+        return None
+    p95 = values[min(int(len(values) * 0.95), len(values) - 1)]
+    return values[0], values[-1], p95
+
+WEEKDAY_NAMES = ['月', '火', '水', '木', '金', '土', '日']
+
+def get_guild_timezone(config):
+    try:
+        return ZoneInfo(config.get('timezone') or DEFAULT_TIMEZONE)
+    except ZoneInfoNotFoundError:
+        return ZoneInfo(DEFAULT_TIMEZONE)
+
+def get_guild_slots(config):
+    """サーバーの定期要約の一覧（各サーバーのタイムゾーンでの時刻）
+    
+    !set_schedule で時刻を指定した場合、最初の時刻は過去24時間、それ以降は前の時刻からの要約になる。
+    週次サマリーは月曜日の最初の時刻。
+    """
+    hours = config.get('schedule_hours')
+    if not hours:
+        slots = [dict(schedule, key=f"daily-{schedule['hour']}") for schedule in SUMMARY_SCHEDULE]
+        slots.append(dict(WEEKLY_SUMMARY_SCHEDULE, key="weekly", is_weekly=True))
+        return slots
+    
+    hours = sorted(set(hours))
+    slots = [{"key": f"daily-{hours[0]}", "hour": hours[0], "minute": 0, "hours_back": 24,
+              "description": "前日の要約", "color": discord.Color.purple()}]
+    for previous, hour in zip(hours, hours[1:]):
+        if hour <= 12:
+            description, color = "午前の要約", discord.Color.blue()
+        elif hour <= 18:
+            description, color = "午後の要約", discord.Color.orange()
+        else:
+            description, color = "夜の要約", discord.Color.gold()
+        slots.append({"key": f"daily-{hour}", "hour": hour, "minute": 0, "hours_back": hour - previous,
+                      "description": description, "color": color})
+    slots.append(dict(WEEKLY_SUMMARY_SCHEDULE, hour=hours[0], key="weekly", is_weekly=True))
+    return slots
+
+def get_next_fire_time(schedule, after, tz=timezone.utc):
+    """after より後の次回の実行時刻（tzでの時刻指定をUTCに変換して返す）"""
+    local_after = after.astimezone(tz)
+    candidate = local_after.replace(hour=schedule['hour'], minute=schedule['minute'], second=0, microsecond=0)
+    if 'weekday' in schedule:
+        candidate += timedelta(days=(schedule['weekday'] - candidate.weekday()) % 7)
+    while candidate <= local_after:
+        candidate += timedelta(days=7 if 'weekday' in schedule else 1)
+    return candidate.astimezone(timezone.utc)
+
+class SummaryScheduler:
+    """定期要約のスケジューラ
+    
+    サーバーごとの定期要約を予定時刻（UTC）でまとめ、その時刻の優先度付きキュー（ヒープ）で管理する。
+    次の時刻まで正確に待機し、イベントループが詰まって予定時刻を過ぎても起きた時点で遅れて実行する
+    （同じ要約を複数回取りこぼした場合は1回にまとめる）。各サーバーの開始のずらしは
+    post_scheduled_summary() で行う。
+    """
+    
+    def __init__(self):
+        self.heap = []  # (予定時刻, 連番, グループのキー)
+        self.groups = {}  # (予定時刻, 要約の種類) -> {'slot': ..., 'guild_ids': set()}
+        self.guild_jobs = defaultdict(dict)  # サーバーID -> 要約の種類 -> 登録済みの最新の予定時刻
+        self.counter = itertools.count()
+        self.running = False
+        self.tasks = set()  # 実行中のdispatch()（完了前にガベージコレクションされないよう参照を保持）
+        self.run_task = None
+        # 定期要約の実行権の所有者（再起動しても同じ値になるので、再起動前に取得した実行権を取り直せる）
+        self.owner = f"{platform.node()}:{WORKER_INDEX}"
     
-    # 統計情報を簡潔に
-    stats_text = f"💬 {total_messages}件 | 📍 {active_channels}ch | 👥 {len(all_authors)}人"
-    embed.add_field(
-        name="📊 統計",
-        value=stats_text,
-        inline=False
-    )
+    def add(self, guild_id, slot, fire_at):
+        """サーバーの定期要約を予定時刻に登録"""
+        key = (fire_at, slot['key'])
+        group = self.groups.get(key)
+        if group is None:
+            group = self.groups[key] = {'slot': slot, 'guild_ids': set()}
+            heapq.heappush(self.heap, (fire_at, next(self.counter), key))
+        group['guild_ids'].add(guild_id)
+        
+        latest = self.guild_jobs[guild_id].get(slot['key'])
+        if latest is None or fire_at > latest:
+            self.guild_jobs[guild_id][slot['key']] = fire_at
     
-    # チャンネル別の活動状況（週次サマリーの場合はTOP5）
-    if active_channels > 0:
-        channel_stats = []
-        top_count = 5 if is_weekly else 3
-        for channel_name, messages in sorted(messages_by_channel.items(), 
-                                            key=lambda x: len(x[1]), 
-                                            reverse=True)[:top_count]:
-            if messages:
-                channel_stats.append(f"**#{channel_name}**: {len(messages)}件")
+    def remove_guild(self, guild_id):
+        """サーバーの定期要約をすべて取り消す（空になったグループは実行時に読み飛ばす）"""
+        for group in self.groups.values():
+            group['guild_ids'].discard(guild_id)
+        self.guild_jobs.pop(guild_id, None)
+    
+    async def schedule_guild(self, guild_id):
+        """サーバーの設定から定期要約を登録し直す
         
-        if channel_stats:
-            embed.add_field(
-                name="🔥 活発なチャンネル",
-                value=" / ".join(channel_stats),
-                inline=False
-            )
+        停止中にSCHEDULE_CATCHUP_SECONDS以内の予定時刻を過ぎた要約が未実行なら、それも登録する。
+        """
+        self.remove_guild(guild_id)
+        config = server_configs[guild_id]
+        tz = get_guild_timezone(config)
+        now = datetime.now(timezone.utc)
+        
+        for slot in get_guild_slots(config):
+            self.add(guild_id, slot, get_next_fire_time(slot, now, tz))
+            
+            if not message_store:
+                continue
+            period = timedelta(days=7 if slot.get('is_weekly') else 1)
+            previous = get_next_fire_time(slot, now - period, tz)
+            if previous <= now and (now - previous).total_seconds() <= SCHEDULE_CATCHUP_SECONDS and \
+                    not await asyncio.to_thread(message_store.has_run, f"{guild_id}:{slot['key']}", previous.timestamp(), self.owner):
+                self.add(guild_id, slot, previous)
     
-    # 要約内容
-    summary = summarize_all_channels(messages_by_channel, is_weekly=is_weekly)
+    def upcoming(self, guild_id):
+        """サーバーの次回の定期要約を (開始予定時刻, 要約の種類) の実行順で返す"""
+        jobs = []
+        offset = timedelta(seconds=get_schedule_offset(guild_id))
+        for fire_at, _, key in self.heap:
+            group = self.groups[key]
+            if guild_id in group['guild_ids']:
+                jobs.append((fire_at + offset, group['slot']))
+        return sorted(jobs, key=lambda job: job[0])
     
-    # 要約をそのまま追加
-    embed.description = summary
+    def due_per_minute(self, hours=24):
+        """今後hours時間に開始予定のサーバー数を1分ごとに集計"""
+        now = datetime.now(timezone.utc)
+        until = now + timedelta(hours=hours)
+        counts = defaultdict(int)
+        for fire_at, _, key in self.heap:
+            if fire_at > until:
+                continue
+            for guild_id in self.groups[key]['guild_ids']:
+                start = fire_at + timedelta(seconds=get_schedule_offset(guild_id))
+                counts[start.replace(second=0, microsecond=0)] += 1
+        return counts
     
-    return embed
-
-async def setup_guild(guild):
-    """サーバーの初期設定"""
-    guild_id = guild.id
+    async def run(self):
+        while True:
+            if not self.heap:
+                await asyncio.sleep(60)
+                continue
+            
+            fire_at = self.heap[0][0]
+            delay = (fire_at - datetime.now(timezone.utc)).total_seconds()
+            if delay > 0:
+                # 時計のずれやジョブの追加に備えて最長60秒ごとに見直す
+                await asyncio.sleep(min(delay, 60))
+                continue
+            
+            _, _, key = heapq.heappop(self.heap)
+            group = self.groups.pop(key)
+            slot = group['slot']
+            guild_ids = list(group['guild_ids'])
+            if not guild_ids:
+                continue
+            
+            # 各サーバーの次回を登録（大きく遅れて複数回分を過ぎていても次の予定時刻は1つだけ、
+            # 起動時の取りこぼし分のように次回が登録済みの場合は何もしない）
+            now = datetime.now(timezone.utc)
+            for guild_id in guild_ids:
+                config = server_configs.get(guild_id)
+                if not config:
+                    continue
+                next_fire = get_next_fire_time(slot, max(fire_at, now), get_guild_timezone(config))
+                latest = self.guild_jobs[guild_id].get(slot['key'])
+                if latest is None or latest <= fire_at:
+                    self.add(guild_id, slot, next_fire)
+            
+            lateness = -delay
+            metrics.observe('scheduler_lag_seconds', lateness, stage='dispatch')
+            if lateness > 60:
+                print(f"⚠️ {slot['description']}の実行が予定時刻から{lateness:.0f}秒遅れました")
+            
+            task = asyncio.create_task(self.dispatch(slot, guild_ids, fire_at))
+            self.tasks.add(task)
+            task.add_done_callback(lambda task, slot=slot: self.dispatch_done(task, slot))
     
-    # Bot用チャンネルを取得または作成
-    bot_channel = await get_or_create_bot_channel(guild)
+    def start(self):
+        """run()をバックグラウンドで開始"""
+        self.running = True
+        self.run_task = asyncio.create_task(self.run())
+        self.run_task.add_done_callback(self.run_done)
     
-    server_configs[guild_id] = {
-        'summary_channel': bot_channel,
-        'enabled': True
-    }
+    def run_done(self, task):
+        """run()が例外で終わった場合はログに残し、次のon_ready（再接続）で開始し直せるようにする"""
+        self.running = False
+        if not task.cancelled() and task.exception():
+            print(f"定期要約のスケジューラが停止しました: {task.exception()!r}")
     
-    if bot_channel:
-        print(f"サーバー '{guild.name}' の設定完了。要約チャンネル: #{bot_channel.name}")
-    else:
-        print(f"サーバー '{guild.name}' でチャンネル作成に失敗しました。")
-
-async def post_scheduled_summary(schedule_info, is_weekly=False):
-    """スケジュールに従って要約を投稿"""
-    for guild_id, config in server_configs.items():
-        if not config['enabled'] or not config['summary_channel']:
-            continue
+    def dispatch_done(self, task, slot):
+        """完了したdispatch()の参照を外し、例外で終わった場合はログに残す"""
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            print(f"定期要約の実行エラー ({slot['description']}): {task.exception()!r}")
+    
+    async def dispatch(self, slot, guild_ids, fire_at):
+        """定期要約を実行し、サーバーごとに実行済みとして記録
         
-        guild = bot.get_guild(guild_id)
-        if not guild:
-            continue
+        MessageStoreで実行権を取得できたサーバーだけを要約するので、再起動の前後や
+        シャードの担当の切り替え中に複数のプロセスが同じサーバーを予定していても投稿は1回になる。
+        実行権は投稿を終えてから実行済みにし、失敗した場合は期限切れ後に取りこぼし分として取り直せるよう残す。
+        """
+        claimed = []
+        if message_store:
+            jobs = {f"{guild_id}:{slot['key']}": guild_id for guild_id in guild_ids}
+            claimed = await asyncio.to_thread(message_store.claim_runs, list(jobs), fire_at.timestamp(),
+                                              self.owner, SCHEDULE_CLAIM_LEASE)
+            if len(claimed) < len(jobs):
+                print(f"{slot['description']}: {len(jobs) - len(claimed)}サーバーは他のプロセスで実行済みか実行中のためスキップ")
+            guild_ids = [jobs[job] for job in claimed]
+        results = await post_scheduled_summary(slot, guild_ids, fire_at, is_weekly=slot.get('is_weekly', False))
         
-        # 指定時間内のメッセージを取得
-        messages_by_channel = get_messages_in_timerange(guild_id, schedule_info['hours_back'])
+        if claimed:
+            finished = [job for job in claimed if results.get(jobs[job]) != 'failed']
+            await asyncio.to_thread(message_store.finish_runs, finished, fire_at.timestamp(), self.owner)
         
-        if messages_by_channel:
-            try:
-                embed = create_server_summary_embed(
-                    guild, 
-                    messages_by_channel, 
-                    schedule_info['description'],
-                    schedule_info['color'],
-                    is_weekly=is_weekly
-                )
-                summary_channel = config['summary_channel']
-                
-                if summary_channel:
-                    await summary_channel.send(embed=embed)
-                    total_messages = sum(len(msgs) for msgs in messages_by_channel.values())
-                    print(f"[{datetime.now()}] {guild.name} の{schedule_info['description']}を投稿しました（{total_messages}件のメッセージ）")
-                
-            except Exception as e:
-                print(f"要約エラー ({guild.name}): {e}")
-        else:
-            print(f"[{datetime.now()}] {guild.name}: {schedule_info['description']}に新しいメッセージがないため要約をスキップ")
+        if slot.get('is_weekly'):
+            # 古いメッセージをクリーンアップ
+            cleanup_old_messages()
+
+summary_scheduler = SummaryScheduler()
 
 @bot.event
 async def on_ready():
     bot.start_time = datetime.now()
     print(f'{bot.user} がログインしました！')
-    print(f'使用モデル: {MODEL_NAME}')
-    print(f'要約スケジュール: 6時(前日の要約)、12時(午前の要約)、18時(午後の要約)、月曜6時(週次要約)')
+    print(f'使用モデル: {MODEL_NAME}（少量の要約: {MODEL_ROUTES["small"]["model"]}, 部分要約: {MODEL_ROUTES["map"]["model"]}）')
+    print(f'要約スケジュール（デフォルト、{DEFAULT_TIMEZONE}）: 6時(前日の要約)、12時(午前の要約)、18時(午後の要約)、月曜6時(週次要約)')
     print(f'メッセージ保持期間: 1週間（168時間）')
     
     # 既に参加している全サーバーの設定
     for guild in bot.guilds:
         await setup_guild(guild)
     
-    # 定期タスクを開始
-    scheduled_summary_task.start()
-    cleanup_task.start()
+    # 停止中に取りこぼした履歴をバックグラウンドで取り込む
+    if not backfill_progress['running']:
+        bot.start_backfill(list(bot.guilds))
+    
+    # 定期タスクを開始（再接続でon_readyが再度呼ばれた場合は何もしない）
+    if not summary_scheduler.running:
+        summary_scheduler.start()
+    if not cleanup_task.is_running():
+        cleanup_task.start()
 
 @bot.event
 async def on_guild_join(guild):
     """新しいサーバーに参加した時の処理"""
     print(f"新しいサーバーに参加しました: {guild.name}")
     await setup_guild(guild)
+    bot.start_backfill([guild])
 
 @bot.event
 async def on_guild_remove(guild):
@@ -372,8 +3468,12 @@ async def on_guild_remove(guild):
     guild_id = guild.id
     if guild_id in server_configs:
         del server_configs[guild_id]
+    summary_scheduler.remove_guild(guild_id)
     if guild_id in message_buffers:
         del message_buffers[guild_id]
+    summary_checkpoints.pop(guild_id, None)
+    if message_store:
+        await message_store.delete_guild(guild_id)
     print(f"サーバーから削除されました: {guild.name}")
 
 @bot.event
@@ -391,38 +3491,10 @@ async def on_message(message):
         return
     
     # メッセージを保存
-    guild_id = message.guild.id
-    channel_id = message.channel.id
-    
-    message_data = MessageData(message)
-    message_buffers[guild_id][channel_id].append(message_data)
+    ingest_message(message)
     
     await bot.process_commands(message)
 
-@tasks.loop(minutes=1)
-async def scheduled_summary_task():
-    """1分ごとにスケジュールをチェックして要約を投稿"""
-    now = datetime.now()
-    current_time = time(now.hour, now.minute)
-    
-    # 通常の要約スケジュール
-    for schedule in SUMMARY_SCHEDULE:
-        scheduled_time = time(schedule['hour'], schedule['minute'])
-        
-        # 現在時刻が予定時刻と一致する場合
-        if (current_time.hour == scheduled_time.hour and 
-            current_time.minute == scheduled_time.minute):
-            await post_scheduled_summary(schedule)
-    
-    # 週次サマリーのチェック（UTCで日曜日の21時 = JSTで月曜日の6時）
-    if (now.weekday() == 6 and  # 日曜日（UTC）
-        current_time.hour == WEEKLY_SUMMARY_SCHEDULE['hour'] and
-        current_time.minute == WEEKLY_SUMMARY_SCHEDULE['minute']):
-        await post_scheduled_summary(WEEKLY_SUMMARY_SCHEDULE, is_weekly=True)
-        
-        # 古いメッセージをクリーンアップ
-        cleanup_old_messages()
-
 @tasks.loop(hours=6)  # 6時間ごとに実行
 async def cleanup_task():
     """定期的なメモリクリーンアップ"""
@@ -431,13 +3503,53 @@ async def cleanup_task():
         if guild_id not in server_configs:
             del message_buffers[guild_id]
     
+    # 保持期間より古いチェックポイントを削除
+    checkpoint_cutoff = datetime.now(timezone.utc).timestamp() - 168 * 3600
+    for guild_id in list(summary_checkpoints.keys()):
+        if guild_id not in server_configs:
+            del summary_checkpoints[guild_id]
+            continue
+        for block_start in [b for b in summary_checkpoints[guild_id] if b < checkpoint_cutoff]:
+            del summary_checkpoints[guild_id][block_start]
+    
     # 1週間以上前のメッセージを削除
     cleanup_old_messages()
+    if message_store:
+        await message_store.delete_before(datetime.now(timezone.utc).timestamp() - 168 * 3600)
     
     # ガベージコレクション実行
     gc.collect()
     print(f"[{datetime.now()}] メモリクリーンアップ完了")
 
+async def save_bucket_rollups():
+    """メッセージが追加されたバケットのうち、時間が過ぎて確定したものの集計をMessageStoreへ保存"""
+    current_hour = int(datetime.now(timezone.utc).timestamp() // 3600)
+    closed = [key for key in message_store.touched if key[2] < current_hour]
+    rows = []
+    for key in closed:
+        message_store.touched.discard(key)
+        guild_id, channel_id, hour = key
+        buffer = message_buffers.get(guild_id, {}).get(channel_id)
+        bucket = buffer.bucket_at(hour) if buffer else None
+        if bucket and bucket.messages:
+            rows.append((guild_id, channel_id, hour, *dump_bucket_rollup(bucket)))
+    if rows:
+        try:
+            await message_store.save_rollups(rows)
+        except Exception:
+            message_store.touched.update(closed)
+            raise
+
+@tasks.loop(seconds=STORE_FLUSH_INTERVAL)
+async def flush_store_task():
+    """受信したメッセージとAPIの利用枠の状態をまとめてMessageStoreへ書き込む"""
+    try:
+        await message_store.flush()
+        await save_bucket_rollups()
+        await quota_governor.save()
+    except Exception as e:
+        print(f"MessageStore 書き込みエラー: {e}")
+
 @bot.command(name='summary')
 async def manual_summary(ctx, hours: int = 24):
     """手動で現在のサーバーの要約を生成するコマンド
@@ -461,7 +3573,8 @@ async def manual_summary(ctx, hours: int = 24):
     guild_id = ctx.guild.id
     
     # 指定時間内のメッセージを取得
-    messages_by_channel = get_messages_in_timerange(guild_id, hours)
+    window = get_summary_window(hours, guild_id)
+    messages_by_channel = get_messages_in_window(guild_id, *window)
     
     if not messages_by_channel:
         await ctx.send(f"過去{hours}時間の要約するメッセージがありません。")
@@ -478,7 +3591,121 @@ async def manual_summary(ctx, hours: int = 24):
         color = discord.Color.gold()  # 週次要約
     
     is_weekly = hours >= 168
-    embed = create_server_summary_embed(ctx.guild, messages_by_channel, f"過去{hours}時間の要約", color, is_weekly=is_weekly)
+    gemini_priority.set((PRIORITY_MANUAL, get_buffered_message_count(guild_id)))
+    
+    if BOT_ROLE == 'gateway':
+        # 統計だけのEmbedを投稿し、要約ワーカーの処理が終わったらjob_result_poller()が編集する
+        embed = create_stats_embed(guild_id, window, f"過去{hours}時間の要約", color, is_weekly=is_weekly)
+        stats = await asyncio.to_thread(message_store.queue_stats)
+        embed.description = f"⏳ 要約の順番を待っています（待機中のジョブ {stats['queued']['count']}件）"
+        message = await ctx.send(embed=embed)
+        await enqueue_summary_job(guild_id, PRIORITY_MANUAL, ctx.channel, f"過去{hours}時間の要約", color, window,
+                                  is_weekly=is_weekly, message_id=message.id)
+        return
+    
+    if not SUMMARY_STREAMING:
+        embed = await create_server_summary_embed(ctx.guild, messages_by_channel, window, f"過去{hours}時間の要約", color,
+                                                  is_weekly=is_weekly)
+        await ctx.send(embed=embed)
+        return
+    
+    # 統計だけのEmbedをすぐに投稿し、要約は生成されたところから順に反映する
+    embed = create_stats_embed(guild_id, window, f"過去{hours}時間の要約", color, is_weekly=is_weekly)
+    embed.description = "⏳ 要約を生成しています…"
+    streamer = EmbedStreamer(await ctx.send(embed=embed), embed)
+    summary = await summarize_all_channels(messages_by_channel, is_weekly=is_weekly, guild_id=guild_id,
+                                           window=window, on_text=streamer.update)
+    await streamer.finish(summary)
+
+def search_messages(guild_id, query, hours, channel_ids=None, limit=SEARCH_RESULT_LIMIT):
+    """過去hours時間のメッセージをキーワードで検索し、新しい順に最大limit件返す
+    
+    検索語はキーワードに分け（extract_query_terms参照）、各チャンネルのバケットの転置インデックスで
+    候補を絞ってから、空白区切りの検索語がすべて本文に含まれるかを確認する。
+    キーワードを含まない検索語（ひらがなだけなど）は全件の走査になるので、空のリストを返す。
+    """
+    phrases = normalize_text(query).split()
+    terms = set()
+    for phrase in phrases:
+        terms |= extract_query_terms(phrase)
+    start_ts = datetime.now(timezone.utc).timestamp() - hours * 3600
+    
+    results = []
+    for channel_id, buffer in message_buffers[guild_id].items():
+        if channel_ids is not None and channel_id not in channel_ids:
+            continue
+        results.extend(buffer.search(terms, phrases, start_ts, limit))
+    
+    results.sort(key=lambda msg: msg.ts, reverse=True)
+    return results[:limit]
+
+def make_snippet(content, query, width=80):
+    """検索語の周辺を切り出した本文の抜粋"""
+    content = " ".join(content.split())
+    first = normalize_text(query).split()[0]
+    # 正規化で文字数が変わらない場合は検索語の位置を中心にする
+    normalized = normalize_text(content)
+    pos = normalized.find(first) if len(normalized) == len(content) else -1
+    start = max(pos - width // 3, 0) if pos >= 0 else 0
+    snippet = content[start:start + width].replace("[", "［").replace("]", "］")
+    return ("…" if start > 0 else "") + snippet + ("…" if start + width < len(content) else "")
+
+@bot.command(name='search')
+async def search(ctx, *, args: str = ""):
+    """バッファ内のメッセージを検索するコマンド
+    
+    使用例:
+    !search デプロイ - 過去1週間から検索
+    !search デプロイ 失敗 24 - 過去24時間から「デプロイ」と「失敗」を両方含むメッセージを検索
+    !search デプロイ 48 #dev - #devの過去48時間から検索
+    """
+    if not ctx.guild:
+        await ctx.send("このコマンドはサーバー内でのみ使用できます。")
+        return
+    
+    # 末尾のチャンネル指定と時間を取り出し、残りを検索語とする
+    words = args.split()
+    channel = None
+    if words and re.fullmatch(r"<#\d+>", words[-1]):
+        channel = ctx.guild.get_channel(int(words.pop()[2:-1]))
+    hours = 168
+    if len(words) > 1 and words[-1].isdigit():
+        hours = min(max(int(words.pop()), 1), 168)
+    query = " ".join(words)
+    
+    if not query:
+        await ctx.send("使い方: `!search <検索語> [時間] [#チャンネル]`")
+        return
+    if not extract_query_terms(query):
+        # 転置インデックスで絞り込めない検索語は全件の走査になるので受け付けない
+        await ctx.send("検索語には漢字・カタカナ・3文字以上の英単語のいずれかを含めてください。")
+        return
+    
+    # 実行したユーザーが閲覧できるチャンネルだけを対象にする
+    channel_ids = set()
+    for channel_id in message_buffers[ctx.guild.id]:
+        target = ctx.guild.get_channel(channel_id)
+        if target and (channel is None or target.id == channel.id) and target.permissions_for(ctx.author).read_messages:
+            channel_ids.add(channel_id)
+    
+    started = time.perf_counter()
+    results = search_messages(ctx.guild.id, query, hours, channel_ids)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    
+    embed = discord.Embed(
+        title=f"🔍 「{query}」の検索結果",
+        color=discord.Color.blue()
+    )
+    if results:
+        lines = []
+        for msg in results:
+            posted = msg.timestamp.astimezone(get_guild_timezone(server_configs.get(ctx.guild.id, {})))
+            lines.append(f"**#{msg.channel_name}** {msg.author}（{posted.strftime('%m/%d %H:%M')}）\n"
+                         f"[{make_snippet(msg.content, query)}]({msg.jump_url})")
+        embed.description = truncate_description("\n".join(lines))
+    else:
+        embed.description = "見つかりませんでした。"
+    embed.set_footer(text=f"過去{hours}時間{f' / #{channel.name}' if channel else ''} / {len(results)}件 / {elapsed_ms:.1f}ms")
     await ctx.send(embed=embed)
 
 @bot.command(name='status')
@@ -504,10 +3731,10 @@ async def bot_status(ctx):
         inline=False
     )
     
-    # 監視状況
+    # 監視状況（メッセージ数の多い順）
     active_channels = []
     total_buffered = 0
-    for channel_id, messages in message_buffers[guild_id].items():
+    for channel_id, messages in sorted(message_buffers[guild_id].items(), key=lambda x: len(x[1]), reverse=True):
         if messages:
             channel = ctx.guild.get_channel(channel_id)
             if channel:
@@ -533,51 +3760,76 @@ async def bot_status(ctx):
         inline=True
     )
     
-    # 次回の要約時刻
-    now = datetime.now()
+    # 直近24時間の活動（1時間ごとの集計から）
+    recent = get_window_stats(guild_id, datetime.now(timezone.utc).timestamp() - 24 * 3600)
+    embed.add_field(
+        name="直近24時間",
+        value=f"{recent['total']}件 / {len(recent['channels'])}ch / {len(recent['authors'])}人",
+        inline=True
+    )
+    
+    # 次回の要約時刻（スケジューラのキューから取得）
+    now = datetime.now(timezone.utc)
+    tz = get_guild_timezone(config)
     next_summaries = []
     
-    # 通常の要約
-    for schedule in SUMMARY_SCHEDULE:
-        scheduled_time = datetime.combine(now.date(), time(schedule['hour'], schedule['minute']))
-        if scheduled_time < now:
-            scheduled_time += timedelta(days=1)
-        time_until = scheduled_time - now
-        hours_until = int(time_until.total_seconds() // 3600)
-        minutes_until = int((time_until.total_seconds() % 3600) // 60)
-        next_summaries.append(f"{schedule['hour']}時 ({hours_until}時間{minutes_until}分後) - {schedule['description']}")
-    
-    # 週次要約（月曜日の朝6時 = UTC日曜日21時）
-    days_until_monday = (6 - now.weekday()) % 7  # 次の日曜日（UTC）までの日数
-    if days_until_monday == 0 and now.hour >= WEEKLY_SUMMARY_SCHEDULE['hour']:
-        days_until_monday = 7
-    
-    next_weekly = datetime.combine(
-        now.date() + timedelta(days=days_until_monday),
-        time(WEEKLY_SUMMARY_SCHEDULE['hour'], WEEKLY_SUMMARY_SCHEDULE['minute'])
-    )
-    time_until_weekly = next_weekly - now
-    days = time_until_weekly.days
-    hours = time_until_weekly.seconds // 3600
-    minutes = (time_until_weekly.seconds % 3600) // 60
-    
-    if days > 0:
-        next_summaries.append(f"月曜6時 ({days}日{hours}時間後) - 週次要約")
-    else:
-        next_summaries.append(f"月曜6時 ({hours}時間{minutes}分後) - 週次要約")
+    for fire_at, slot in summary_scheduler.upcoming(guild_id):
+        local = fire_at.astimezone(tz)
+        total_minutes = int((fire_at - now).total_seconds() // 60)
+        days, minutes = divmod(max(total_minutes, 0), 60 * 24)
+        hours, minutes = divmod(minutes, 60)
+        until = f"{days}日{hours}時間後" if days > 0 else f"{hours}時間{minutes}分後"
+        when = f"{WEEKDAY_NAMES[local.weekday()]}曜{local.hour}時" if slot.get('is_weekly') else f"{local.hour}時"
+        next_summaries.append(f"{when}{local.minute:02d}分 ({until}) - {slot['description']}")
     
     embed.add_field(
-        name="次回の要約",
-        value="\n".join(next_summaries),
+        name=f"次回の要約（{tz.key}）",
+        value="\n".join(next_summaries) if next_summaries else "なし",
         inline=False
     )
     
+    # 履歴の取り込み状況
+    if backfill_progress['running']:
+        embed.add_field(
+            name="履歴の取り込み中",
+            value=(f"{backfill_progress['channels_done']}/{backfill_progress['channels_total']}チャンネル完了 "
+                   f"({backfill_progress['messages']}件)"),
+            inline=False
+        )
+    
+    # 前回の定期要約の実行結果
+    if last_scheduled_run:
+        run = last_scheduled_run
+        within_target = "✅" if run['elapsed'] <= SUMMARY_TARGET_WINDOW else "⚠️"
+        embed.add_field(
+            name="前回の定期要約",
+            value=(f"{run['description']}: {run['guilds']}サーバーを{run['elapsed']:.1f}秒で処理 {within_target}\n"
+                   f"投稿 {run['posted']} / スキップ {run['skipped']} / 失敗 {run['failed']}"
+                   + (f" / キュー登録 {run['queued']}" if run['queued'] else "")),
+            inline=False
+        )
+    
     embed.add_field(
         name="AI要約",
         value=f"{MODEL_NAME} 使用中" if GOOGLE_API_KEY else "未設定",
         inline=True
     )
     
+    # モデルごとのサーキットブレーカーの状態
+    breaker_lines = []
+    models = dict.fromkeys([route['model'] for route in MODEL_ROUTES.values()] + ([FALLBACK_MODEL] if FALLBACK_MODEL else []))
+    for model in models:
+        breaker = get_circuit_breaker(model)
+        line = f"{model}: {breaker.describe()}（エラー {breaker.stats['failures']}回 / 停止 {breaker.stats['opened']}回）"
+        if breaker.state != 'closed' and breaker.last_error:
+            line += f"\n└ {breaker.last_error[:100]}"
+        breaker_lines.append(line)
+    embed.add_field(
+        name="Gemini APIの状態",
+        value="\n".join(breaker_lines),
+        inline=False
+    )
+    
     # 稼働時間
     if hasattr(bot, 'start_time'):
         uptime = datetime.now() - bot.start_time
@@ -605,6 +3857,8 @@ async def toggle_summary(ctx):
     guild_id = ctx.guild.id
     if guild_id in server_configs:
         server_configs[guild_id]['enabled'] = not server_configs[guild_id]['enabled']
+        if message_store:
+            await message_store.save_guild_settings(guild_id, server_configs[guild_id])
         status = "有効" if server_configs[guild_id]['enabled'] else "無効"
         await ctx.send(f"要約機能を{status}にしました。")
     else:
@@ -620,20 +3874,106 @@ async def set_summary_channel(ctx, channel: discord.TextChannel):
     guild_id = ctx.guild.id
     if guild_id in server_configs:
         server_configs[guild_id]['summary_channel'] = channel
+        if message_store:
+            await message_store.save_guild_settings(guild_id, server_configs[guild_id])
         await ctx.send(f"要約チャンネルを {channel.mention} に設定しました。")
     else:
         await ctx.send("サーバー設定が見つかりません。")
 
+@bot.command(name='set_timezone')
+@commands.has_permissions(administrator=True)
+async def set_timezone(ctx, timezone_name: str):
+    """定期要約のタイムゾーンを設定（例: !set_timezone Asia/Tokyo）"""
+    if not ctx.guild:
+        return
+    
+    guild_id = ctx.guild.id
+    if guild_id not in server_configs:
+        await ctx.send("サーバー設定が見つかりません。")
+        return
+    
+    try:
+        ZoneInfo(timezone_name)
+    except (ZoneInfoNotFoundError, ValueError):
+        await ctx.send(f"タイムゾーン `{timezone_name}` が見つかりません。`Asia/Tokyo` のようなIANA形式で指定してください。")
+        return
+    
+    config = server_configs[guild_id]
+    config['timezone'] = timezone_name
+    if message_store:
+        await message_store.save_guild_settings(guild_id, config)
+    await summary_scheduler.schedule_guild(guild_id)
+    await ctx.send(f"タイムゾーンを {timezone_name} に設定しました。")
+
+@bot.command(name='set_schedule')
+@commands.has_permissions(administrator=True)
+async def set_schedule(ctx, *hours: int):
+    """定期要約の時刻を設定（例: !set_schedule 6 12 18、引数なしでデフォルトに戻す）"""
+    if not ctx.guild:
+        return
+    
+    guild_id = ctx.guild.id
+    if guild_id not in server_configs:
+        await ctx.send("サーバー設定が見つかりません。")
+        return
+    
+    if any(hour < 0 or hour > 23 for hour in hours):
+        await ctx.send("時刻は0〜23の整数で指定してください。")
+        return
+    
+    config = server_configs[guild_id]
+    config['schedule_hours'] = sorted(set(hours)) or None
+    if message_store:
+        await message_store.save_guild_settings(guild_id, config)
+    await summary_scheduler.schedule_guild(guild_id)
+    
+    slots = get_guild_slots(config)
+    await ctx.send("定期要約の時刻を設定しました: " + "、".join(
+        f"{slot['hour']}時({slot['description']})" for slot in slots if not slot.get('is_weekly')))
+
+@bot.command(name='schedule')
+@commands.has_permissions(administrator=True)
+async def schedule_info(ctx):
+    """このサーバーのスケジュール設定と、全サーバーの定期要約の負荷分散状況を表示"""
+    if not ctx.guild:
+        return
+    
+    config = server_configs.get(ctx.guild.id, {})
+    tz = get_guild_timezone(config)
+    offset = get_schedule_offset(ctx.guild.id)
+    
+    embed = discord.Embed(
+        title="🗓️ 定期要約のスケジュール",
+        color=discord.Color.blue()
+    )
+    
+    embed.add_field(
+        name="このサーバー",
+        value=(f"タイムゾーン: {tz.key}\n"
+               f"時刻: " + "、".join(f"{slot['hour']}時" for slot in get_guild_slots(config) if not slot.get('is_weekly')) + "\n"
+               f"開始のずらし: {offset // 60}分{offset % 60}秒"),
+        inline=False
+    )
+    
+    # 今後24時間の1分あたりの開始予定サーバー数
+    counts = summary_scheduler.due_per_minute()
+    if counts:
+        peaks = sorted(counts.items(), key=lambda x: x[1], reverse=True)[:5]
+        embed.add_field(
+            name="全サーバーの負荷（今後24時間）",
+            value=(f"開始予定: {sum(counts.values())}件 / {len(counts)}分に分散\n"
+                   f"1分あたり最大: {peaks[0][1]}サーバー\n" +
+                   "\n".join(f"{minute.astimezone(tz).strftime('%H:%M')} - {count}サーバー" for minute, count in peaks)),
+            inline=False
+        )
+    
+    await ctx.send(embed=embed)
+
 @bot.command(name='api_usage')
 @commands.has_permissions(administrator=True)
 async def api_usage(ctx):
     """API使用量を表示"""
-    global daily_api_calls, last_reset_date
-    
-    # 日付が変わったらリセット
-    if datetime.now().date() != last_reset_date:
-        daily_api_calls = 0
-        last_reset_date = datetime.now().date()
+    usage = quota_governor.today()
     
     embed = discord.Embed(
         title="📊 Gemini API 使用状況",
@@ -642,20 +3982,42 @@ async def api_usage(ctx):
     
     embed.add_field(
         name="本日の使用回数",
-        value=f"{daily_api_calls} / 1,500回",
+        value=f"{usage['requests']:,} / {GEMINI_RPD:,}回" if GEMINI_RPD else f"{usage['requests']:,}回",
         inline=False
     )
     
+    if GEMINI_RPD:
+        embed.add_field(
+            name="使用率",
+            value=f"{(usage['requests'] / GEMINI_RPD * 100):.1f}%",
+            inline=True
+        )
+        
+        embed.add_field(
+            name="残り回数",
+            value=f"{max(GEMINI_RPD - usage['requests'], 0):,}回",
+            inline=True
+        )
+    
     embed.add_field(
-        name="使用率",
-        value=f"{(daily_api_calls / 1500 * 100):.1f}%",
-        inline=True
+        name="本日のトークン数",
+        value=f"入力 {usage['input_tokens']:,} / 出力 {usage['output_tokens']:,}",
+        inline=False
     )
     
+    # 利用枠（1分のトークンバケットと1日のカウンター）の現在の残量
+    now = time.time()
+    labels = {'rpm': 'リクエスト/分', 'rpd': 'リクエスト/日', 'tpm': '入力トークン/分', 'tpd': '入力トークン/日'}
+    lines = []
+    for name, bucket in quota_governor.buckets.items():
+        lines.append(f"{labels[name]}: 残り {max(bucket.remaining(now), 0):,.0f} / {bucket.capacity:,}")
+    stats = quota_governor.stats
+    lines.append(f"待機中: {len(quota_governor.waiters)}件 / 待機した呼び出し: {stats['waited']}回"
+                 f"（合計{stats['wait_seconds']:.0f}秒） / 枠超過で簡易要約: {stats['rejected']}回")
     embed.add_field(
-        name="残り回数",
-        value=f"{1500 - daily_api_calls}回",
-        inline=True
+        name="利用枠",
+        value="\n".join(lines),
+        inline=False
     )
     
     embed.add_field(
@@ -664,6 +4026,25 @@ async def api_usage(ctx):
         inline=True
     )
     
+    # モデルの振り分け先ごとの応答時間とトークン数
+    route_lines = []
+    for (name, model), stats in sorted(route_stats.items(), key=lambda item: list(MODEL_ROUTES).index(item[0][0])):
+        if not stats['calls']:
+            continue
+        latencies = sorted(stats['latencies'])
+        p95 = latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)]
+        route_lines.append(
+            f"{MODEL_ROUTES[name]['description']}（{model}）: {stats['calls']}回 / エラー {stats['errors']}回\n"
+            f"└ 応答 平均{sum(latencies) / len(latencies):.1f}秒・p95 {p95:.1f}秒 / "
+            f"平均トークン 入力{stats['input_tokens'] // stats['calls']:,}・出力{stats['output_tokens'] // stats['calls']:,}"
+        )
+    if route_lines:
+        embed.add_field(
+            name="モデルの振り分け",
+            value="\n".join(route_lines),
+            inline=False
+        )
+    
     # 予測（1日3回 + 週1回の要約 × サーバー数）
     total_servers = len(server_configs)
     active_servers = len([c for c in server_configs.values() if c['enabled']])
@@ -675,6 +4056,23 @@ async def api_usage(ctx):
         inline=False
     )
     
+    # プロンプトサイズ
+    if prompt_size_stats['calls']:
+        embed.add_field(
+            name="プロンプトサイズ",
+            value=(f"平均 約{prompt_size_stats['total_tokens'] // prompt_size_stats['calls']:,} tokens / "
+                   f"最大 約{prompt_size_stats['max_tokens']:,} tokens（予算 {PROMPT_TOKEN_BUDGET:,}）"),
+            inline=False
+        )
+    
+    # 要約キャッシュの効果
+    stats = summary_cache_stats
+    embed.add_field(
+        name="要約キャッシュ",
+        value=f"ヒット {stats['hits']}回 / 合流 {stats['joined']}回 / 新規生成 {stats['misses']}回（{len(summary_cache)}件保持）",
+        inline=False
+    )
+    
     # 全サーバーの統計
     embed.add_field(
         name="サーバー統計",
@@ -688,8 +4086,10 @@ async def api_usage(ctx):
 @commands.has_permissions(administrator=True)
 async def system_info(ctx):
     """システムリソースの使用状況を表示"""
-    # CPU使用率
-    cpu_percent = psutil.cpu_percent(interval=1)
+    # CPU使用率・プロセス情報（バックグラウンドのサンプラーの最新値を使用）
+    latest = resource_samples[-1] if resource_samples else None
+    cpu_percent = latest['cpu'] if latest else psutil.cpu_percent(interval=None)
+    process_memory = (latest['rss'] if latest else psutil.Process().memory_info().rss) / 1024 / 1024  # MB
     
     # メモリ使用率
     memory = psutil.virtual_memory()
@@ -697,10 +4097,6 @@ async def system_info(ctx):
     memory_used = memory.used / 1024 / 1024 / 1024  # GB
     memory_total = memory.total / 1024 / 1024 / 1024  # GB
     
-    # プロセス情報
-    process = psutil.Process()
-    process_memory = process.memory_info().rss / 1024 / 1024  # MB
-    
     embed = discord.Embed(
         title="🖥️ システム情報",
         color=discord.Color.green()
@@ -724,6 +4120,32 @@ async def system_info(ctx):
         inline=True
     )
     
+    # 直近1時間の推移（最小 / 最大 / p95）
+    if resource_samples:
+        cpu = summarize_samples('cpu')
+        rss = summarize_samples('rss')
+        lag = summarize_samples('loop_lag')
+        buffered = summarize_samples('buffered')
+        minutes = len(resource_samples) * SAMPLER_INTERVAL // 60
+        embed.add_field(
+            name=f"直近{minutes}分の推移（最小 / 最大 / p95）",
+            value=(f"CPU: {cpu[0]:.0f} / {cpu[1]:.0f} / {cpu[2]:.0f}%\n"
+                   f"Bot使用メモリ: {rss[0] / 1024 / 1024:.0f} / {rss[1] / 1024 / 1024:.0f} / {rss[2] / 1024 / 1024:.0f} MB\n"
+                   f"イベントループ遅延: {lag[0] * 1000:.0f} / {lag[1] * 1000:.0f} / {lag[2] * 1000:.0f} ms\n"
+                   f"バッファ件数: {buffered[0]:,} / {buffered[1]:,} / {buffered[2]:,}"),
+            inline=False
+        )
+        
+        # GCの状況（世代別の回収回数は直近1時間の増分）
+        first, last = resource_samples[0], resource_samples[-1]
+        collections = [b - a for a, b in zip(first['gc_collections'], last['gc_collections'])]
+        embed.add_field(
+            name="GC",
+            value=(f"回収回数（世代0/1/2）: {collections[0]}/{collections[1]}/{collections[2]}\n"
+                   f"未回収オブジェクト: {'/'.join(str(c) for c in last['gc_counts'])}"),
+            inline=False
+        )
+    
     embed.add_field(
         name="Python",
         value=platform.python_version(),
@@ -749,14 +4171,143 @@ async def system_info(ctx):
         inline=True
     )
     
+    # シャーディングしている場合はこのプロセスが担当するシャードと応答時間
+    if isinstance(bot, commands.AutoShardedBot) and bot.latencies:
+        latencies = [latency for _, latency in bot.latencies if not math.isnan(latency)]  # 未接続のシャードはNaN
+        embed.add_field(
+            name="シャード",
+            value=(f"{len(bot.latencies)}/{bot.shard_count} シャード（プロセス {WORKER_INDEX + 1}/{WORKER_COUNT}）\n"
+                   f"最大応答時間: {max(latencies, default=0) * 1000:.0f} ms"),
+            inline=True
+        )
+    
     embed.add_field(
         name="メッセージ保持期間",
         value="1週間（168時間）",
         inline=True
     )
     
+    # バッファのメモリ効率
+    total_buffered = sum(get_buffered_message_count(guild_id) for guild_id in list(message_buffers.keys()))
+    bytes_per_message = estimate_message_memory()
+    embed.add_field(
+        name="メッセージバッファ",
+        value=(f"{total_buffered:,}件 / 約{bytes_per_message:.0f} B/件\n"
+               f"推定 {total_buffered * bytes_per_message / 1024 / 1024:.1f} MB"),
+        inline=True
+    )
+    
+    await ctx.send(embed=embed)
+
+@bot.command(name='loop')
+@commands.has_permissions(administrator=True)
+async def loop_info(ctx):
+    """イベントループの遅延と最近の停止（ブロッキング処理）を表示"""
+    if loop_watchdog is None or loop_watchdog.started_at is None:
+        await ctx.send("イベントループの監視は無効です（LOOP_STALL_THRESHOLD / LOOP_WATCHDOG_INTERVAL）。")
+        return
+    
+    embed = discord.Embed(
+        title="🔄 イベントループの状態",
+        color=discord.Color.green() if not loop_watchdog.events else discord.Color.orange()
+    )
+    
+    lags = sorted(loop_watchdog.lags)
+    if lags:
+        minutes = max(round(len(lags) * LOOP_WATCHDOG_INTERVAL / 60), 1)
+        embed.add_field(
+            name=f"直近{minutes}分の遅延（p50 / p95 / 最大）",
+            value=(f"{lags[len(lags) // 2] * 1000:.0f} / {lags[min(int(len(lags) * 0.95), len(lags) - 1)] * 1000:.0f} / "
+                   f"{lags[-1] * 1000:.0f} ms"),
+            inline=False
+        )
+    
+    embed.add_field(
+        name="停止回数",
+        value=f"{loop_watchdog.stalls}回（{LOOP_STALL_THRESHOLD:g}秒以上、{loop_watchdog.started_at.astimezone(JST).strftime('%m/%d %H:%M')}以降）",
+        inline=False
+    )
+    
+    with loop_watchdog.lock:
+        events = list(loop_watchdog.events)
+    
+    if events:
+        # 停止の原因になった箇所を合計時間の長い順に集計
+        locations = defaultdict(lambda: [0, 0.0])
+        for event in events:
+            locations[event['location']][0] += 1
+            locations[event['location']][1] += event['duration'] or 0.0
+        top = sorted(locations.items(), key=lambda item: item[1][1], reverse=True)[:5]
+        embed.add_field(
+            name="停止の多い箇所（回数 / 合計）",
+            value="\n".join(f"`{location}` {count}回 / {total:.1f}秒" for location, (count, total) in top),
+            inline=False
+        )
+        
+        recent = []
+        for event in reversed(events[-5:]):
+            duration = f"{event['duration']:.1f}秒" if event['duration'] is not None else "継続中"
+            recent.append(f"{event['time'].astimezone(JST).strftime('%m/%d %H:%M:%S')} {duration} "
+                          f"`{event['location']}` {event['task'] or 'コールバック'}")
+        embed.add_field(name="最近の停止", value=truncate_description("\n".join(recent), 1024), inline=False)
+        
+        latest = next((event for event in reversed(events) if event['stack']), None)
+        if latest:
+            stack = "".join(latest['stack'][-6:]).rstrip()
+            embed.add_field(name="最後に記録したスタック", value=f"```\n{truncate_description(stack, 1000)}\n```", inline=False)
+    else:
+        embed.add_field(name="最近の停止", value="記録されていません", inline=False)
+    
+    await ctx.send(embed=embed)
+
+@bot.command(name='queue')
+@commands.has_permissions(administrator=True)
+async def queue_info(ctx):
+    """要約ジョブのキューの状況を表示（BOT_ROLE=gateway）"""
+    if BOT_ROLE != 'gateway':
+        await ctx.send("要約ジョブのキューは使用していません（BOT_ROLE=all）。")
+        return
+    
+    stats = await asyncio.to_thread(message_store.queue_stats)
+    now = time.time()
+    
+    def describe(status, label):
+        entry = stats[status]
+        if not entry['count']:
+            return f"{label}: 0件"
+        return f"{label}: {entry['count']}件（最も古いもの {now - entry['oldest']:.0f}秒前に登録）"
+    
+    embed = discord.Embed(
+        title="📥 要約ジョブのキュー",
+        color=discord.Color.orange() if stats['queued']['count'] else discord.Color.green()
+    )
+    embed.add_field(
+        name="現在の状況",
+        value="\n".join([describe('queued', '待機中'), describe('running', '処理中'),
+                         describe('done', '投稿待ち'), describe('failed', '失敗（簡易要約を投稿）'),
+                         describe('posting', '投稿中・投稿の再試行待ち')]),
+        inline=False
+    )
+    
+    embed.add_field(
+        name="処理中のワーカー",
+        value="\n".join(f"`{worker}`: {count}件" for worker, count in stats['workers']) or "なし",
+        inline=False
+    )
+    
+    recent = stats['recent']
+    embed.add_field(
+        name="直近24時間",
+        value=(f"完了 {recent['finished']}件 / 失敗 {recent['failed']}件 / 再試行あり {recent['retried']}件\n"
+               f"登録から完了までの平均: {recent['average'] or 0:.1f}秒"),
+        inline=False
+    )
+    
     await ctx.send(embed=embed)
 
-# Botを起動
+# Botを起動（要約ワーカーはDiscordに接続しない）
 if __name__ == "__main__":
-    bot.run(DISCORD_BOT_TOKEN)
\ No newline at end of file
+    if BOT_ROLE == 'summarizer':
+        asyncio.run(run_summarizer())
+    else:
+        bot.run(DISCORD_BOT_TOKEN)
\ No newline at end of file
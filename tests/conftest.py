@@ -0,0 +1,12 @@
+import os
+import sys
+import tempfile
+
+# bot.pyはインポート時に環境変数を読み込むので、先にテスト用の値を設定する
+os.environ.setdefault('DISCORD_BOT_TOKEN', 'test-token')
+os.environ.setdefault('GOOGLE_API_KEY', 'test-key')
+os.environ['MESSAGE_STORE_PATH'] = os.path.join(tempfile.mkdtemp(), 'messages.db')
+os.environ['METRICS_PORT'] = '0'
+os.environ['LOOP_STALL_THRESHOLD'] = '0'
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
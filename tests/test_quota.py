@@ -0,0 +1,92 @@
+import asyncio
+
+import pytest
+
+import bot
+
+
+def test_token_bucket_refills_over_period():
+    bucket = bot.TokenBucket(10, 60)
+    now = bucket.updated
+    bucket.take(10)
+    assert bucket.wait_time(1, now) == pytest.approx(6)
+    assert bucket.remaining(now + 30) == pytest.approx(5)
+    # 容量を超える量は容量として扱う
+    assert bucket.wait_time(100, now + 30) == pytest.approx(30)
+
+
+def test_daily_counter_waits_until_quota_midnight():
+    counter = bot.DailyCounter(2)
+    now = counter.day + 3600
+    assert counter.wait_time(1, now) == 0
+    counter.take(1)
+    counter.take(1)
+    end = bot.get_quota_day(now)[1]
+    assert counter.wait_time(1, now) == pytest.approx(end - now)
+    # 日付が変わるまで少しずつ回復はしない
+    assert counter.remaining(end - 1) == 0
+    assert counter.wait_time(1, end) == 0
+    assert counter.remaining(end) == 2
+
+
+def test_governor_daily_limit(monkeypatch):
+    monkeypatch.setattr(bot, 'GEMINI_RPM', 0)
+    monkeypatch.setattr(bot, 'GEMINI_TPM', 0)
+    monkeypatch.setattr(bot, 'GEMINI_RPD', 2)
+    monkeypatch.setattr(bot, 'GEMINI_TPD', 0)
+    governor = bot.QuotaGovernor()
+    assert not governor.shared
+
+    async def run():
+        return [await governor.reserve(100) for _ in range(3)]
+
+    first, second, third = asyncio.run(run())
+    assert first == 0 and second == 0
+    assert third > 60
+    # 許可されなかった呼び出しは使用量に数えない
+    assert governor.usage['requests'] == 2
+    assert governor.usage['input_tokens'] == 200
+
+    with pytest.raises(bot.QuotaExceededError):
+        asyncio.run(governor.acquire(100, timeout=0.1))
+
+
+def test_governor_record_adjusts_tokens(monkeypatch):
+    monkeypatch.setattr(bot, 'GEMINI_RPM', 0)
+    monkeypatch.setattr(bot, 'GEMINI_TPM', 0)
+    monkeypatch.setattr(bot, 'GEMINI_RPD', 0)
+    monkeypatch.setattr(bot, 'GEMINI_TPD', 1000)
+    governor = bot.QuotaGovernor()
+
+    asyncio.run(governor.reserve(300))
+    governor.record(300, 500, 40)
+    assert governor.usage == {'date': governor.usage['date'], 'requests': 1, 'input_tokens': 500, 'output_tokens': 40}
+    assert governor.buckets['tpd'].remaining(bot.time.time()) == 500
+
+
+def test_waiters_run_in_priority_order(monkeypatch):
+    monkeypatch.setattr(bot, 'GEMINI_RPM', 0)
+    monkeypatch.setattr(bot, 'GEMINI_TPM', 0)
+    monkeypatch.setattr(bot, 'GEMINI_RPD', 0)
+    monkeypatch.setattr(bot, 'GEMINI_TPD', 0)
+    governor = bot.QuotaGovernor()
+    # 0.05秒ごとに1件だけ許可する
+    bucket = bot.TokenBucket(1, 0.05)
+    bucket.take(1)
+    governor.buckets['rpm'] = bucket
+    order = []
+
+    async def call(name, priority):
+        bot.gemini_priority.set(priority)
+        await governor.acquire(10, timeout=5)
+        order.append(name)
+
+    async def run():
+        await asyncio.gather(
+            call('manual', (bot.PRIORITY_MANUAL, 0)),
+            call('scheduled-large', (bot.PRIORITY_SCHEDULED, 500)),
+            call('scheduled-small', (bot.PRIORITY_SCHEDULED, 5)),
+        )
+
+    asyncio.run(run())
+    assert order == ['scheduled-small', 'scheduled-large', 'manual']
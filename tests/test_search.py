@@ -0,0 +1,89 @@
+import types
+from datetime import datetime, timezone
+
+import discord
+import pytest
+
+import bot
+
+GUILD_ID = 4242
+
+
+def make_message(channel_id, content, offset):
+    created = datetime.now(timezone.utc).replace(microsecond=0)
+    message_id = discord.utils.time_snowflake(created) + offset
+    guild = types.SimpleNamespace(id=GUILD_ID, name='guild')
+    channel = types.SimpleNamespace(id=channel_id, name=f'ch{channel_id}', guild=guild)
+    author = types.SimpleNamespace(id=1, display_name='alice', bot=False)
+    return types.SimpleNamespace(id=message_id, guild=guild, channel=channel, author=author, content=content,
+                                 created_at=created, attachments=[], embeds=[])
+
+
+@pytest.fixture
+def messages():
+    contents = [
+        'デプロイが失敗しました',
+        'the deployment finished',
+        'サーバー障害対応の手順',
+        '本番環境障害の報告です',
+        'ランチに行きます',
+    ]
+    for i, content in enumerate(contents):
+        bot.ingest_message(make_message(10 + i % 2, content, i))
+    yield
+    bot.message_buffers.pop(GUILD_ID, None)
+    bot.message_store.pending.clear()
+
+
+def search(query):
+    return sorted(msg.content for msg in bot.search_messages(GUILD_ID, query, 24))
+
+
+def test_extract_terms():
+    assert bot.extract_terms('The Deployment of 障害対応') == {'deployment', '障害対応'}
+    assert bot.extract_terms('本番環境障害') == {'本番', '番環', '環境', '境障', '障害'}
+    assert bot.extract_query_terms('障害対応') == {'障害', '害対', '対応'}
+
+
+def test_search_whole_terms(messages):
+    assert search('デプロイ') == ['デプロイが失敗しました']
+    assert search('デプロイ 失敗') == ['デプロイが失敗しました']
+    assert search('デプロイ 成功') == []
+
+
+def test_search_inside_longer_terms(messages):
+    # 英単語は前方一致、漢字は長い語の途中でも一致する
+    assert search('deploy') == ['the deployment finished']
+    assert search('障害') == ['サーバー障害対応の手順', '本番環境障害の報告です']
+    assert search('環境障害') == ['本番環境障害の報告です']
+    assert search('対応') == ['サーバー障害対応の手順']
+
+
+def test_search_without_index_terms(messages):
+    # ひらがなだけの検索語は全件を走査せずに空の結果を返す
+    assert bot.extract_query_terms('ほげほげ') == set()
+    assert search('ほげほげ') == []
+    assert search('デプロイ しました') == ['デプロイが失敗しました']
+
+
+def test_vocabulary_follows_buffer():
+    buffer = bot.ChannelBuffer()
+    old = make_message(1, 'deployment deploy debug', 0)
+    old.created_at = old.created_at.replace(year=old.created_at.year - 1)
+    old.id = discord.utils.time_snowflake(old.created_at)
+    buffer.append(bot.MessageData(old))
+    buffer.append(bot.MessageData(make_message(1, 'deployer デプロイメント', 1)))
+    assert buffer.expand_term('deploy') == ['deploy', 'deployer', 'deployment']
+    assert buffer.expand_term('プロイ') == ['デプロイメント']
+
+    buffer.evict_before(old.created_at.timestamp() + 3600)
+    assert buffer.vocabulary == sorted(buffer.documents) == ['deployer', 'デプロイメント']
+    assert buffer.expand_term('deploy') == ['deployer']
+
+    # 復元したバケットは最初の検索で語彙を作り直す
+    restored = bot.ChannelBuffer()
+    for bucket in buffer.buckets:
+        restored.add_bucket(bucket)
+    assert restored.vocabulary is None
+    assert restored.expand_term('deploy') == ['deployer']
+    assert restored.vocabulary == ['deployer', 'デプロイメント']
@@ -0,0 +1,75 @@
+import asyncio
+import types
+from datetime import datetime, timezone
+
+import discord
+
+import bot
+
+GUILD_ID = 5151
+
+
+def make_message(content, offset):
+    created = datetime.now(timezone.utc).replace(microsecond=0)
+    guild = types.SimpleNamespace(id=GUILD_ID, name='guild')
+    channel = types.SimpleNamespace(id=1, name='general', guild=guild)
+    author = types.SimpleNamespace(id=1, display_name='alice', bot=False)
+    return types.SimpleNamespace(id=discord.utils.time_snowflake(created) + offset, guild=guild, channel=channel,
+                                 author=author, content=content, created_at=created, attachments=[], embeds=[])
+
+
+def test_setup_hook_starts_store_flush():
+    assert bot.message_store is not None
+
+    async def run():
+        bot.ingest_message(make_message('起動時の書き込みテスト', 0))
+        await bot.bot.setup_hook()
+        try:
+            assert bot.flush_store_task.is_running()
+            # 開始直後の1回目の実行で書き込み待ちのメッセージがディスクへ反映される
+            for _ in range(50):
+                if not bot.message_store.pending:
+                    break
+                await asyncio.sleep(0.02)
+            assert not bot.message_store.pending
+            await bot.bot.hydration_task
+        finally:
+            bot.flush_store_task.cancel()
+            for task in bot.monitoring_tasks:
+                task.cancel()
+            bot.monitoring_tasks.clear()
+        # 終了時にも残りを書き込む
+        bot.ingest_message(make_message('終了時の書き込みテスト', 1))
+        await bot.bot.close()
+        assert not bot.message_store.pending
+
+    asyncio.run(run())
+    rows = bot.message_store.conn.execute("SELECT content FROM messages WHERE guild_id = ?", (GUILD_ID,)).fetchall()
+    assert sorted(row[0] for row in rows) == ['終了時の書き込みテスト', '起動時の書き込みテスト']
+    bot.message_buffers.pop(GUILD_ID, None)
+
+
+def test_background_task_failures_are_logged(monkeypatch, capsys):
+    scheduler = bot.SummaryScheduler()
+
+    async def broken_run():
+        raise RuntimeError('scheduler broke')
+
+    async def broken_backfill(guilds):
+        raise RuntimeError('backfill broke')
+
+    monkeypatch.setattr(scheduler, 'run', broken_run)
+    monkeypatch.setattr(bot, 'backfill_guilds', broken_backfill)
+
+    async def run():
+        scheduler.start()
+        bot.bot.start_backfill([])
+        assert scheduler.running and len(bot.bot.backfill_tasks) == 1
+        await asyncio.sleep(0.01)
+
+    asyncio.run(run())
+    # 停止したスケジューラは次のon_readyで開始し直せる
+    assert not scheduler.running
+    assert not bot.bot.backfill_tasks
+    out = capsys.readouterr().out
+    assert 'scheduler broke' in out and 'backfill broke' in out
@@ -0,0 +1,96 @@
+import asyncio
+import time
+
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / 'store.db')
+
+
+def job_status(store, job_id):
+    return store.conn.execute("SELECT status, attempts FROM summary_jobs WHERE job_id = ?", (job_id,)).fetchone()
+
+
+def test_claim_job_by_priority_and_size(db_path):
+    store = bot.MessageStore(db_path)
+    manual = asyncio.run(store.enqueue_job(1, bot.PRIORITY_MANUAL, 10, '{}'))
+    large = asyncio.run(store.enqueue_job(2, bot.PRIORITY_SCHEDULED, 500, '{}'))
+    small = asyncio.run(store.enqueue_job(3, bot.PRIORITY_SCHEDULED, 5, '{}'))
+
+    claimed = [store.claim_job('w1', 60, 3)[0] for _ in range(3)]
+    assert claimed == [small, large, manual]
+    assert store.claim_job('w1', 60, 3) is None
+
+
+def test_finish_job_retry(db_path):
+    store = bot.MessageStore(db_path)
+    job_id = asyncio.run(store.enqueue_job(1, bot.PRIORITY_SCHEDULED, 1, '{}'))
+    assert store.claim_job('w1', 60, 3)[5] == 1
+
+    store.finish_job(job_id, 'w1', error='timeout', retry_at=time.time() + 60)
+    assert job_status(store, job_id) == ('queued', 1)
+    # 再試行の時刻までは取得できない
+    assert store.claim_job('w1', 60, 3) is None
+
+    store.conn.execute("UPDATE summary_jobs SET available_at = 0 WHERE job_id = ?", (job_id,))
+    store.conn.commit()
+    assert store.claim_job('w2', 60, 3)[5] == 2
+    store.finish_job(job_id, 'w2', result='要約')
+    assert job_status(store, job_id) == ('done', 2)
+
+
+def test_expired_lease_is_reclaimed(db_path):
+    store = bot.MessageStore(db_path)
+    job_id = asyncio.run(store.enqueue_job(1, bot.PRIORITY_SCHEDULED, 1, '{}'))
+    # 期限切れの実行中のジョブは他のワーカーが取得し直せる
+    assert store.claim_job('w1', -1, 3)[0] == job_id
+    assert store.claim_job('w2', 60, 3)[0] == job_id
+
+    # 取得し直された後の元のワーカーの結果は記録しない
+    store.finish_job(job_id, 'w1', result='古い要約')
+    assert job_status(store, job_id) == ('running', 2)
+    store.finish_job(job_id, 'w2', result='要約')
+    assert job_status(store, job_id) == ('done', 2)
+
+
+def test_expired_lease_exhausts_attempts(db_path):
+    store = bot.MessageStore(db_path)
+    job_id = asyncio.run(store.enqueue_job(1, bot.PRIORITY_SCHEDULED, 1, '{}'))
+    store.claim_job('w1', -1, 2)
+    store.claim_job('w2', -1, 2)
+
+    assert store.claim_job('w3', 60, 2) is None
+    assert job_status(store, job_id) == ('failed', 2)
+    assert store.conn.execute("SELECT error FROM summary_jobs WHERE job_id = ?", (job_id,)).fetchone()[0]
+
+
+def test_claim_runs_across_connections(db_path):
+    first = bot.MessageStore(db_path)
+    second = bot.MessageStore(db_path)
+    fire_at = 1_700_000_000
+
+    assert first.claim_runs(['daily:1', 'daily:2'], fire_at, 'host:0', 60) == ['daily:1', 'daily:2']
+    assert second.claim_runs(['daily:1', 'daily:2', 'daily:3'], fire_at, 'host:1', 60) == ['daily:3']
+    assert second.has_run('daily:1', fire_at, 'host:1')
+    # 再起動後の同じプロセスは投稿を終えていない実行権を取り直せる
+    assert first.claim_runs(['daily:1'], fire_at, 'host:0', 60) == ['daily:1']
+
+    first.finish_runs(['daily:1'], fire_at, 'host:0')
+    assert first.has_run('daily:1', fire_at, 'host:0')
+    assert not first.has_run('daily:2', fire_at, 'host:0')
+
+
+def test_claim_runs_after_lease_expires(db_path):
+    first = bot.MessageStore(db_path)
+    second = bot.MessageStore(db_path)
+    fire_at = 1_700_000_000
+
+    assert first.claim_runs(['daily:1', 'daily:2'], fire_at, 'host:0', -1) == ['daily:1', 'daily:2']
+    first.finish_runs(['daily:1'], fire_at, 'host:0')
+    # 実行済みの実行権は期限が切れても取り直さない
+    assert second.claim_runs(['daily:1', 'daily:2'], fire_at, 'host:1', 60) == ['daily:2']
+    assert first.claim_runs(['daily:2'], fire_at, 'host:0', 60) == []
@@ -0,0 +1,55 @@
+import asyncio
+
+import bot
+
+
+def test_joined_callers_share_one_generation():
+    calls = []
+
+    async def factory():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return '要約'
+
+    async def run():
+        results = await asyncio.gather(*(bot.get_or_create_summary(('shared',), factory) for _ in range(3)))
+        cached = await bot.get_or_create_summary(('shared',), factory)
+        return results, cached
+
+    results, cached = asyncio.run(run())
+    assert results == ['要約'] * 3 and cached == '要約'
+    assert len(calls) == 1
+    bot.summary_cache.clear()
+
+
+def test_generation_continues_until_last_caller_cancels():
+    events = []
+
+    async def factory():
+        try:
+            await asyncio.sleep(0.1)
+        except asyncio.CancelledError:
+            events.append('cancelled')
+            raise
+        events.append('done')
+        return '要約'
+
+    async def run():
+        first = asyncio.create_task(bot.get_or_create_summary(('cancel',), factory))
+        second = asyncio.create_task(bot.get_or_create_summary(('cancel',), factory))
+        await asyncio.sleep(0.01)
+        # 1人がキャンセルしても、もう1人のために生成を続ける
+        first.cancel()
+        assert await second == '要約'
+        assert events == ['done']
+        bot.summary_cache.clear()
+
+        # 全員がキャンセルしたら生成も止める
+        third = asyncio.create_task(bot.get_or_create_summary(('cancel',), factory))
+        await asyncio.sleep(0.01)
+        third.cancel()
+        await asyncio.sleep(0.01)
+        assert events == ['done', 'cancelled']
+        assert ('cancel',) not in bot.inflight_summaries
+
+    asyncio.run(run())